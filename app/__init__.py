@@ -1,18 +1,24 @@
+import json
 import os
-from typing import Mapping
+from typing import Mapping, Optional
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
-def create_app(test_config: Mapping = None) -> Flask:
+def create_app(test_config: Optional[Mapping] = None) -> Flask:
     app = Flask(import_name='app', instance_relative_config=True)
     if test_config is None:
         # load the instance config from ../instance/config.json
         try:
-            app.config.from_json('config.json')
+            app.config.from_file('config.json', json.load)
         except:
             pass
     else:
         app.config.from_mapping(test_config)
+    # trust the X-Forwarded-For header set by this many reverse proxies, so request.remote_addr is the real client
+    if app.config.get('PROXY_COUNT', 0) > 0:
+        proxy_fix = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
+        app.wsgi_app = proxy_fix  # type: ignore[method-assign]
     # create instance folder if it doesn't already exist
     try:
         os.makedirs(app.instance_path)
@@ -20,3 +26,25 @@ def create_app(test_config: Mapping = None) -> Flask:
         pass
 
     return app
+
+
+def create_async_app(test_config: Optional[Mapping] = None):
+    """
+    Like create_app, but makes a Quart app to be served over ASGI. Quart is only imported here, so the WSGI app runs
+    without it.
+    """
+    from quart import Quart
+    app = Quart(import_name='app', instance_relative_config=True)
+    if test_config is None:
+        try:
+            app.config.from_file('config.json', json.load)
+        except:
+            pass
+    else:
+        app.config.from_mapping(test_config)
+    try:
+        os.makedirs(app.instance_path)
+    except OSError:
+        pass
+
+    return app
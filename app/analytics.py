@@ -0,0 +1,88 @@
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterable, List, Optional, Tuple
+
+
+def pike(carcasses: int, illegal_carcasses: int) -> Optional[float]:
+    """
+    Returns the Proportion of Illegally Killed Elephants, or None when there are no carcasses to take it from
+    """
+    if carcasses == 0:
+        return None
+    return illegal_carcasses / carcasses
+
+
+def trend_series(totals: Iterable[Tuple[str, str, int, int, int]],
+                 window: int = 1,
+                 year_from: Optional[int] = None) -> List[dict]:
+    """
+    Derives the PIKE trend of each group from its yearly totals.
+
+    The rolling PIKE of a year is computed from the carcasses of the ``window`` years ending with it, so years with
+    few carcasses do not dominate it. Years without records count as no carcasses. The year over year change is the
+    difference between the PIKE of a year and of the year before, when both are known.
+
+    :param totals: (group_id, group_name, year, carcasses, illegal_carcasses) ordered by group_id and year, as
+        returned by AnalyticsProvider.get_yearly_totals
+    :param window: number of years in a rolling window
+    :param year_from: years before this one only feed the rolling windows of later years and are left out
+    :return: one JSON object per group
+    """
+    series = []
+    for group_id, group in groupby(totals, key=itemgetter(0)):
+        # the window looks back over the rows of the group, so they are kept
+        rows = list(group)
+        points = []
+        window_start = 0
+        window_carcasses = 0
+        window_illegal_carcasses = 0
+        previous = None
+        summary_carcasses = 0
+        summary_illegal_carcasses = 0
+        for _, _, year, carcasses, illegal_carcasses in rows:
+            window_carcasses += carcasses
+            window_illegal_carcasses += illegal_carcasses
+            # drops the years that fell out of the window
+            while rows[window_start][2] <= year - window:
+                window_carcasses -= rows[window_start][3]
+                window_illegal_carcasses -= rows[window_start][4]
+                window_start += 1
+            year_pike = pike(carcasses, illegal_carcasses)
+            if year_from is None or year >= year_from:
+                change = None
+                if previous is not None and previous[0] == year - 1 and previous[1] is not None \
+                        and year_pike is not None:
+                    change = year_pike - previous[1]
+                points.append({
+                    'year':
+                    year,
+                    'carcasses':
+                    carcasses,
+                    'illegalCarcasses':
+                    illegal_carcasses,
+                    'pike':
+                    year_pike,
+                    'rollingPike':
+                    pike(window_carcasses, window_illegal_carcasses),
+                    'yearOverYear':
+                    change,
+                })
+                summary_carcasses += carcasses
+                summary_illegal_carcasses += illegal_carcasses
+            previous = (year, year_pike)
+        if points:
+            series.append({
+                'group':
+                group_id,
+                'name':
+                rows[-1][1],
+                'carcasses':
+                summary_carcasses,
+                'illegalCarcasses':
+                summary_illegal_carcasses,
+                'pike':
+                pike(summary_carcasses, summary_illegal_carcasses),
+                'years':
+                points,
+            })
+    return series
@@ -0,0 +1,264 @@
+import asyncio
+import aiomysql
+from contextlib import asynccontextmanager
+from itertools import islice
+from typing import AsyncIterator, Iterable, List, Optional, Sequence, Set, Tuple
+from .file_access import FileVersionStamp
+from .statements import chunks, INSERT_MIKE_RECORD, REPLACE_MIKE_RECORD, UPDATE_MIKE_RECORD, mike_query_statement, \
+    mike_page_from_rows, yearly_totals_statement, country_totals_refresh_statements, stored_keys_statement, \
+    remove_records_statement, update_params
+from .models import MikeRecord, AsyncMikeRecordProvider, AsyncCountryRecordProvider, AsyncAnalyticsProvider, \
+    DataAccessError, DataVersion, MikeRecordQuery, MikeRecordPage, EditResult, TotalsQuery
+
+
+def _pyformat(sql: str) -> str:
+    """
+    Rewrites the ``?`` placeholders of the statements shared with MariaDBRecordProvider into the ``%s`` ones of
+    aiomysql. None of those statements holds a ``?`` or ``%`` anywhere else.
+    """
+    return sql.replace('?', '%s')
+
+
+async def _chunks_off_loop(items: Iterable, size: int) -> AsyncIterator[list]:
+    """
+    Like statements.chunks, but pulls each chunk on a thread, so producing the items, such as parsing an uploaded
+    datasheet, does not hold up the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    it = iter(items)
+    while True:
+        chunk = await loop.run_in_executor(None,
+                                           lambda: list(islice(it, size)))
+        if not chunk:
+            return
+        yield chunk
+
+
+class AsyncMariaDBRecordProvider(AsyncMikeRecordProvider,
+                                 AsyncCountryRecordProvider,
+                                 AsyncAnalyticsProvider):
+    """
+    Serves the API's reads and writes of MIKE and country records from MariaDB over asyncio, so that a single
+    process can wait on many queries at once. It runs the same statements as MariaDBRecordProvider and shares its
+    data version stamp, so the two can serve the same database side by side.
+
+    The pool holds up to ``ASYNC_DB_POOL_SIZE`` connections and must be opened on the event loop that uses it, with
+    open(), before the first query.
+    """
+
+    def __init__(self,
+                 config: dict,
+                 version_stamp: Optional[FileVersionStamp] = None) -> None:
+        self._config = config
+        self._version_stamp = version_stamp
+        self._chunk_size = config.get('DB_WRITE_CHUNK_SIZE', 1000)
+        self._pool_timeout = config.get('DB_POOL_TIMEOUT', 10.0)
+        self._pool: Optional[aiomysql.Pool] = None
+
+    async def open(self):
+        try:
+            self._pool = await aiomysql.create_pool(
+                host=self._config['DB_HOST'],
+                port=self._config['DB_PORT'],
+                user=self._config['DB_USER'],
+                password=self._config['DB_PASSWORD'],
+                db=self._config['DB_NAME'],
+                minsize=0,
+                maxsize=self._config.get('ASYNC_DB_POOL_SIZE', 20),
+                pool_recycle=self._config.get('DB_POOL_RECYCLE', 3600.0),
+                autocommit=False)
+        except (aiomysql.Error, OSError):
+            raise DataAccessError()
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[aiomysql.Connection]:
+        """
+        Checks out a connection for the duration of an ``async with`` block
+
+        :raises DataAccessError: if the pool is not open or no connection could be obtained within ``DB_POOL_TIMEOUT``
+            seconds
+        """
+        pool = self._pool
+        if pool is None:
+            raise DataAccessError()
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self._pool_timeout)
+        except (asyncio.TimeoutError, aiomysql.Error, OSError):
+            raise DataAccessError()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    async def _fetch_all(self, sql: str, params: tuple = ()) -> List[tuple]:
+        async with self._connection() as conn:
+            try:
+                async with conn.cursor() as cur:
+                    await cur.execute(_pyformat(sql), params)
+                    rows = list(await cur.fetchall())
+                # ends the snapshot of the read so the connection goes back to the pool idle
+                await conn.rollback()
+                return rows
+            except aiomysql.Error:
+                raise DataAccessError()
+
+    async def get_data_version(self) -> Optional[DataVersion]:
+        if self._version_stamp is None:
+            return None
+        # the stamp is a file, so it is read on a thread
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._version_stamp.current)
+
+    async def _data_changed(self):
+        if self._version_stamp is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._version_stamp.bump)
+
+    async def _refresh_country_totals(self, cursor, years: set):
+        for sql, params in country_totals_refresh_statements(years):
+            await cursor.execute(_pyformat(sql), params)
+
+    # Implements AsyncMikeRecordProvider
+
+    async def get_all_mike_record_rows(self) -> List[tuple]:
+        return await self._fetch_all('select * from elephantcarcasses')
+
+    async def query_mike_records(self,
+                                 query: MikeRecordQuery) -> MikeRecordPage:
+        return mike_page_from_rows(
+            query, await self._fetch_all(*mike_query_statement(query)))
+
+    async def add_or_overwrite_mike_records(self,
+                                            records: Iterable[MikeRecord]):
+        async with self._connection() as conn:
+            try:
+                async with conn.cursor() as cur:
+                    years: Set[int] = set()
+                    async for chunk in _chunks_off_loop(
+                            records, self._chunk_size):
+                        await cur.executemany(
+                            _pyformat(REPLACE_MIKE_RECORD),
+                            [record.to_tuple() for record in chunk])
+                        years.update(record.year for record in chunk)
+                    await self._refresh_country_totals(cur, years)
+                await conn.commit()
+                await self._data_changed()
+            except aiomysql.Error:
+                await conn.rollback()
+                raise DataAccessError()
+            except BaseException:
+                await conn.rollback()
+                raise
+
+    async def apply_mike_record_edits(
+            self,
+            added: Sequence[MikeRecord],
+            changed: Sequence[MikeRecord],
+            removed: Sequence[MikeRecord.PrimaryKey],
+            continue_on_error: bool = False) -> EditResult:
+        async with self._connection() as conn:
+            try:
+                async with conn.cursor() as cur:
+                    stored: Set[MikeRecord.PrimaryKey] = set()
+                    keys = [record.get_primary_key() for record in added] + \
+                        [record.get_primary_key() for record in changed] + list(removed)
+                    for chunk in chunks(set(keys), self._chunk_size):
+                        sql, params = stored_keys_statement(chunk)
+                        await cur.execute(_pyformat(sql), params)
+                        stored.update(
+                            MikeRecord.PrimaryKey(mike_site_id, mike_year) for
+                            mike_site_id, mike_year in await cur.fetchall())
+                    result = EditResult.check(added, changed, removed, stored)
+                    if result.failed() and not continue_on_error:
+                        await conn.rollback()
+                        return result
+
+                    to_add = [(i, record) for i, record in enumerate(added)
+                              if result.added[i] == EditResult.OK]
+                    to_change = [
+                        record for i, record in enumerate(changed)
+                        if result.changed[i] == EditResult.OK
+                    ]
+                    to_remove = [
+                        key for i, key in enumerate(removed)
+                        if result.removed[i] == EditResult.OK
+                    ]
+                    for chunk in chunks(to_add, self._chunk_size):
+                        await self._add_edited_records(cur, chunk, result)
+                    if result.failed() and not continue_on_error:
+                        # a concurrent writer took one of the keys after they were checked
+                        await conn.rollback()
+                        return result
+                    for chunk in chunks(to_change, self._chunk_size):
+                        await cur.executemany(
+                            _pyformat(UPDATE_MIKE_RECORD),
+                            [update_params(record) for record in chunk])
+                    for chunk in chunks(to_remove, self._chunk_size):
+                        sql, params = remove_records_statement(chunk)
+                        await cur.execute(_pyformat(sql), params)
+                    years = {
+                        record.year
+                        for i, record in to_add
+                        if result.added[i] == EditResult.OK
+                    }
+                    years.update(record.year for record in to_change)
+                    years.update(record_key[1] for record_key in to_remove)
+                    await self._refresh_country_totals(cur, years)
+                await conn.commit()
+                result.applied = True
+                if years:
+                    await self._data_changed()
+                return result
+            except aiomysql.Error:
+                await conn.rollback()
+                raise DataAccessError()
+            except BaseException:
+                await conn.rollback()
+                raise
+
+    @staticmethod
+    async def _add_edited_records(cursor, records: List[Tuple[int,
+                                                              MikeRecord]],
+                                  result: EditResult):
+        """
+        Inserts a chunk of (index, record) pairs as MariaDBRecordProvider._add_edited_records does
+        """
+        await cursor.execute('savepoint add_records')
+        try:
+            await cursor.executemany(
+                _pyformat(INSERT_MIKE_RECORD),
+                [record.to_tuple() for _, record in records])
+            return
+        except aiomysql.IntegrityError:
+            await cursor.execute('rollback to savepoint add_records')
+        for i, record in records:
+            await cursor.execute('savepoint add_record')
+            try:
+                await cursor.execute(_pyformat(INSERT_MIKE_RECORD),
+                                     record.to_tuple())
+            except aiomysql.IntegrityError:
+                await cursor.execute('rollback to savepoint add_record')
+                result.added[i] = EditResult.DUPLICATE
+
+    # Implements AsyncCountryRecordProvider
+
+    async def get_all_country_record_rows(self) -> List[tuple]:
+        return await self._fetch_all('select '
+                                     'country_name'
+                                     ', country_code'
+                                     ', mike_year'
+                                     ', carcasses'
+                                     ', illegal_carcasses '
+                                     'from country_year_totals '
+                                     'order by country_code, mike_year')
+
+    # Implements AsyncAnalyticsProvider
+
+    async def get_yearly_totals(self, query: TotalsQuery) -> List[tuple]:
+        return await self._fetch_all(*yearly_totals_statement(query))
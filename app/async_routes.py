@@ -0,0 +1,289 @@
+import asyncio
+import codecs
+import csv
+import json
+from typing import Awaitable, Callable, Hashable, Optional
+from quart import Quart, Blueprint, Request, Response, request, jsonify, url_for
+from .analytics import trend_series
+from .auth import AuthProvider, LoginRateLimiter
+from .cache import ResponseCache
+from .compression import ResponseCompressor
+from .datasheet import ColumnarMikeCsvReader, InvalidDatasheetError
+from .jobs import JobRunner
+from .models import AsyncMikeRecordProvider, AsyncCountryRecordProvider, AsyncAnalyticsProvider, \
+    MikeRecordProvider, JobProvider, DataVersion, InvalidRecordError, PasswordCheckBusyError
+from .routes import MIKE_QUERY_PARAMS, MIKE_CSV_URL, VALID_COUNTRY_CODES, EditRequest, parse_mike_record_query, \
+    is_compact_request, parse_trend_query, mike_page_to_json, sync_records_from_mike, \
+    job_to_json, get_auth_token, is_not_modified, set_version_headers, set_encoding_headers
+from .serialization import MIKE_RECORD_ENCODER, COUNTRY_RECORD_ENCODER, encode_compact_mike_rows
+
+
+async def cached_json_response(
+        req: Request,
+        cache: Optional[ResponseCache],
+        key: Hashable,
+        version: Optional[DataVersion],
+        build: Callable[[], Awaitable[str]],
+        compressor: Optional[ResponseCompressor] = None) -> Response:
+    """
+    The asyncio counterpart of routes.cached_json_response, for a ``build`` that awaits the data it serializes.
+    Bodies are compressed on a thread so the event loop carries on meanwhile.
+    """
+    if version is None:
+        return Response(await build(), mimetype='application/json')
+    if cache is None:
+        compressor = None
+    encoding = compressor.negotiate(
+        req.accept_encodings) if compressor is not None else None
+    if is_not_modified(req, version):
+        if cache is not None and compressor is not None and encoding is not None:
+            # the tag names the encoding a 200 would have been sent in
+            body = cache.get(key, version.token)
+            if body is not None:
+                encoding = compressor.negotiate(req.accept_encodings,
+                                                size=len(body))
+        res = set_version_headers(Response('', status=304), version, encoding)
+        return set_encoding_headers(
+            res, encoding) if compressor is not None else res
+    if cache is None:
+        return set_version_headers(
+            Response(await build(), mimetype='application/json'), version)
+    payload = cache.get(key, version.token, encoding)
+    if payload is None:
+        body = cache.get(key, version.token) if encoding is not None else None
+        if body is None:
+            body = (await build()).encode('utf-8')
+            cache.put(key, version.token, body)
+        if compressor is not None and encoding is not None:
+            # small bodies are sent as they are
+            encoding = compressor.negotiate(req.accept_encodings,
+                                            size=len(body))
+        payload = body
+        if compressor is not None and encoding is not None:
+            payload = await asyncio.get_running_loop().run_in_executor(
+                None, compressor.compress, encoding, body)
+            cache.put(key, version.token, payload, encoding)
+    res = set_version_headers(Response(payload, mimetype='application/json'),
+                              version, encoding)
+    return set_encoding_headers(res,
+                                encoding) if compressor is not None else res
+
+
+def register_async_admin_routes(app: Quart,
+                                mike_store: AsyncMikeRecordProvider,
+                                auth: AuthProvider, jobs: JobRunner,
+                                job_mike_store: MikeRecordProvider):
+    admin = Blueprint('admin', 'admin', url_prefix='/admin')
+
+    @admin.before_request
+    async def require_login():
+        token = get_auth_token(request)
+        if token is None or not auth.is_logged_in(token):
+            return jsonify({'message': 'You are not logged in'}), 401
+
+    @admin.route('/upload', methods=['POST'])
+    async def upload_records():
+        file = (await request.files).get('mike_datasheet')
+        if file is None or not file.filename or file.filename.split(
+                '.')[-1].lower() != 'csv':
+            return jsonify(
+                {'message':
+                 'Requires a CSV file in "mike_datasheet" field.'}), 400
+        reader = ColumnarMikeCsvReader(codecs.iterdecode(file.stream, 'utf-8'),
+                                       VALID_COUNTRY_CODES)
+        try:
+            await mike_store.add_or_overwrite_mike_records(reader)
+            return jsonify({
+                'message': 'Database has been updated.',
+                'recordsWritten': reader.records_read,
+                'recordsSkipped': reader.records_skipped
+            }), 200
+        except (InvalidDatasheetError, csv.Error):
+            return jsonify({
+                'message': 'The datasheet is in an invalid format.',
+                'errorCount': reader.error_count,
+                'errors': reader.errors
+            }), 400
+        except UnicodeDecodeError:
+            return jsonify({'message':
+                            'Send the CSV file in UTF-8 encoding.'}), 400
+
+    @admin.route('/update', methods=['GET'])
+    async def update_from_mike():
+        # the download and the synchronization run on a job thread with the blocking store, off the event loop
+        url = app.config.get('MIKE_CSV_URL', MIKE_CSV_URL)
+        force = request.args.get('force', '').lower() == 'true'
+        job = await asyncio.get_running_loop().run_in_executor(
+            None, jobs.submit,
+            'mike_update', lambda progress: sync_records_from_mike(
+                job_mike_store, url, force, progress))
+        return jsonify({
+            'message': 'The update has started.',
+            'jobId': job.job_id
+        }), 202, {
+            'Location': url_for('admin.fetch_job', job_id=job.job_id)
+        }
+
+    @admin.route('/jobs/<job_id>', methods=['GET'])
+    async def fetch_job(job_id: str):
+        job = await asyncio.get_running_loop().run_in_executor(
+            None, jobs.job_store.get_job, job_id)
+        if job is None:
+            return jsonify({'message': 'Not Found'}), 404
+        return jsonify(job_to_json(job)), 200
+
+    @admin.route('/edit', methods=['POST'])
+    async def edit_records():
+        try:
+            edit = EditRequest(await request.get_json())
+        except TypeError:
+            return jsonify({'message': 'Bad Request'}), 400
+        if edit.has_invalid() and not edit.continue_on_error:
+            return jsonify({
+                'message':
+                'One or more of the records supplied are invalid.'
+            }), 400
+        result = await mike_store.apply_mike_record_edits(
+            edit.added, edit.changed, edit.removed, edit.continue_on_error)
+        body, status = edit.result_to_json(result)
+        return jsonify(body), status
+
+    app.register_blueprint(admin)
+
+
+def register_async_routes(
+        app: Quart,
+        mike_store: AsyncMikeRecordProvider,
+        country_store: AsyncCountryRecordProvider,
+        auth: AuthProvider,
+        job_store: JobProvider,
+        job_mike_store: MikeRecordProvider,
+        analytics_store: Optional[AsyncAnalyticsProvider] = None):
+    """
+    Registers the routes of routes.register_routes on a Quart app, with the same requests and responses, served by
+    asyncio stores. Jobs such as /admin/update still run on threads, with the blocking ``job_mike_store`` and
+    ``job_store``. Snapshot exports and streamed responses are not served.
+    """
+    response_cache = ResponseCache(
+        app.config.get('RESPONSE_CACHE_SIZE', 64),
+        app.config.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    compressor = ResponseCompressor.from_config(app.config)
+    jobs = JobRunner(job_store, app.config.get('JOB_WORKERS', 1))
+    login_limiter = LoginRateLimiter(
+        app.config.get('LOGIN_ATTEMPTS_PER_MINUTE', 10),
+        app.config.get('LOGIN_ATTEMPT_BURST', 5))
+
+    @app.before_request
+    async def filter_request_types():
+        if (request.method == 'POST'
+                and not (request.mimetype == 'application/json'
+                         or request.mimetype == 'multipart/form-data')):
+            return jsonify({'message': 'Bad Request'}), 400
+
+    @app.errorhandler(404)
+    async def report_not_found(_):
+        return jsonify({'message': 'Not Found'}), 404
+
+    @app.errorhandler(500)
+    async def report_internal_error(_):
+        return jsonify({'message': 'Internal Server Error'}), 500
+
+    @app.route('/mikerecords', methods=['GET'])
+    async def fetch_mike_records():
+        try:
+            compact = is_compact_request(request.args)
+        except ValueError:
+            return jsonify({'message': 'Bad Request'}), 400
+        if any(x in request.args for x in MIKE_QUERY_PARAMS):
+            return await fetch_mike_record_query(compact)
+        encode = encode_compact_mike_rows if compact else MIKE_RECORD_ENCODER.encode_rows
+
+        async def build() -> str:
+            return encode(await mike_store.get_all_mike_record_rows())
+
+        return await cached_json_response(
+            request, response_cache,
+            ('mikerecords', 'compact') if compact else 'mikerecords', await
+            mike_store.get_data_version(), build, compressor)
+
+    async def fetch_mike_record_query(compact: bool):
+        try:
+            query = parse_mike_record_query(
+                request.args, app.config.get('MAX_PAGE_SIZE', 1000))
+        except (ValueError, KeyError, InvalidRecordError):
+            return jsonify({'message': 'Bad Request'}), 400
+
+        async def build() -> str:
+            return mike_page_to_json(
+                query, await mike_store.query_mike_records(query), compact)
+
+        # an unpaginated query can return the whole table, which is not worth a cache entry per filter
+        cache = response_cache if query.limit is not None else None
+        return await cached_json_response(
+            request, cache, ('mikerecords', query.cache_key(), compact), await
+            mike_store.get_data_version(), build, compressor)
+
+    @app.route('/countryrecords', methods=['GET'])
+    async def fetch_country_records():
+
+        async def build() -> str:
+            return COUNTRY_RECORD_ENCODER.encode_rows(
+                await country_store.get_all_country_record_rows())
+
+        return await cached_json_response(
+            request, response_cache, 'countryrecords', await
+            country_store.get_data_version(), build, compressor)
+
+    @app.route('/analytics/trends', methods=['GET'])
+    async def fetch_trends():
+        if analytics_store is None:
+            return jsonify({'message': 'Not Found'}), 404
+        try:
+            query, window, year_from = parse_trend_query(request.args)
+        except ValueError:
+            return jsonify({'message': 'Bad Request'}), 400
+
+        async def build() -> str:
+            return json.dumps(
+                trend_series(await analytics_store.get_yearly_totals(query),
+                             window, year_from))
+
+        return await cached_json_response(
+            request, response_cache, ('trends', request.query_string), await
+            analytics_store.get_data_version(), build, compressor)
+
+    @app.route('/login', methods=['POST'])
+    async def login():
+        data = await request.get_json()
+        pwd = data.get('password') if isinstance(data, dict) else None
+        token = get_auth_token(request)
+        # if the user wants to refresh their token
+        if token:
+            if auth.is_logged_in(token):
+                return jsonify({'token': auth.generate_new_token()}), 200
+        # else if user wants to login and get a token
+        if pwd:
+            retry_after = login_limiter.try_acquire(request.remote_addr)
+            if retry_after > 0:
+                return jsonify(
+                    {'message':
+                     'Too many login attempts. Try again later.'}), 429, {
+                         'Retry-After': str(int(retry_after) + 1)
+                     }
+            try:
+                # waits for the hash on a thread, so other requests are served meanwhile
+                token = await asyncio.get_running_loop().run_in_executor(
+                    None, auth.login, pwd)
+            except PasswordCheckBusyError:
+                return jsonify(
+                    {'message':
+                     'The server is busy. Try again later.'}), 503, {
+                         'Retry-After': '1'
+                     }
+            if token is not None:
+                return jsonify({'token': token}), 200
+            else:
+                return jsonify({'message': 'Your password is incorrect.'}), 401
+        return jsonify({'message': 'Bad Request'}), 400
+
+    register_async_admin_routes(app, mike_store, auth, jobs, job_mike_store)
@@ -1,22 +1,225 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Union
+from hashlib import blake2b
+from os import path
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Mapping, Optional, Tuple, Union
 from .models import MasterPasswordProvider
 import jwt
 import jwt.exceptions
 
 
+class VerifiedTokenCache:
+    """
+    A bounded, least-recently-used set of tokens whose signature has already been verified.
+
+    Entries are keyed by a digest of the token, so the token itself is never kept, and expire with the token.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        # the expiry time and key ID of each token, by digest
+        self._entries: 'OrderedDict[bytes, Tuple[float, Optional[str]]]' = OrderedDict(
+        )
+        self._lock = Lock()
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, digest: bytes,
+            now: float) -> Optional[Tuple[float, Optional[str]]]:
+        """
+        :return: (expiry time, key ID) of the token, or None if the token is not cached or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return entry
+
+    def put(self, digest: bytes, expires_at: float, key_id: Optional[str]):
+        with self._lock:
+            self._entries[digest] = (expires_at, key_id)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class LoginRateLimiter:
+    """
+    Limits how often each client may try a password, using one token bucket per client.
+
+    A client may make ``burst`` attempts in a row, after which it earns ``per_minute`` attempts a minute. Buckets live
+    in the memory of one process, and the least recently seen clients are forgotten beyond ``max_clients``.
+    """
+
+    def __init__(self,
+                 per_minute: float = 10,
+                 burst: int = 5,
+                 max_clients: int = 10000) -> None:
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_clients = max_clients
+        # the tokens left to each client and when they were counted
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._lock = Lock()
+
+    def try_acquire(self, client: str) -> float:
+        """
+        Counts an attempt by ``client`` if it is allowed one
+
+        :return: 0 if the attempt may go ahead, otherwise the number of seconds until it would be allowed
+        """
+        now = monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(client, (self.burst, now))
+            tokens, wait = self._take(tokens, updated_at, now)
+            self._buckets[client] = (tokens, now)
+            self._buckets.move_to_end(client)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def _take(self, tokens: float, updated_at: float,
+              now: float) -> Tuple[float, float]:
+        """
+        Refills a bucket up to ``now`` and takes a token from it if it has one
+
+        :return: the tokens left and the number of seconds until the next attempt would be allowed, 0 if this one is
+        """
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0.0
+        return tokens, (1 - tokens) / self.rate
+
+
+class SharedLoginRateLimiter(LoginRateLimiter):
+    """
+    A LoginRateLimiter whose buckets are kept in an SQLite file, so that every worker process using the file counts a
+    client's attempts together.
+
+    A bucket that has not been used for long enough to fill up again is deleted, as it is the same as no bucket. If
+    the file cannot be used, attempts are counted in the memory of the process instead.
+    """
+
+    def __init__(self,
+                 db_file: str,
+                 per_minute: float = 10,
+                 burst: int = 5,
+                 max_clients: int = 10000) -> None:
+        super().__init__(per_minute, burst, max_clients)
+        self.db_file = db_file
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        # a connection must not be used by a forked child of the process that opened it
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file,
+                                   timeout=5.0,
+                                   isolation_level=None)
+            # in a write transaction from the start, so processes creating the table at once wait for each other
+            conn.execute('begin immediate')
+            conn.execute('create table if not exists login_buckets '
+                         '( client text not null primary key'
+                         ', tokens real not null'
+                         ', updated_at real not null )')
+            conn.execute('commit')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def try_acquire(self, client: str) -> float:
+        try:
+            conn = self._connection()
+            conn.execute('begin immediate')
+            try:
+                # the clocks of the processes must agree, so this uses the wall clock, read once the bucket is locked
+                now = time()
+                row = conn.execute(
+                    'select tokens, updated_at from login_buckets where client = ?',
+                    (client, )).fetchone()
+                tokens, updated_at = row if row is not None else (self.burst,
+                                                                  now)
+                tokens, wait = self._take(tokens, updated_at,
+                                          max(now, updated_at))
+                conn.execute(
+                    'insert or replace into login_buckets values (?, ?, ?)',
+                    (client, tokens, now))
+                conn.execute('delete from login_buckets where updated_at < ?',
+                             (now - self.burst / self.rate, ))
+                conn.execute('commit')
+            except BaseException:
+                conn.execute('rollback')
+                raise
+        except (sqlite3.Error, OSError):
+            return super().try_acquire(client)
+        return wait
+
+
 class AuthProvider:
-    def __init__(self, master_pwd_provider: MasterPasswordProvider,
-                 secret: str):
+    """
+    Issues and checks login tokens.
+
+    ``secret`` is either a single secret or a mapping of key IDs to secrets. With a mapping, new tokens are signed with
+    the secret of ``key_id`` and carry it in their ``kid`` header, and tokens signed with any other listed secret stay
+    valid until they expire, so secrets can be rotated without logging everyone out. Removing a key ID from the mapping
+    revokes the tokens signed with it.
+    """
+
+    def __init__(self,
+                 master_pwd_provider: MasterPasswordProvider,
+                 secret: Union[str, Mapping[str, str]],
+                 key_id: Optional[str] = None,
+                 token_cache_size: int = 1024):
         self.master_pwd_provider = master_pwd_provider
-        self.secret = secret
+        # tokens signed with a single secret carry no key ID
+        self.secrets: Dict[Optional[str], str]
+        self.key_id: Optional[str]
+        if isinstance(secret, str):
+            self.secrets = {None: secret}
+            self.key_id = None
+        else:
+            self.secrets = {key: value for key, value in secret.items()}
+            self.key_id = key_id if key_id is not None else next(
+                iter(self.secrets))
+        self.secret = self.secrets[self.key_id]
+        self._token_cache = VerifiedTokenCache(token_cache_size)
 
     def is_logged_in(self, token: str) -> bool:
-        try:
-            jwt.decode(token, self.secret, algorithms=['HS256'])
-            return True
-        except (jwt.exceptions.DecodeError, jwt.ExpiredSignatureError) as e:
+        digest = self._token_cache.digest(token)
+        cached = self._token_cache.get(digest, time())
+        if cached is not None:
+            return cached[1] in self.secrets
+        verified = self._verify(token)
+        if verified is None:
             return False
+        self._token_cache.put(digest, *verified)
+        return True
+
+    def _verify(self, token: str) -> Optional[Tuple[float, Optional[str]]]:
+        """
+        :return: the expiry time and key ID of the token if its signature is valid, otherwise None
+        """
+        try:
+            key_id = jwt.get_unverified_header(token).get('kid')
+            secret = self.secrets.get(key_id)
+            if secret is None:
+                return None
+            claims = jwt.decode(token, secret, algorithms=['HS256'])
+            return claims['exp'], key_id
+        except (jwt.exceptions.InvalidTokenError, KeyError):
+            return None
 
     def login(self, password: str) -> Union[str, None]:
         if self.master_pwd_provider.verify_pwd(password):
@@ -25,6 +228,7 @@ class AuthProvider:
             return None
 
     def generate_new_token(self):
-        return jwt.encode({
-            'exp': datetime.utcnow() + timedelta(minutes=30)
-        }, self.secret)
+        headers = {'kid': self.key_id} if self.key_id is not None else None
+        return jwt.encode({'exp': datetime.utcnow() + timedelta(minutes=30)},
+                          self.secret,
+                          headers=headers)
@@ -0,0 +1,48 @@
+"""
+The storage backends that ``STORAGE_BACKEND`` in config.json can select. Each backend's provider implements
+MikeRecordProvider, CountryRecordProvider, AnalyticsProvider, JobProvider and SnapshotExportProvider, as well as the
+schema commands of manage_db.py (migrate, get_schema_version, rebuild_country_totals and check_country_totals).
+"""
+from os import path
+from typing import Callable, Dict
+from .file_access import FileVersionStamp
+from .sqlite_access import SQLiteRecordProvider
+
+
+def create_mariadb_provider(config: dict, instance_folder: str):
+    # imported here so the other backends work without the mariadb connector installed
+    from .data_access import MariaDBRecordProvider
+    return MariaDBRecordProvider(config, FileVersionStamp(instance_folder),
+                                 path.join(instance_folder, 'exports'))
+
+
+def create_sqlite_provider(config: dict,
+                           instance_folder: str) -> SQLiteRecordProvider:
+    db = SQLiteRecordProvider(
+        config.get('SQLITE_DATABASE')
+        or path.join(instance_folder, 'records.sqlite3'), config,
+        FileVersionStamp(instance_folder), path.join(instance_folder,
+                                                     'exports'))
+    # the database lives with the app, so there is no separate setup step to create its schema
+    db.migrate()
+    return db
+
+
+STORAGE_BACKENDS: Dict[str, Callable[[dict, str], object]] = {
+    'mariadb': create_mariadb_provider,
+    'sqlite': create_sqlite_provider,
+}
+
+
+def create_record_provider(config: dict, instance_folder: str):
+    """
+    Creates the provider of the storage backend named by ``STORAGE_BACKEND``, MariaDB by default
+
+    :raises ValueError: if no backend has that name
+    """
+    name = config.get('STORAGE_BACKEND', 'mariadb')
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(
+            'Unknown STORAGE_BACKEND "{}". Choose one of: {}'.format(
+                name, ', '.join(STORAGE_BACKENDS)))
+    return STORAGE_BACKENDS[name](config, instance_folder)
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Hashable, Optional, Tuple
+
+
+class ResponseCache:
+    """
+    A bounded, least-recently-used cache of serialized response bodies tagged with the data version they were built
+    from. An entry is only returned while its version matches the version asked for, so bumping the data version
+    invalidates every entry at once without any cross-process signalling.
+
+    Each entry holds the body as it was built and any compressed variants of it, keyed by their content encoding. The
+    cache holds at most ``max_entries`` entries and, counting every variant, ``max_bytes`` bytes. The entry stored
+    last is always kept, even if it alone is larger than that.
+    """
+
+    def __init__(self,
+                 max_entries: int = 64,
+                 max_bytes: int = 32 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        # the version of each entry and its body by content encoding, None being the body as it was built
+        self._entries: 'OrderedDict[Hashable, Tuple[str, Dict[Optional[str], bytes]]]' = OrderedDict(
+        )
+        self._lock = Lock()
+
+    def get(self,
+            key: Hashable,
+            version: str,
+            encoding: Optional[str] = None) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1].get(encoding)
+
+    def put(self,
+            key: Hashable,
+            version: str,
+            payload: bytes,
+            encoding: Optional[str] = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self._remove(key)
+                entry = self._entries[key] = (version, {})
+            previous = entry[1].get(encoding)
+            if previous is not None:
+                self.size -= len(previous)
+            entry[1][encoding] = payload
+            self.size += len(payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > 1 and (len(
+                    self._entries) > self.max_entries
+                                              or self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable):
+        _, payloads = self._entries.pop(key)
+        self.size -= sum(map(len, payloads.values()))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -0,0 +1,170 @@
+"""
+A compact, column-oriented binary layout for exporting whole tables.
+
+A file holds, in order:
+
+- the 8 bytes ``MIKECOL1``
+- the length of the header, as a little-endian unsigned 32-bit integer
+- the header, a UTF-8 JSON object
+- zero bytes up to the next multiple of 8
+- one buffer per column, each starting at a multiple of 8 bytes from the start of the file
+
+The header lists the number of rows and, for each column, its name, type, the offset of its buffer from the start
+of the file and the buffer's length in bytes. Integer columns are little-endian ``int32`` arrays. String columns are
+dictionary encoded: the header holds the distinct values in a ``dictionary`` list and the buffer holds, for each
+row, the position of its value in that list as a little-endian ``uint16`` or ``uint32`` (given as ``indexType``).
+Every buffer can be viewed as a typed array without copying it, for example with ``new Int32Array(buffer, offset,
+rows)`` in a browser.
+"""
+import json
+import sys
+from array import array
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple
+
+MAGIC = b'MIKECOL1'
+MIME_TYPE = 'application/vnd.mike.columnar'
+_ALIGNMENT = 8
+
+
+def _typecode(size: int, signed: bool) -> str:
+    """
+    Returns the array typecode of the integers that are ``size`` bytes long on this platform
+    """
+    for code in ('bhilq' if signed else 'BHILQ'):
+        if array(code).itemsize == size:
+            return code
+    raise ValueError()
+
+
+_INT32 = _typecode(4, True)
+_UINT16 = _typecode(2, False)
+_UINT32 = _typecode(4, False)
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _padding(length: int) -> bytes:
+    return b'\0' * (-length % _ALIGNMENT)
+
+
+def write_columnar(file: BinaryIO,
+                   names: Sequence[str],
+                   types: Sequence[type],
+                   rows: Iterable[tuple],
+                   metadata: Optional[Dict[str, object]] = None) -> int:
+    """
+    Writes rows to a file in the columnar layout. The rows are read once and only the encoded columns are kept in
+    memory.
+
+    :param names: name of each column, in row order
+    :param types: type of each column, either str or int
+    :param metadata: extra entries for the header
+    :return: the number of rows written
+    :raises ValueError: if a column type is not supported
+    :raises OverflowError: if an integer does not fit in 32 bits
+    """
+    if len(names) != len(types) or any(t not in (str, int) for t in types):
+        raise ValueError()
+    dictionaries: List[Optional[Dict[str, int]]] = [{} if t is str else None
+                                                    for t in types]
+    columns = [array(_UINT32 if t is str else _INT32) for t in types]
+    appends = [column.append for column in columns]
+    count = 0
+    for row in rows:
+        for value, dictionary, append in zip(row, dictionaries, appends):
+            if dictionary is None:
+                append(value)
+            else:
+                index = dictionary.get(value)
+                if index is None:
+                    index = dictionary[value] = len(dictionary)
+                append(index)
+        count += 1
+
+    buffers = []
+    descriptions: List[Dict[str, object]] = []
+    for name, dictionary, column in zip(names, dictionaries, columns):
+        if dictionary is None:
+            descriptions.append({'name': name, 'type': 'int32'})
+        else:
+            index_type = 'uint32'
+            if len(dictionary) <= 1 << 16:
+                column = array(_UINT16, column)
+                index_type = 'uint16'
+            # dictionaries preserve insertion order, so the keys are listed by index
+            descriptions.append({
+                'name': name,
+                'type': 'dictionary',
+                'indexType': index_type,
+                'dictionary': list(dictionary)
+            })
+        buffers.append(_little_endian(column))
+
+    for description, buffer in zip(descriptions, buffers):
+        description['byteLength'] = len(buffer)
+    header = dict(metadata or {}, rows=count, columns=descriptions)
+    # the offsets are written in the header, so the length of the header depends on them: they are shifted by the
+    # length of the last encoding of the header until it stops changing, which takes a couple of rounds
+    data_start = 0
+    while True:
+        for description, offset in zip(descriptions, _offsets(buffers)):
+            description['offset'] = data_start + offset
+        encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        end = len(MAGIC) + 4 + len(encoded)
+        if end + len(_padding(end)) == data_start:
+            break
+        data_start = end + len(_padding(end))
+
+    file.write(MAGIC)
+    file.write(len(encoded).to_bytes(4, 'little'))
+    file.write(encoded)
+    file.write(_padding(end))
+    for buffer in buffers:
+        file.write(buffer)
+        file.write(_padding(len(buffer)))
+    return count
+
+
+def _offsets(buffers: List[bytes]) -> List[int]:
+    offsets = []
+    position = 0
+    for buffer in buffers:
+        offsets.append(position)
+        position += len(buffer) + len(_padding(len(buffer)))
+    return offsets
+
+
+def read_columnar(data: bytes) -> Tuple[dict, Dict[str, list]]:
+    """
+    Decodes a file written by write_columnar
+
+    :return: the header and the values of each column by name
+    :raises ValueError: if the data is not in the columnar layout
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError()
+    header_end = len(MAGIC) + 4 + int.from_bytes(
+        data[len(MAGIC):len(MAGIC) + 4], 'little')
+    header = json.loads(data[len(MAGIC) + 4:header_end].decode('utf-8'))
+    columns = {}
+    for description in header['columns']:
+        if description['type'] == 'int32':
+            values = array(_INT32)
+        else:
+            values = array(_UINT16 if description['indexType'] ==
+                           'uint16' else _UINT32)
+        start = description['offset']
+        values.frombytes(data[start:start + description['byteLength']])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        if description['type'] == 'dictionary':
+            dictionary = description['dictionary']
+            columns[description['name']] = [dictionary[i] for i in values]
+        else:
+            columns[description['name']] = values.tolist()
+    return header, columns
@@ -0,0 +1,117 @@
+"""
+Content-Encoding negotiation for the cached read responses. gzip is always available. Brotli (``br``) and Zstandard
+(``zstd``) are offered when the brotli and zstandard packages are installed.
+"""
+import gzip
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Optional
+from .metrics import phase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+# every encoding the app can send, in the order they are preferred
+CONTENT_ENCODINGS = ('zstd', 'br', 'gzip')
+# each body is compressed once per data version, so the levels favour size over speed
+DEFAULT_LEVELS = {'zstd': 10, 'br': 6, 'gzip': 9}
+# streamed bodies are compressed on every request, so they get a cheaper level
+DEFAULT_STREAM_LEVEL = 6
+# bodies shorter than this gain too little from compression to be worth the client decompressing them
+DEFAULT_MIN_SIZE = 1024
+
+
+def _gzip(level: int) -> Callable[[bytes], bytes]:
+    # mtime=0 keeps the output the same for the same body
+    return lambda payload: gzip.compress(payload, compresslevel=level, mtime=0)
+
+
+def _brotli(level: int) -> Callable[[bytes], bytes]:
+    return lambda payload: brotli.compress(
+        payload, quality=level, mode=brotli.MODE_TEXT)
+
+
+def _zstd(level: int) -> Callable[[bytes], bytes]:
+    # a compressor must not be shared between threads
+    return lambda payload: zstandard.ZstdCompressor(level=level).compress(
+        payload)
+
+
+class ResponseCompressor:
+    """
+    Picks the encoding of a response from the client's ``Accept-Encoding`` header and compresses its body.
+
+    When a client accepts several encodings equally, the first of CONTENT_ENCODINGS that is available wins. Streamed
+    bodies are only sent as gzip. Bodies shorter than ``min_size`` bytes are sent as they are.
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 levels: Optional[Mapping[str, int]] = None,
+                 stream_level: int = DEFAULT_STREAM_LEVEL,
+                 min_size: int = DEFAULT_MIN_SIZE) -> None:
+        levels = dict(DEFAULT_LEVELS, **(levels or {}))
+        self.stream_level = stream_level
+        self.min_size = min_size
+        self.encoders: Dict[str, Callable[[bytes], bytes]] = {}
+        if not enabled:
+            return
+        if zstandard is not None:
+            self.encoders['zstd'] = _zstd(levels['zstd'])
+        if brotli is not None:
+            self.encoders['br'] = _brotli(levels['br'])
+        self.encoders['gzip'] = _gzip(levels['gzip'])
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> 'ResponseCompressor':
+        return cls(
+            config.get('COMPRESS_RESPONSES', True),
+            config.get('COMPRESSION_LEVELS'),
+            config.get('STREAM_COMPRESSION_LEVEL', DEFAULT_STREAM_LEVEL),
+            config.get('COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE))
+
+    def negotiate(self,
+                  accept_encodings,
+                  stream: bool = False,
+                  size: Optional[int] = None) -> Optional[str]:
+        """
+        :param accept_encodings: the parsed ``Accept-Encoding`` header of the request
+        :param stream: whether the body is to be compressed with compress_stream
+        :param size: the length of the body in bytes, if it is known
+        :return: the name of the encoding to send, or None to send the body as it is
+        """
+        if size is not None and size < self.min_size:
+            return None
+        offered = [
+            encoding for encoding in self.encoders
+            if not stream or encoding == 'gzip'
+        ]
+        if not offered:
+            return None
+        # a client that prefers the body as it is gets it that way
+        encoding = accept_encodings.best_match(offered + ['identity'])
+        return encoding if encoding in offered else None
+
+    def compress(self, encoding: str, payload: bytes) -> bytes:
+        return self.encoders[encoding](payload)
+
+    def compress_stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Compresses a body into gzip as its chunks are produced. The compressor holds on to small chunks until it has
+        a block of output, so few tiny writes reach the client.
+        """
+        compressor = zlib.compressobj(self.stream_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            with phase('compress'):
+                data = compressor.compress(chunk)
+            if data:
+                yield data
+        with phase('compress'):
+            data = compressor.flush()
+        yield data
@@ -1,17 +1,312 @@
+import json
 import mariadb
-from os import path
-from .models import MikeRecord, CountryRecord, MikeRecordProvider, CountryRecordProvider, MasterPasswordProvider, \
-    DataAccessError, InvalidPrimaryKeyOperationError, NoMasterPasswordError
-from typing import Iterable, Optional
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHash
+import os
+import threading
+import uuid
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import monotonic
+from .models import MikeRecord, CountryRecord, MikeRecordProvider, CountryRecordProvider, DataAccessError, \
+    DataVersion, InvalidPrimaryKeyOperationError, MikeRecordQuery, MikeRecordPage, Job, JobProvider, SyncSource, \
+    SyncSummary, AnalyticsProvider, TotalsQuery, EditResult
+# the file based providers used to live here and can still be imported from this module
+from .file_access import FileVersionStamp, FileSnapshotExportProvider, TextFileMasterPasswordProvider
+from .metrics import InstrumentedConnection, phase
+from .statements import chunks, INSERT_MIKE_RECORD, REPLACE_MIKE_RECORD, UPDATE_MIKE_RECORD, INSERT_COUNTRY_TOTALS, \
+    ELEPHANTCARCASSES_INDEXES, create_index_statement, mike_query_statement, mike_page_from_rows, \
+    yearly_totals_statement, country_totals_refresh_statements, stored_keys_statement, remove_records_statement, \
+    update_params
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Sequence, Set
 
 
-class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
-    def __init__(self, config: dict) -> None:
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn, now: float) -> None:
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class MariaDBConnectionPool:
+    """
+    A bounded pool of MariaDB connections owned by a single process.
+
+    Connections are opened lazily, up to ``size`` of them. Idle connections that have not been used for
+    ``ping_interval`` seconds are pinged before being handed out, and connections older than ``recycle`` seconds are
+    closed and replaced. When a pool is inherited by a forked child (e.g. a uWSGI worker) the child forgets the parent's
+    connections instead of sharing their sockets and opens its own.
+
+    :param instrument: hand out connections that report their timings and round trips to app.metrics
+    """
+
+    def __init__(self,
+                 connect: Callable[[], object],
+                 size: int = 5,
+                 timeout: float = 10.0,
+                 ping_interval: float = 30.0,
+                 recycle: float = 3600.0,
+                 instrument: bool = False) -> None:
+        if size < 1:
+            raise ValueError(
+                'A connection pool needs room for at least one connection.')
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.recycle = recycle
+        self.instrument = instrument
+        self._reset()
+        # Reset the pool in forked children; a weak reference keeps the hook from pinning the pool in memory
+        pool_ref = weakref.ref(self)
+
+        def reset_in_child() -> None:
+            pool = pool_ref()
+            if pool is not None:
+                pool._reset()
+
+        os.register_at_fork(after_in_child=reset_in_child)
+
+    def _reset(self) -> None:
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle: Deque[_PooledConnection] = deque()
+        self._open = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._checkout_seconds = 0.0
+        self._max_checkout_seconds = 0.0
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        Checks out a connection for the duration of a ``with`` block.
+
+        Whatever transaction is still open when the block exits is rolled back so the next user starts clean.
+
+        :raises DataAccessError: if no connection could be obtained within the pool's timeout
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        with phase('connect'):
+            entry = self._checkout()
+        try:
+            yield InstrumentedConnection(
+                entry.conn) if self.instrument else entry.conn
+        finally:
+            self._checkin(entry)
+
+    def _checkout(self) -> _PooledConnection:
+        start = monotonic()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._open < self.size:
+                    self._open += 1
+                    entry = None
+                else:
+                    if not waited:
+                        waited = True
+                        self._waits += 1
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise DataAccessError()
+                    self._cond.wait(remaining)
+                    continue
+            now = monotonic()
+            if entry is None:
+                try:
+                    entry = _PooledConnection(self._connect(), now)
+                except mariadb.Error:
+                    self._forget()
+                    raise DataAccessError()
+                except BaseException:
+                    # give the reserved slot back whatever went wrong, or the pool shrinks for good
+                    self._forget()
+                    raise
+                with self._cond:
+                    self._created += 1
+            elif now - entry.created_at > self.recycle or (
+                    now - entry.last_used > self.ping_interval
+                    and not self._is_alive(entry.conn)):
+                self._discard(entry)
+                continue
+            with self._cond:
+                elapsed = now - start
+                self._checkouts += 1
+                self._checkout_seconds += elapsed
+                self._max_checkout_seconds = max(self._max_checkout_seconds,
+                                                 elapsed)
+            return entry
+
+    def _checkin(self, entry: _PooledConnection) -> None:
+        try:
+            entry.conn.rollback()
+        except mariadb.Error:
+            self._discard(entry)
+            return
+        entry.last_used = monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        try:
+            conn.ping()
+            return True
+        except mariadb.Error:
+            return False
+
+    def _discard(self, entry: _PooledConnection) -> None:
+        try:
+            entry.conn.close()
+        except mariadb.Error:
+            pass
+        with self._cond:
+            self._discarded += 1
+        self._forget()
+
+    def _forget(self) -> None:
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def close(self) -> None:
+        """
+        Closes every idle connection. Connections that are checked out are closed when they are returned.
+        """
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the pool's state and counters for this process.
+
+        :return: dict with size, open, in_use, idle, checkouts, waits, timeouts, created, discarded,
+            avg_checkout_ms and max_checkout_ms
+        """
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'size':
+                self.size,
+                'open':
+                self._open,
+                'in_use':
+                self._open - idle,
+                'idle':
+                idle,
+                'checkouts':
+                self._checkouts,
+                'waits':
+                self._waits,
+                'timeouts':
+                self._timeouts,
+                'created':
+                self._created,
+                'discarded':
+                self._discarded,
+                'avg_checkout_ms': (self._checkout_seconds / self._checkouts *
+                                    1000) if self._checkouts else 0.0,
+                'max_checkout_ms':
+                self._max_checkout_seconds * 1000,
+            }
+
+
+# Schema migrations as (version, description, statements), applied in order.
+# Every statement must be safe to run again. Never change a released migration, append a new one instead.
+MIGRATIONS = [
+    (1, 'Create and fill country_year_totals', [
+        'create table if not exists country_year_totals '
+        '( country_code char(2) not null'
+        ', mike_year int not null'
+        ', country_name char(100) not null'
+        ', carcasses int not null'
+        ', illegal_carcasses int not null'
+        ', primary key (country_code, mike_year) )',
+        'delete from country_year_totals',
+        INSERT_COUNTRY_TOTALS + 'group by country_code, mike_year',
+    ]),
+    (2, 'Add country and subregion indexes to elephantcarcasses', [
+        create_index_statement('elephantcarcasses', name, columns)
+        for name, columns in ELEPHANTCARCASSES_INDEXES
+    ]),
+    (3, 'Create jobs', [
+        'create table if not exists jobs '
+        '( job_id char(32) not null primary key'
+        ', kind varchar(50) not null'
+        ', status varchar(20) not null'
+        ', created_at datetime(3) not null'
+        ', started_at datetime(3) null'
+        ', finished_at datetime(3) null'
+        ', progress text not null'
+        ', result mediumtext null'
+        ', message varchar(500) null )',
+    ]),
+    (4, 'Create sync_sources and mike_sync_rows', [
+        'create table if not exists sync_sources '
+        '( name varchar(50) not null primary key'
+        ', etag varchar(200) null'
+        ', last_modified varchar(50) null'
+        ', digest char(64) not null'
+        ', synced_at timestamp not null default current_timestamp on update current_timestamp )',
+        'create table if not exists mike_sync_rows '
+        '( mike_site_id char(3) not null'
+        ', mike_year int not null'
+        ', fingerprint char(32) not null'
+        ', primary key (mike_site_id, mike_year) )',
+    ]),
+]
+
+
+def _to_db_time(value: Optional[datetime]) -> Optional[datetime]:
+    # DATETIME columns hold naive UTC times
+    return value.astimezone(timezone.utc).replace(
+        tzinfo=None) if value is not None else None
+
+
+def _from_db_time(value: Optional[datetime]) -> Optional[datetime]:
+    return value.replace(tzinfo=timezone.utc) if value is not None else None
+
+
+class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider,
+                            AnalyticsProvider, JobProvider,
+                            FileSnapshotExportProvider):
+    MIGRATIONS = MIGRATIONS
+
+    def __init__(self,
+                 config: dict,
+                 version_stamp: Optional[FileVersionStamp] = None,
+                 export_folder: Optional[str] = None) -> None:
         self._config = config
+        self._version_stamp = version_stamp
+        self._export_folder = export_folder
+        self._export_lock = threading.Lock()
+        self._chunk_size = config.get('DB_WRITE_CHUNK_SIZE', 1000)
+        self._fetch_size = config.get('DB_FETCH_SIZE', 500)
+        self._pool = MariaDBConnectionPool(
+            self._connect,
+            size=config.get('DB_POOL_SIZE', 5),
+            timeout=config.get('DB_POOL_TIMEOUT', 10.0),
+            ping_interval=config.get('DB_POOL_PING_INTERVAL', 30.0),
+            recycle=config.get('DB_POOL_RECYCLE', 3600.0),
+            instrument=config.get('METRICS_ENABLED', False),
+        )
 
-    def _get_connection(self):
+    def _connect(self):
         return mariadb.connect(
             host=self._config['DB_HOST'],
             port=self._config['DB_PORT'],
@@ -20,6 +315,86 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
             database=self._config['DB_NAME'],
         )
 
+    def _get_connection(self):
+        return self._pool.connection()
+
+    def get_pool_stats(self) -> dict:
+        return self._pool.stats()
+
+    # Schema migrations
+
+    def get_schema_version(self) -> int:
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                self._create_migrations_table(cur)
+                return self._get_schema_version(cur)
+            except mariadb.Error:
+                raise DataAccessError()
+
+    def migrate(self) -> List[int]:
+        """
+        Applies every migration newer than the schema version recorded in the database.
+
+        A named lock keeps several processes starting at once from migrating concurrently.
+
+        :return: the versions that were applied
+        """
+        applied = []
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    "select get_lock('all_ears_migrations', ?)",
+                    (self._config.get('DB_MIGRATION_LOCK_TIMEOUT', 60), ))
+                if cur.fetchone()[0] != 1:
+                    raise DataAccessError()
+                try:
+                    self._create_migrations_table(cur)
+                    current = self._get_schema_version(cur)
+                    for version, description, statements in MIGRATIONS:
+                        if version <= current:
+                            continue
+                        for statement in statements:
+                            cur.execute(statement)
+                        cur.execute(
+                            'insert into schema_migrations (version, description) '
+                            'values (?, ?)', (version, description))
+                        conn.commit()
+                        applied.append(version)
+                finally:
+                    cur.execute("select release_lock('all_ears_migrations')")
+                    cur.fetchone()
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
+        if applied:
+            self._data_changed()
+        return applied
+
+    @staticmethod
+    def _create_migrations_table(cursor):
+        cursor.execute(
+            'create table if not exists schema_migrations '
+            '( version int not null primary key'
+            ', description varchar(200) not null'
+            ', applied_at timestamp not null default current_timestamp )')
+
+    @staticmethod
+    def _get_schema_version(cursor) -> int:
+        cursor.execute(
+            'select coalesce(max(version), 0) from schema_migrations')
+        return cursor.fetchone()[0]
+
+    def get_data_version(self) -> Optional[DataVersion]:
+        if self._version_stamp is None:
+            return None
+        return self._version_stamp.current()
+
+    def _data_changed(self):
+        if self._version_stamp is not None:
+            self._version_stamp.bump()
+
     # Implements MikeRecordProvider
 
     def add_mike_record(self, record: MikeRecord):
@@ -27,7 +402,9 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
             cur = conn.cursor()
             try:
                 self._add_record(cur, record)
+                self._refresh_country_totals(cur, {record.year})
                 conn.commit()
+                self._data_changed()
             except (mariadb.IntegrityError, mariadb.Error) as e:
                 conn.rollback()
                 if isinstance(e, mariadb.IntegrityError):
@@ -36,60 +413,65 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
                     raise DataAccessError()
 
     def add_mike_records(self, records: Iterable[MikeRecord]):
-        curr_record = None
         with self._get_connection() as conn:
             cur = conn.cursor()
+            years: Set[int] = set()
             try:
-                for record in records:
-                    curr_record = record
-                    self._add_record(cur, record)
+                for chunk in chunks(records, self._chunk_size):
+                    self._add_records(cur, chunk)
+                    years.update(record.year for record in chunk)
+                self._refresh_country_totals(cur, years)
                 conn.commit()
-            except (mariadb.IntegrityError, mariadb.Error) as e:
+                self._data_changed()
+            except InvalidPrimaryKeyOperationError:
                 conn.rollback()
-                if isinstance(e, mariadb.IntegrityError):
-                    raise InvalidPrimaryKeyOperationError(curr_record)
-                else:
-                    raise DataAccessError()
+                raise
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
 
     def add_or_overwrite_mike_records(self, records: Iterable[MikeRecord]):
         with self._get_connection() as conn:
             cur = conn.cursor()
+            years: Set[int] = set()
             try:
-                for record in records:
-                    cur.execute(
-                        'replace into elephantcarcasses '
-                        '( un_region'
-                        ', subregion_name'
-                        ', subregion_id'
-                        ', country_name'
-                        ', country_code'
-                        ', mike_site_id'
-                        ', mike_site_name'
-                        ', mike_year'
-                        ', carcasses'
-                        ', illegal_carcasses ) '
-                        'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                        record.to_tuple())
+                for chunk in chunks(records, self._chunk_size):
+                    cur.executemany(REPLACE_MIKE_RECORD,
+                                    [record.to_tuple() for record in chunk])
+                    years.update(record.year for record in chunk)
+                self._refresh_country_totals(cur, years)
                 conn.commit()
+                self._data_changed()
             except mariadb.Error:
                 conn.rollback()
                 raise DataAccessError()
 
     @staticmethod
     def _add_record(cursor, record: MikeRecord):
-        cursor.execute(
-            'insert into elephantcarcasses '
-            '( un_region'
-            ', subregion_name'
-            ', subregion_id'
-            ', country_name'
-            ', country_code'
-            ', mike_site_id'
-            ', mike_site_name'
-            ', mike_year'
-            ', carcasses'
-            ', illegal_carcasses ) '
-            'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', record.to_tuple())
+        cursor.execute(INSERT_MIKE_RECORD, record.to_tuple())
+
+    @classmethod
+    def _add_records(cls, cursor, records: list):
+        """
+        Inserts a chunk of records with one bulk statement.
+
+        The chunk runs inside a savepoint. On a key conflict the chunk is rolled back to the savepoint and replayed
+        row by row, so the exact offending record can be reported.
+
+        :raises InvalidPrimaryKeyOperationError: with the first record whose primary key is already taken
+        """
+        cursor.execute('savepoint add_records')
+        try:
+            cursor.executemany(INSERT_MIKE_RECORD,
+                               [record.to_tuple() for record in records])
+        except mariadb.IntegrityError:
+            cursor.execute('rollback to savepoint add_records')
+            for record in records:
+                try:
+                    cls._add_record(cursor, record)
+                except mariadb.IntegrityError:
+                    raise InvalidPrimaryKeyOperationError(record)
+            raise
 
     def get_mike_record(
             self, record_key: MikeRecord.PrimaryKey) -> Optional[MikeRecord]:
@@ -129,12 +511,44 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
             else:
                 return list(map(MikeRecord.from_tuple, cur))
 
+    def iter_mike_records(self) -> Iterator[MikeRecord]:
+        return map(MikeRecord.from_tuple, self.iter_mike_record_rows())
+
+    def iter_mike_record_rows(self) -> Iterator[tuple]:
+        with self._get_connection() as conn:
+            # an unbuffered cursor reads rows off the socket as they are fetched
+            cur = conn.cursor(buffered=False)
+            try:
+                cur.execute('select * from elephantcarcasses')
+                while True:
+                    rows = cur.fetchmany(self._fetch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            except mariadb.Error:
+                raise DataAccessError()
+            finally:
+                cur.close()
+
+    def query_mike_records(self, query: MikeRecordQuery) -> MikeRecordPage:
+        sql, params = mike_query_statement(query)
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+            except mariadb.Error:
+                raise DataAccessError()
+        return mike_page_from_rows(query, rows)
+
     def update_mike_record(self, record: MikeRecord):
         with self._get_connection() as conn:
             cur = conn.cursor()
             try:
                 self._update_record(cur, record)
+                self._refresh_country_totals(cur, {record.year})
                 conn.commit()
+                self._data_changed()
             except mariadb.Error:
                 conn.rollback()
                 raise DataAccessError()
@@ -142,43 +556,36 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
     def update_mike_records(self, records: Iterable[MikeRecord]):
         with self._get_connection() as conn:
             cur = conn.cursor()
+            years: Set[int] = set()
             try:
-                for record in records:
-                    self._update_record(cur, record)
+                for chunk in chunks(records, self._chunk_size):
+                    cur.executemany(
+                        UPDATE_MIKE_RECORD,
+                        [self._update_params(record) for record in chunk])
+                    years.update(record.year for record in chunk)
+                self._refresh_country_totals(cur, years)
                 conn.commit()
+                self._data_changed()
             except mariadb.Error as e:
                 conn.rollback()
                 raise DataAccessError()
 
+    @classmethod
+    def _update_record(cls, cursor, record: MikeRecord):
+        cursor.execute(UPDATE_MIKE_RECORD, cls._update_params(record))
+
     @staticmethod
-    def _update_record(cursor, record: MikeRecord):
-        cursor.execute(
-            'update elephantcarcasses set'
-            ' un_region = ?'
-            ', subregion_name = ?'
-            ', subregion_id = ?'
-            ', country_name = ?'
-            ', country_code = ?'
-            ', mike_site_name = ?'
-            ', carcasses = ?'
-            ', illegal_carcasses = ?  '
-            'where mike_site_id = ? and mike_year = ?', (
-                record.un_region,
-                record.subregion_name,
-                record.subregion_id,
-                record.country_name,
-                record.country_code,
-                record.mike_site_name,
-                record.carcasses,
-                record.illegal_carcasses,
-            ) + record.get_primary_key())
+    def _update_params(record: MikeRecord) -> tuple:
+        return update_params(record)
 
     def remove_mike_record(self, record_key: MikeRecord.PrimaryKey):
         with self._get_connection() as conn:
             cur = conn.cursor()
             try:
                 self._remove_record(cur, record_key)
+                self._refresh_country_totals(cur, {record_key[1]})
                 conn.commit()
+                self._data_changed()
             except mariadb.Error:
                 conn.rollback()
                 raise DataAccessError()
@@ -187,10 +594,14 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
                             record_keys: Iterable[MikeRecord.PrimaryKey]):
         with self._get_connection() as conn:
             cur = conn.cursor()
+            years: Set[int] = set()
             try:
-                for record_key in record_keys:
-                    self._remove_record(cur, record_key)
+                for chunk in chunks(record_keys, self._chunk_size):
+                    self._remove_records(cur, chunk)
+                    years.update(record_key[1] for record_key in chunk)
+                self._refresh_country_totals(cur, years)
                 conn.commit()
+                self._data_changed()
             except mariadb.Error:
                 conn.rollback()
                 raise DataAccessError()
@@ -201,6 +612,260 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
             'delete from elephantcarcasses '
             'where mike_site_id = ? and mike_year = ?', record_key)
 
+    @staticmethod
+    def _remove_records(cursor,
+                        record_keys: list,
+                        table: str = 'elephantcarcasses'):
+        cursor.execute(*remove_records_statement(record_keys, table))
+
+    def apply_mike_record_edits(self,
+                                added: Sequence[MikeRecord],
+                                changed: Sequence[MikeRecord],
+                                removed: Sequence[MikeRecord.PrimaryKey],
+                                continue_on_error: bool = False) -> EditResult:
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                result = EditResult.check(
+                    added, changed, removed,
+                    self._stored_keys(
+                        cur, [record.get_primary_key() for record in added] +
+                        [record.get_primary_key()
+                         for record in changed] + list(removed)))
+                if result.failed() and not continue_on_error:
+                    conn.rollback()
+                    return result
+
+                to_add = [(i, record) for i, record in enumerate(added)
+                          if result.added[i] == EditResult.OK]
+                to_change = [
+                    record for i, record in enumerate(changed)
+                    if result.changed[i] == EditResult.OK
+                ]
+                to_remove = [
+                    key for i, key in enumerate(removed)
+                    if result.removed[i] == EditResult.OK
+                ]
+                for chunk in chunks(to_add, self._chunk_size):
+                    self._add_edited_records(cur, chunk, result)
+                if result.failed() and not continue_on_error:
+                    # a concurrent writer took one of the keys after they were checked
+                    conn.rollback()
+                    return result
+                for chunk in chunks(to_change, self._chunk_size):
+                    cur.executemany(
+                        UPDATE_MIKE_RECORD,
+                        [self._update_params(record) for record in chunk])
+                for chunk in chunks(to_remove, self._chunk_size):
+                    self._remove_records(cur, chunk)
+                years = {
+                    record.year
+                    for i, record in to_add if result.added[i] == EditResult.OK
+                }
+                years.update(record.year for record in to_change)
+                years.update(record_key[1] for record_key in to_remove)
+                self._refresh_country_totals(cur, years)
+                conn.commit()
+                result.applied = True
+                if years:
+                    self._data_changed()
+                return result
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
+
+    def _stored_keys(self, cursor,
+                     record_keys: List[MikeRecord.PrimaryKey]) -> set:
+        """
+        Returns which of the given primary keys are stored
+        """
+        stored: Set[MikeRecord.PrimaryKey] = set()
+        for chunk in chunks(set(record_keys), self._chunk_size):
+            cursor.execute(*stored_keys_statement(chunk))
+            stored.update(
+                MikeRecord.PrimaryKey(mike_site_id, mike_year)
+                for mike_site_id, mike_year in cursor)
+        return stored
+
+    @classmethod
+    def _add_edited_records(cls, cursor, records: list, result: EditResult):
+        """
+        Inserts a chunk of (index, record) pairs with one bulk statement. If a key turns out to be taken, the chunk is
+        replayed row by row and the records that conflict are marked as duplicates in the result.
+        """
+        cursor.execute('savepoint add_records')
+        try:
+            cursor.executemany(INSERT_MIKE_RECORD,
+                               [record.to_tuple() for _, record in records])
+            return
+        except mariadb.IntegrityError:
+            cursor.execute('rollback to savepoint add_records')
+        for i, record in records:
+            cursor.execute('savepoint add_record')
+            try:
+                cls._add_record(cursor, record)
+            except mariadb.IntegrityError:
+                cursor.execute('rollback to savepoint add_record')
+                result.added[i] = EditResult.DUPLICATE
+
+    def sync_mike_records(self, records: Iterable[MikeRecord]) -> SyncSummary:
+        summary = SyncSummary()
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # fingerprints of the stored records and of the rows of the last synchronized datasheet
+                cur.execute('select * from elephantcarcasses')
+                stored = {}
+                for row in cur.fetchall():
+                    record = MikeRecord.from_tuple(row)
+                    stored[record.get_primary_key()] = record.fingerprint()
+                cur.execute(
+                    'select mike_site_id, mike_year, fingerprint from mike_sync_rows'
+                )
+                synced = {
+                    (row[0].lower(), row[1]): row[2]
+                    for row in cur.fetchall()
+                }
+                seen = {}
+                years: Set[int] = set()
+                for chunk in chunks(records, self._chunk_size):
+                    inserts = []
+                    updates = []
+                    for record in chunk:
+                        key = record.get_primary_key()
+                        fingerprint = record.fingerprint()
+                        seen[key] = fingerprint
+                        current = stored.get(key)
+                        if current == fingerprint:
+                            summary.unchanged += 1
+                            continue
+                        if current is None:
+                            inserts.append(record.to_tuple())
+                            summary.inserted += 1
+                        else:
+                            updates.append(self._update_params(record))
+                            summary.changed += 1
+                        stored[key] = fingerprint
+                        years.add(record.year)
+                    if inserts:
+                        cur.executemany(INSERT_MIKE_RECORD, inserts)
+                    if updates:
+                        cur.executemany(UPDATE_MIKE_RECORD, updates)
+                dropped = [key for key in synced if key not in seen]
+                for chunk in chunks([key for key in dropped if key in stored],
+                                    self._chunk_size):
+                    self._remove_records(cur, chunk)
+                    summary.deleted += len(chunk)
+                    years.update(key[1] for key in chunk)
+                for chunk in chunks(dropped, self._chunk_size):
+                    self._remove_records(cur, chunk, 'mike_sync_rows')
+                for chunk in chunks([
+                        key + (fingerprint, )
+                        for key, fingerprint in seen.items()
+                        if synced.get(key) != fingerprint
+                ], self._chunk_size):
+                    cur.executemany(
+                        'insert into mike_sync_rows (mike_site_id, mike_year, fingerprint) '
+                        'values (?, ?, ?) '
+                        'on duplicate key update fingerprint = values(fingerprint)',
+                        chunk)
+                self._refresh_country_totals(cur, years)
+                conn.commit()
+                if summary.inserted or summary.changed or summary.deleted:
+                    self._data_changed()
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
+        return summary
+
+    def get_sync_source(self, name: str) -> Optional[SyncSource]:
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    'select name, etag, last_modified, digest from sync_sources where name = ?',
+                    (name, ))
+                row = cur.fetchone()
+            except mariadb.Error:
+                raise DataAccessError()
+        return SyncSource(*row) if row is not None else None
+
+    def save_sync_source(self, source: SyncSource):
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    'replace into sync_sources (name, etag, last_modified, digest) values (?, ?, ?, ?)',
+                    (source.name, source.etag, source.last_modified,
+                     source.digest))
+                conn.commit()
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
+
+    # Maintains the country_year_totals aggregate table
+
+    @staticmethod
+    def _refresh_country_totals(cursor, years: set):
+        """
+        Recomputes the country totals of the given years from elephantcarcasses.
+
+        Whole years are recomputed, because a replaced or updated record may have moved to another country. This must
+        run in the same transaction as the write that touched those years.
+        """
+        for sql, params in country_totals_refresh_statements(years):
+            cursor.execute(sql, params)
+
+    def rebuild_country_totals(self):
+        """
+        Recomputes the whole country_year_totals table from elephantcarcasses in one transaction
+        """
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute('delete from country_year_totals')
+                cur.execute(INSERT_COUNTRY_TOTALS +
+                            'group by country_code, mike_year')
+                conn.commit()
+                self._data_changed()
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
+
+    def check_country_totals(self) -> List[CountryRecord.PrimaryKey]:
+        """
+        Compares country_year_totals with the totals computed from elephantcarcasses
+
+        :return: keys of the country totals that are missing, extra or wrong, empty if the table is consistent
+        """
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    'select country_code, mike_year, carcasses, illegal_carcasses '
+                    'from country_year_totals')
+                stored = {
+                    (row[0], row[1]): (row[2], row[3])
+                    for row in cur.fetchall()
+                }
+                cur.execute('select country_code'
+                            ', mike_year'
+                            ', cast(sum(carcasses) as int)'
+                            ', cast(sum(illegal_carcasses) as int) '
+                            'from elephantcarcasses '
+                            'group by country_code, mike_year')
+                expected = {
+                    (row[0], row[1]): (row[2], row[3])
+                    for row in cur.fetchall()
+                }
+            except mariadb.Error:
+                raise DataAccessError()
+        return [
+            CountryRecord.PrimaryKey(*key)
+            for key in sorted(stored.keys() | expected.keys())
+            if stored.get(key) != expected.get(key)
+        ]
+
     # Implements CountryRecordProvider
 
     def get_country_record(
@@ -214,63 +879,108 @@ class MariaDBRecordProvider(MikeRecordProvider, CountryRecordProvider):
                     'country_name'
                     ', country_code'
                     ', mike_year'
-                    ', cast(sum(carcasses) as int) as carcasses'
-                    ', cast(sum(illegal_carcasses) as int) as illegal_carcasses '
-                    'from elephantcarcasses '
-                    'where country_code = ? and mike_year = ? '
-                    'group by country_code, mike_year', record_key)
+                    ', carcasses'
+                    ', illegal_carcasses '
+                    'from country_year_totals '
+                    'where country_code = ? and mike_year = ?', record_key)
+                row = cur.fetchone()
             except mariadb.Error:
                 raise DataAccessError()
-            if cur.fieldcount() == 0:
+            if row is None:
                 return None
             else:
-                return CountryRecord.from_tuple(cur.fetchone())
+                return CountryRecord.from_tuple(row)
 
     def get_all_country_records(self) -> Iterable[CountryRecord]:
+        return list(
+            map(CountryRecord.from_tuple, self.get_all_country_record_rows()))
+
+    def get_all_country_record_rows(self) -> List[tuple]:
         with self._get_connection() as conn:
             cur = conn.cursor()
             try:
-                cur.execute(
-                    'select '
-                    'country_name'
-                    ', country_code'
-                    ', mike_year'
-                    ', cast(sum(carcasses) as int) as carcasses'
-                    ', cast(sum(illegal_carcasses) as int) as illegal_carcasses '
-                    'from elephantcarcasses '
-                    'group by country_code, mike_year')
+                cur.execute('select '
+                            'country_name'
+                            ', country_code'
+                            ', mike_year'
+                            ', carcasses'
+                            ', illegal_carcasses '
+                            'from country_year_totals '
+                            'order by country_code, mike_year')
             except mariadb.Error:
                 raise DataAccessError()
             if cur.fieldcount() == 0:
                 return []
             else:
-                return list(map(lambda x: CountryRecord.from_tuple(x), cur))
+                return cur.fetchall()
+
+    # Implements AnalyticsProvider
+
+    def get_yearly_totals(self, query: TotalsQuery) -> List[tuple]:
+        sql, params = yearly_totals_statement(query)
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(sql, params)
+                return cur.fetchall()
+            except mariadb.Error:
+                raise DataAccessError()
 
+    # Implements JobProvider
 
-class TextFileMasterPasswordProvider(MasterPasswordProvider):
-    def __init__(self, instance_folder: str) -> None:
-        self.master_pwd_file = path.join(instance_folder, 'password.txt')
+    def create_job(self, kind: str) -> Job:
+        job = Job(uuid.uuid4().hex, kind, Job.QUEUED,
+                  datetime.now(timezone.utc))
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    'insert into jobs (job_id, kind, status, created_at, progress) '
+                    'values (?, ?, ?, ?, ?)',
+                    (job.job_id, job.kind, job.status,
+                     _to_db_time(job.created_at), json.dumps(job.progress)))
+                conn.commit()
+            except mariadb.Error:
+                conn.rollback()
+                raise DataAccessError()
+        return job
 
-    def verify_pwd(self, plain_pwd: str) -> bool:
-        if path.isfile(self.master_pwd_file):
+    def update_job(self, job: Job):
+        with self._get_connection() as conn:
+            cur = conn.cursor()
             try:
-                with open(self.master_pwd_file, 'r') as f:
-                    master_pwd_hash = f.read()
-                    if master_pwd_hash == '':
-                        raise NoMasterPasswordError()
-                    else:
-                        return PasswordHasher().verify(master_pwd_hash,
-                                                       plain_pwd)
-            except OSError:
+                cur.execute(
+                    'update jobs set'
+                    ' status = ?'
+                    ', started_at = ?'
+                    ', finished_at = ?'
+                    ', progress = ?'
+                    ', result = ?'
+                    ', message = ? '
+                    'where job_id = ?',
+                    (job.status, _to_db_time(job.started_at),
+                     _to_db_time(job.finished_at), json.dumps(
+                         job.progress), json.dumps(job.result) if job.result
+                     is not None else None, job.message, job.job_id))
+                conn.commit()
+            except mariadb.Error:
+                conn.rollback()
                 raise DataAccessError()
-            except (VerifyMismatchError, VerificationError, InvalidHash):
-                return False
-        else:
-            raise NoMasterPasswordError()
 
-    def set_master_pwd(self, new_pwd: str):
-        try:
-            with open(self.master_pwd_file, 'w') as f:
-                f.write(PasswordHasher().hash(new_pwd))
-        except OSError:
-            raise DataAccessError()
+    def get_job(self, job_id: str) -> Optional[Job]:
+        with self._get_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    'select job_id, kind, status, created_at, started_at, finished_at, progress, result, message '
+                    'from jobs where job_id = ?', (job_id, ))
+                row = cur.fetchone()
+            except mariadb.Error:
+                raise DataAccessError()
+        if row is None:
+            return None
+        # jobs always have a creation time
+        return Job(row[0], row[1], row[2], row[3].replace(tzinfo=timezone.utc),
+                   _from_db_time(row[4]), _from_db_time(row[5]),
+                   json.loads(row[6]),
+                   json.loads(row[7]) if row[7] is not None else None, row[8])
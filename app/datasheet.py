@@ -0,0 +1,246 @@
+"""
+Column at a time parsing of MIKE CSV datasheets. Rows are read in blocks and transposed into columns: numbers into
+typed arrays and IDs into dictionary encoded index arrays, so each constraint is checked once per column or once per
+distinct value instead of once per row.
+"""
+import csv
+from array import array
+from itertools import compress, islice, repeat
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from .models import MikeRecord
+
+MIKE_CSV_COLUMNS = ('UNRegion', 'SubregionName', 'SubregionID', 'CountryName',
+                    'CountryCode', 'MIKEsiteID', 'MIKEsiteName', 'year',
+                    'TotalNumberOfCarcasses', 'NumberOfIllegalCarcasses')
+# the length each ID column must have, by column
+ID_LENGTHS = {'SubregionID': 2, 'CountryCode': 2, 'MIKEsiteID': 3}
+NUMBER_COLUMNS = ('year', 'TotalNumberOfCarcasses', 'NumberOfIllegalCarcasses')
+
+
+class InvalidDatasheetError(Exception):
+
+    def __init__(self, errors: List[dict], error_count: int):
+        self.errors = errors
+        self.error_count = error_count
+        super().__init__()
+
+
+class _Dictionary(dict):
+    """
+    Numbers each distinct value in the order it is first seen
+    """
+
+    def __missing__(self, key: str) -> int:
+        index = self[key] = len(self)
+        return index
+
+
+class _Numbers(dict):
+    """
+    Parses each distinct value once
+    """
+
+    def __missing__(self, key: str) -> int:
+        number = self[key] = int(key)
+        return number
+
+
+class ColumnarMikeCsvReader:
+    """
+    Lazily reads MIKE records from the lines of a CSV datasheet a column at a time, keeping only the current block of
+    rows in memory.
+
+    Records from countries outside ``country_codes`` are skipped. Once a block holds a bad value no more records are
+    yielded, but the rest of the datasheet is still read so that every error can be reported. After the last row,
+    InvalidDatasheetError is raised if any value was bad. A consumer that writes the records inside a transaction
+    therefore rolls the whole datasheet back. Each error names its row, with row 1 being the header, and its column.
+    """
+    MAX_REPORTED_ERRORS = 100
+    # blocks of 2048 rows read slower than a row at a time once the process held a large heap, as the app does while
+    # serving; blocks this small stay well ahead, see benchmarks/bench_csv.py
+    BLOCK_ROWS = 256
+
+    def __init__(self,
+                 csv_lines: Iterable[str],
+                 country_codes: Optional[set] = None) -> None:
+        self.csv_lines = csv_lines
+        self.country_codes = country_codes
+        self.rows_read = 0
+        self.records_read = 0
+        self.records_skipped = 0
+        self.errors: List[dict] = []
+        self.error_count = 0
+
+    def _report(self, block_errors: List[tuple]):
+        self.error_count += len(block_errors)
+        room = self.MAX_REPORTED_ERRORS - len(self.errors)
+        if room > 0:
+            self.errors.extend({
+                'row': row,
+                'column': MIKE_CSV_COLUMNS[column],
+                'message': message
+            } for row, column, message in sorted(block_errors)[:room])
+
+    @staticmethod
+    def _parse_numbers(values: Sequence[str], rows: Sequence[int], column: int,
+                       numbers_seen: _Numbers, errors: List[tuple]) -> array:
+        try:
+            numbers = array('q', map(numbers_seen.__getitem__, values))
+        except (ValueError, OverflowError):
+            # find the bad values only once the whole column failed
+            numbers = array('q', bytes(8 * len(values)))
+            for i, value in enumerate(values):
+                try:
+                    numbers[i] = int(value)
+                except ValueError:
+                    errors.append(
+                        (rows[i], column, 'The value is not an integer.'))
+                except OverflowError:
+                    errors.append(
+                        (rows[i], column, 'The number is too large.'))
+        if numbers and min(numbers) < 0:
+            errors.extend((rows[i], column, 'The number is negative.')
+                          for i, number in enumerate(numbers) if number < 0)
+        return numbers
+
+    @staticmethod
+    def _encode_ids(values: Sequence[str], rows: Sequence[int], column: int,
+                    dictionary: _Dictionary, errors: List[tuple]) -> array:
+        known = len(dictionary)
+        indices = array('I', map(dictionary.__getitem__, values))
+        length = ID_LENGTHS[MIKE_CSV_COLUMNS[column]]
+        if len(dictionary) > known:
+            # only the values first seen in this block need checking
+            bad = {
+                index
+                for index, value in enumerate(islice(dictionary, known, None),
+                                              known) if len(value) != length
+            }
+            if bad:
+                message = 'The ID must be {} characters long.'.format(length)
+                errors.extend((rows[i], column, message)
+                              for i, index in enumerate(indices)
+                              if index in bad)
+        return indices
+
+    def _read_blocks(
+        self, lines: Iterator[str], width: int, positions: List[int]
+    ) -> Iterator[Tuple[Sequence[int], List[Sequence[str]], List[tuple]]]:
+        """
+        Splits the lines after the header into blocks of rows
+
+        :return: for each block, the number of each of its rows, the values of each column and the errors so far
+        """
+        first_row = 2
+        while True:
+            block = list(islice(lines, self.BLOCK_ROWS))
+            if not block:
+                return
+            text = ''.join(block)
+            if '"' not in text and set(map(str.count, block,
+                                           repeat(','))) == {width - 1}:
+                # without quotes and with a value for every column, each column is a slice of the split block
+                values = ','.join(map(str.rstrip, block,
+                                      repeat('\r\n'))).split(',')
+                numbered = range(first_row, first_row + len(block))
+                first_row += len(block)
+                self.rows_read += len(block)
+                yield numbered, [
+                    values[position::width] for position in positions
+                ], []
+                continue
+            while text.count('"') % 2:
+                # a quoted value goes on past the end of the block
+                line = next(lines, None)
+                if line is None:
+                    break
+                block.append(line)
+                text += line
+            errors: List[tuple] = []
+            rows: List[int] = []
+            kept = []
+            needed = max(positions) + 1
+            for row, values in enumerate(csv.reader(block), first_row):
+                if len(values) >= needed:
+                    rows.append(row)
+                    kept.append(values)
+                elif values:
+                    # blank lines are skipped, like csv.DictReader does, and short rows are errors
+                    column = next(column
+                                  for column, position in enumerate(positions)
+                                  if position >= len(values))
+                    errors.append((row, column, 'A value is missing.'))
+                first_row = row + 1
+            self.rows_read += len(kept) + len(errors)
+            transposed: List[Sequence[str]] = list(zip(*kept)) or [()] * needed
+            yield rows, [transposed[position]
+                         for position in positions], errors
+
+    def __iter__(self) -> Iterator[MikeRecord]:
+        lines = iter(self.csv_lines)
+        header = next(csv.reader(islice(lines, 1)), [])
+        missing = [x for x in MIKE_CSV_COLUMNS if x not in header]
+        if missing:
+            self.error_count += 1
+            self.errors.append({
+                'row':
+                1,
+                'column':
+                None,
+                'message':
+                'Missing columns: ' + ', '.join(missing)
+            })
+            raise InvalidDatasheetError(self.errors, self.error_count)
+        positions = [header.index(x) for x in MIKE_CSV_COLUMNS]
+        numbers = {
+            column: _Numbers()
+            for column, name in enumerate(MIKE_CSV_COLUMNS)
+            if name in NUMBER_COLUMNS
+        }
+        ids = {
+            column: _Dictionary()
+            for column, name in enumerate(MIKE_CSV_COLUMNS)
+            if name in ID_LENGTHS
+        }
+        # the lower case spelling of every distinct ID, by index
+        lowered: Dict[int, List[str]] = {column: [] for column in ids}
+        country_column = MIKE_CSV_COLUMNS.index('CountryCode')
+        # whether each distinct country code is tracked, by index
+        tracked: List[bool] = []
+        for rows, values, errors in self._read_blocks(lines, len(header),
+                                                      positions):
+            columns: List[Iterable] = []
+            for column, column_values in enumerate(values):
+                if column in numbers:
+                    columns.append(
+                        self._parse_numbers(column_values, rows, column,
+                                            numbers[column], errors))
+                elif column in ids:
+                    indices = self._encode_ids(column_values, rows, column,
+                                               ids[column], errors)
+                    lowered[column].extend(value.lower() for value in islice(
+                        ids[column], len(lowered[column]), None))
+                    if column == country_column:
+                        country_indices = indices
+                    columns.append(map(lowered[column].__getitem__, indices))
+                else:
+                    # other text is stored as it is
+                    columns.append(column_values)
+            if errors:
+                self._report(errors)
+            if self.error_count > 0:
+                continue
+            if self.country_codes is not None:
+                tracked.extend(
+                    value in self.country_codes
+                    for value in lowered[country_column][len(tracked):])
+                mask = bytes(map(tracked.__getitem__, country_indices))
+                self.records_skipped += len(mask) - mask.count(1)
+                columns = [
+                    compress(column_values, mask) for column_values in columns
+                ]
+            for record_values in zip(*columns):
+                self.records_read += 1
+                yield MikeRecord(*record_values)
+        if self.error_count > 0:
+            raise InvalidDatasheetError(self.errors, self.error_count)
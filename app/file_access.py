@@ -0,0 +1,308 @@
+"""
+The parts of the data access layer kept in the instance folder instead of a database: the data version stamp, the
+snapshot exports and the master password.
+"""
+import os
+import threading
+import uuid
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import path
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHash
+from .columnar import write_columnar
+from .models import MikeRecord, CountryRecord, MasterPasswordProvider, DataAccessError, DataVersion, \
+    NoMasterPasswordError, PasswordCheckBusyError, SnapshotExport, SnapshotExportProvider
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where password checks are only capped per process
+    fcntl = None  # type: ignore[assignment]
+
+
+class FileVersionStamp:
+    """
+    A data version token kept in a file so that every worker process sees the same version.
+
+    Bumping writes a new random token to a temporary file and atomically renames it over the stamp, so readers never
+    observe a partially written token.
+    """
+
+    def __init__(self, instance_folder: str) -> None:
+        self.stamp_file = path.join(instance_folder, 'data_version')
+
+    def current(self) -> DataVersion:
+        try:
+            with open(self.stamp_file, 'r') as f:
+                token = f.read()
+                modified = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            token = ''
+        except OSError:
+            raise DataAccessError()
+        if token == '':
+            return self.bump()
+        return DataVersion(token,
+                           datetime.fromtimestamp(modified, timezone.utc))
+
+    def bump(self) -> DataVersion:
+        token = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        tmp_file = '{}.{}.{}.tmp'.format(self.stamp_file, os.getpid(),
+                                         threading.get_ident())
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(token)
+            os.replace(tmp_file, self.stamp_file)
+        except OSError:
+            raise DataAccessError()
+        return DataVersion(token, now)
+
+
+_EXPORT_SUFFIX = '.mkcol'
+
+
+class FileSnapshotExportProvider(SnapshotExportProvider):
+    """
+    Keeps columnar exports of the tables in a folder, one per table and data version, produced from the rows of the
+    record providers it is mixed into. Subclasses set ``_export_folder`` and ``_export_lock``.
+    """
+    _export_folder: Optional[str] = None
+    _export_lock: threading.Lock
+
+    @abstractmethod
+    def iter_mike_record_rows(self) -> Iterator[tuple]:
+        """
+        The rows of the MIKE record export, as MikeRecordProvider.iter_mike_record_rows yields them
+        """
+        pass
+
+    @abstractmethod
+    def get_all_country_record_rows(self) -> List[tuple]:
+        """
+        The rows of the country record export, as CountryRecordProvider.get_all_country_record_rows returns them
+        """
+        pass
+
+    @abstractmethod
+    def get_data_version(self) -> Optional[DataVersion]:
+        """
+        The version each export is named after. Exports need one, so providers that return None cannot export.
+        """
+        pass
+
+    def get_snapshot_export(self, table: str) -> SnapshotExport:
+        names: Sequence[str]
+        types: Sequence[type]
+        rows: Callable[[], Iterable[tuple]]
+        if table == self.MIKE_RECORDS:
+            names, types, rows = MikeRecord.JSON_KEYS, MikeRecord.FIELD_TYPES, self.iter_mike_record_rows
+        elif table == self.COUNTRY_RECORDS:
+            names, types, rows = CountryRecord.JSON_KEYS, CountryRecord.FIELD_TYPES, self.get_all_country_record_rows
+        else:
+            raise ValueError()
+        # exports are named after the version they were produced from, so they need a version to exist
+        version = self.get_data_version()
+        if self._export_folder is None or version is None:
+            raise DataAccessError()
+        export_file = path.join(
+            self._export_folder, '{}-{}{}'.format(table, version.token,
+                                                  _EXPORT_SUFFIX))
+        export = self._open_export(export_file, version)
+        if export is not None:
+            return export
+        with self._export_lock:
+            export = self._open_export(export_file, version)
+            if export is None:
+                export = self._write_export(export_file, table, names, types,
+                                            rows(), version)
+                self._remove_stale_exports(table, export_file)
+            return export
+
+    @staticmethod
+    def _open_export(export_file: str,
+                     version: DataVersion) -> Optional[SnapshotExport]:
+        try:
+            f = open(export_file, 'rb')
+        except FileNotFoundError:
+            return None
+        except OSError:
+            raise DataAccessError()
+        return SnapshotExport(f, os.fstat(f.fileno()).st_size, version)
+
+    @staticmethod
+    def _write_export(export_file: str, table: str, names: Sequence[str],
+                      types: Sequence[type], rows: Iterable[tuple],
+                      version: DataVersion) -> SnapshotExport:
+        """
+        Writes an export to a temporary file and renames it into place, so other processes never open a partial
+        export. The file that was written is returned still open, so it is served even if another process removes it
+        right away.
+        """
+        tmp_file = '{}.{}.{}.tmp'.format(export_file, os.getpid(),
+                                         threading.get_ident())
+        try:
+            os.makedirs(path.dirname(export_file), exist_ok=True)
+            f = open(tmp_file, 'w+b')
+        except OSError:
+            raise DataAccessError()
+        try:
+            write_columnar(f, names, types, rows, {
+                'table': table,
+                'dataVersion': version.token
+            })
+            f.flush()
+            os.replace(tmp_file, export_file)
+        except (OSError, OverflowError, DataAccessError):
+            f.close()
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise DataAccessError()
+        size = f.tell()
+        f.seek(0)
+        return SnapshotExport(f, size, version)
+
+    @staticmethod
+    def _remove_stale_exports(table: str, export_file: str):
+        export_folder = path.dirname(export_file)
+        try:
+            names = os.listdir(export_folder)
+        except OSError:
+            return
+        for name in names:
+            stale_file = path.join(export_folder, name)
+            if name.startswith(table + '-') and name.endswith(
+                    _EXPORT_SUFFIX) and stale_file != export_file:
+                try:
+                    os.remove(stale_file)
+                except OSError:
+                    # another process removed it first
+                    pass
+
+
+class TextFileMasterPasswordProvider(MasterPasswordProvider):
+    """
+    Keeps the Argon2 hash of the master password in ``password.txt``.
+
+    The hash is read once and read again only when the file changes. Hashes are verified on a dedicated pool of
+    ``workers`` threads; Argon2 releases the GIL, so other threads of the process keep serving while a hash is
+    computed. At most ``max_pending`` checks may be running at once across every process sharing the instance folder.
+    Each check holds an exclusive lock on one of ``max_pending`` slot files in ``password_checks``, which the OS
+    releases even if the process dies.
+
+    Checks never queue up behind the CPU: when every hash thread of the process or every slot is taken, the check is
+    turned away with PasswordCheckBusyError at once. The thread calling verify_pwd still waits for its own hash.
+    """
+
+    def __init__(self,
+                 instance_folder: str,
+                 workers: int = 1,
+                 max_pending: int = 4) -> None:
+        self.master_pwd_file = path.join(instance_folder, 'password.txt')
+        self.slot_folder = path.join(instance_folder, 'password_checks')
+        self.max_pending = max_pending
+        self._hasher = PasswordHasher()
+        # the hash as last read, and the modification time, size and inode of the file it was read from
+        self._hash = ''
+        self._hash_stat: Optional[Tuple[int, int, int]] = None
+        self._hash_lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._idle_workers = threading.BoundedSemaphore(workers)
+        # threads are only started on the first check, so a provider created before uWSGI forks works in every worker
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='argon2')
+
+    def _get_hash(self) -> str:
+        try:
+            stat = os.stat(self.master_pwd_file)
+        except FileNotFoundError:
+            raise NoMasterPasswordError()
+        except OSError:
+            raise DataAccessError()
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self._hash_lock:
+            if self._hash_stat != stamp:
+                try:
+                    with open(self.master_pwd_file, 'r') as f:
+                        self._hash = f.read()
+                except OSError:
+                    raise DataAccessError()
+                self._hash_stat = stamp
+            master_pwd_hash = self._hash
+        if master_pwd_hash == '':
+            raise NoMasterPasswordError()
+        return master_pwd_hash
+
+    @contextmanager
+    def _check_slot(self) -> Iterator[None]:
+        """
+        Holds one of the ``max_pending`` check slots for the duration of a ``with`` block
+
+        :raises PasswordCheckBusyError: if every slot is taken
+        """
+        if fcntl is None:
+            if not self._pending.acquire(blocking=False):
+                raise PasswordCheckBusyError()
+            try:
+                yield
+            finally:
+                self._pending.release()
+            return
+        try:
+            os.makedirs(self.slot_folder, exist_ok=True)
+        except OSError:
+            raise DataAccessError()
+        for slot in range(self.max_pending):
+            # a new descriptor for every attempt, so threads of the same process exclude each other too
+            try:
+                fd = os.open(path.join(self.slot_folder, str(slot)),
+                             os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                raise DataAccessError()
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            try:
+                yield
+            finally:
+                os.close(fd)
+            return
+        raise PasswordCheckBusyError()
+
+    def verify_pwd(self, plain_pwd: str) -> bool:
+        """
+        Checks a password against the master password, blocking the calling thread while its hash is computed
+
+        :raises PasswordCheckBusyError: if no hash thread or check slot is free to start the check right away
+        """
+        master_pwd_hash = self._get_hash()
+        # only hand the check to the executor if one of its threads can start it, so result() never waits in its queue
+        if not self._idle_workers.acquire(blocking=False):
+            raise PasswordCheckBusyError()
+        try:
+            with self._check_slot():
+                return self._executor.submit(self._verify, master_pwd_hash,
+                                             plain_pwd).result()
+        finally:
+            self._idle_workers.release()
+
+    def _verify(self, master_pwd_hash: str, plain_pwd: str) -> bool:
+        try:
+            return self._hasher.verify(master_pwd_hash, plain_pwd)
+        except (VerifyMismatchError, VerificationError, InvalidHash):
+            return False
+
+    def set_master_pwd(self, new_pwd: str):
+        try:
+            with open(self.master_pwd_file, 'w') as f:
+                f.write(self._hasher.hash(new_pwd))
+        except OSError:
+            raise DataAccessError()
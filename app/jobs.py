@@ -0,0 +1,93 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Callable, Optional
+from .models import Job, JobProvider, DataAccessError
+
+logger = logging.getLogger(__name__)
+
+
+class JobFailedError(Exception):
+    """
+    Raised by a job function to fail its job with a message for the client and an optional result
+    """
+
+    def __init__(self, message: str, result: Optional[dict] = None):
+        self.message = message
+        self.result = result
+        super().__init__(message)
+
+
+class JobProgress:
+    """
+    Passed to a running job function to report its progress. Updates are written to the job store at most once every
+    ``interval`` seconds.
+    """
+
+    def __init__(self,
+                 job_store: JobProvider,
+                 job: Job,
+                 interval: float = 1.0) -> None:
+        self._job_store = job_store
+        self._job = job
+        self._interval = interval
+        self._last_saved = monotonic()
+
+    def update(self, **counters: int):
+        self._job.progress.update(counters)
+        now = monotonic()
+        if now - self._last_saved >= self._interval:
+            self._last_saved = now
+            try:
+                self._job_store.update_job(self._job)
+            except DataAccessError:
+                # progress is informational, the job itself carries on
+                logger.warning('Could not save the progress of job %s',
+                               self._job.job_id)
+
+
+class JobRunner:
+    """
+    Runs job functions on a pool of background threads of this process and keeps their state in a job store, so any
+    worker process can report on them.
+
+    A job function receives a JobProgress and returns the job's result. If it raises, the job fails.
+    """
+
+    def __init__(self, job_store: JobProvider, max_workers: int = 1) -> None:
+        self.job_store = job_store
+        # threads are only started on the first submit, so a runner created before uWSGI forks works in every worker
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='job')
+
+    def submit(self, kind: str, func: Callable[[JobProgress],
+                                               Optional[dict]]) -> Job:
+        job = self.job_store.create_job(kind)
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def _run(self, job: Job, func: Callable[[JobProgress], Optional[dict]]):
+        job.status = Job.RUNNING
+        job.started_at = datetime.now(timezone.utc)
+        try:
+            self.job_store.update_job(job)
+            job.result = func(JobProgress(self.job_store, job))
+            job.status = Job.SUCCEEDED
+        except JobFailedError as e:
+            job.status = Job.FAILED
+            job.message = e.message
+            job.result = e.result
+        except Exception:
+            logger.exception('Job %s (%s) failed', job.job_id, job.kind)
+            job.status = Job.FAILED
+            job.message = 'The job failed unexpectedly. Contact an administrator.'
+        job.finished_at = datetime.now(timezone.utc)
+        try:
+            self.job_store.update_job(job)
+        except DataAccessError:
+            logger.exception('Could not save the outcome of job %s',
+                             job.job_id)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,647 @@
+import cProfile
+import json
+import os
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from os import path
+from time import monotonic, perf_counter, time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where the files of exited workers are kept
+    fcntl = None  # type: ignore[assignment]
+
+# phases of a request that are timed separately; time spent elsewhere is the rest of the request's latency
+PHASES = ('connect', 'execute', 'fetch', 'serialize', 'compress')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    """
+    Counts observations in buckets with fixed upper bounds, like a Prometheus histogram
+
+    :param bounds: increasing upper bounds of the buckets; larger observations are only counted in the total
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def merge(self, state: dict):
+        """
+        Adds the observations of a histogram with the same bounds, as returned by to_state
+        """
+        for i, count in enumerate(state['counts']):
+            self.counts[i] += count
+        self.count += state['count']
+        self.sum += state['sum']
+
+    def to_state(self) -> dict:
+        return {'counts': self.counts, 'count': self.count, 'sum': self.sum}
+
+
+class RequestMetrics:
+    """
+    The time spent in each phase of the request being handled, and the number of database round trips it made.
+
+    Phases may nest, for example a query run while a response is serialized. Time is only charged to the innermost
+    phase, so the phases of a request never add up to more than its latency.
+    """
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.round_trips = 0
+        # the name and start time of each phase entered and not yet exited, innermost last
+        self._stack: List[list] = []
+
+    def enter(self, name: str):
+        now = perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self.phases[outer[0]] += now - outer[1]
+        self._stack.append([name, now])
+
+    def exit(self):
+        now = perf_counter()
+        name, started = self._stack.pop()
+        self.phases[name] += now - started
+        if self._stack:
+            self._stack[-1][1] = now
+
+
+_current_request: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    'request_metrics', default=None)
+
+
+def begin_request() -> RequestMetrics:
+    """
+    Starts collecting the metrics of the request handled by the current thread
+    """
+    metrics = RequestMetrics()
+    _current_request.set(metrics)
+    return metrics
+
+
+def end_request():
+    _current_request.set(None)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Charges the time spent in a ``with`` block to a phase of the current request, if there is one
+    """
+    metrics = _current_request.get()
+    if metrics is None:
+        yield
+        return
+    metrics.enter(name)
+    try:
+        yield
+    finally:
+        metrics.exit()
+
+
+def count_round_trip():
+    metrics = _current_request.get()
+    if metrics is not None:
+        metrics.round_trips += 1
+
+
+class InstrumentedCursor:
+    """
+    Wraps a database cursor to time its statements and fetches and count its round trips
+    """
+    __slots__ = ('_cursor', )
+
+    def __init__(self, cursor) -> None:
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        count_round_trip()
+        with phase('execute'):
+            return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        count_round_trip()
+        with phase('execute'):
+            return self._cursor.executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with phase('fetch'):
+            return self._cursor.fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with phase('fetch'):
+            return self._cursor.fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with phase('fetch'):
+            return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """
+    Wraps a database connection so that its cursors and transaction statements are instrumented
+    """
+    __slots__ = ('_conn', )
+
+    def __init__(self, conn) -> None:
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs) -> InstrumentedCursor:
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+    def commit(self):
+        count_round_trip()
+        with phase('execute'):
+            self._conn.commit()
+
+    def rollback(self):
+        count_round_trip()
+        with phase('execute'):
+            self._conn.rollback()
+
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+
+
+def _label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _is_running(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    if os.name != 'posix':
+        # os.kill would end the process instead of looking it up
+        return False
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        # running, as another user
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _worker_file_key(name: str) -> Optional[Tuple[int, int]]:
+    """
+    Returns the process ID and start time in a worker's metrics file name, or None if it is not such a file
+    """
+    if not name.endswith('.json'):
+        return None
+    try:
+        pid, started = name[:-len('.json')].split('-')
+        return int(pid), int(started)
+    except ValueError:
+        return None
+
+
+def _labels(names: Sequence[str], values: Sequence[str], **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    return '{' + ','.join('{}="{}"'.format(name, _label_value(str(value)))
+                          for name, value in pairs) + '}'
+
+
+class _Totals:
+    """
+    Adds up the metrics states written by workers
+    """
+
+    def __init__(self, histograms: Dict[str, tuple],
+                 pool_counters: Iterable[str]) -> None:
+        self.histogram_specs = histograms
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {
+            name: {}
+            for name in histograms
+        }
+        self.slow_requests = 0
+        self.pool_counter_keys = tuple(pool_counters)
+        self.pool_counters: Optional[Dict[str, int]] = None
+
+    def add(self, state: dict):
+        for name, series in state['histograms'].items():
+            for labels, histogram_state in series:
+                labels = tuple(labels)
+                if labels not in self.histograms[name]:
+                    self.histograms[name][labels] = Histogram(
+                        self.histogram_specs[name][3])
+                self.histograms[name][labels].merge(histogram_state)
+        self.slow_requests += state['slow_requests']
+        pool = state.get('pool')
+        if pool is not None:
+            if self.pool_counters is None:
+                self.pool_counters = dict.fromkeys(self.pool_counter_keys, 0)
+            for key in self.pool_counter_keys:
+                self.pool_counters[key] += pool[key]
+
+    def to_state(self) -> dict:
+        state = {
+            'histograms': {
+                name: [[list(labels), histogram.to_state()]
+                       for labels, histogram in series.items()]
+                for name, series in self.histograms.items()
+            },
+            'slow_requests': self.slow_requests,
+        }
+        if self.pool_counters is not None:
+            state['pool'] = self.pool_counters
+        return state
+
+
+class MetricsRegistry:
+    """
+    Request metrics of one worker process, shared with the other workers through a folder.
+
+    Each worker writes its metrics to a file named after its process ID and start time, at most every
+    ``flush_interval`` seconds, so a worker never overwrites the file of an earlier worker that had the same process ID.
+    Collecting the metrics folds the files of workers that have exited into ``retired.json`` and adds it up with the
+    files of the running workers, so counts only ever go up, across restarts too, and the folder holds one file per
+    running worker. Without file locks, on Windows, the files of exited workers are kept instead.
+
+    :param pool_stats: returns the stats of the worker's database connection pool, see MariaDBConnectionPool.stats
+    """
+    # name, help text, label names and bucket bounds of each histogram
+    HISTOGRAMS = {
+        'requests':
+        ('mike_request_duration_seconds', 'Time spent handling requests.',
+         ('method', 'route', 'status'), LATENCY_BUCKETS),
+        'phases': ('mike_request_phase_seconds',
+                   'Time each request spent in each phase.',
+                   ('route', 'phase'), LATENCY_BUCKETS),
+        'round_trips': ('mike_request_db_round_trips',
+                        'Database round trips made by each request.',
+                        ('route', ), ROUND_TRIP_BUCKETS),
+    }
+    # name and help text of the counters and gauges taken from the connection pool stats, by their key in the stats
+    POOL_COUNTERS = {
+        'checkouts': ('mike_db_pool_checkouts_total',
+                      'Connections handed out by the connection pools.'),
+        'waits': ('mike_db_pool_waits_total',
+                  'Checkouts that had to wait for a free connection.'),
+        'timeouts': ('mike_db_pool_timeouts_total',
+                     'Checkouts that gave up waiting for a free connection.'),
+        'created': ('mike_db_pool_connections_created_total',
+                    'Database connections opened.'),
+        'discarded':
+        ('mike_db_pool_connections_discarded_total',
+         'Database connections closed because they were broken or too old.'),
+    }
+    POOL_GAUGES = {
+        'size': ('mike_db_pool_size',
+                 'Connections the pools of the running workers may open.'),
+        'in_use':
+        ('mike_db_pool_connections_in_use',
+         'Connections checked out of the pools of the running workers.'),
+        'idle':
+        ('mike_db_pool_connections_idle',
+         'Open connections waiting in the pools of the running workers.'),
+    }
+    RETIRED_FILE = 'retired.json'
+
+    def __init__(self,
+                 folder: str,
+                 flush_interval: float = 5.0,
+                 pool_stats: Optional[Callable[[], dict]] = None) -> None:
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self.pool_stats = pool_stats
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._file_name = '{}-{}.json'.format(self._pid, int(time() * 1e6))
+        self._histograms: Dict[str, Dict[Tuple[str, ...], Histogram]] = {
+            name: {}
+            for name in self.HISTOGRAMS
+        }
+        self._slow_requests = 0
+        self._flushed_at = 0.0
+        self._dirty = False
+
+    def _observe(self, histogram: str, labels: Tuple[str, ...], value: float):
+        series = self._histograms[histogram]
+        if labels not in series:
+            series[labels] = Histogram(self.HISTOGRAMS[histogram][3])
+        series[labels].observe(value)
+
+    def record(self,
+               method: str,
+               route: str,
+               status: int,
+               seconds: float,
+               request_metrics: RequestMetrics,
+               slow: bool = False):
+        """
+        Records a finished request
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked worker starts its own count
+                self._reset()
+            self._observe('requests', (method, route, str(status)), seconds)
+            for name, phase_seconds in request_metrics.phases.items():
+                self._observe('phases', (route, name), phase_seconds)
+            self._observe('round_trips', (route, ),
+                          request_metrics.round_trips)
+            if slow:
+                self._slow_requests += 1
+            self._dirty = True
+        self.flush()
+
+    def flush(self, force: bool = False):
+        """
+        Writes this worker's metrics to its file if they changed and the last write is old enough
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # the metrics of the process this one was forked from are not its own
+                self._reset()
+            now = monotonic()
+            if not self._dirty or (not force and now - self._flushed_at
+                                   < self.flush_interval):
+                return
+            state = {
+                'histograms': {
+                    name: [[list(labels), histogram.to_state()]
+                           for labels, histogram in series.items()]
+                    for name, series in self._histograms.items()
+                },
+                'slow_requests': self._slow_requests,
+            }
+            if self.pool_stats is not None:
+                state['pool'] = self.pool_stats()
+            self._flushed_at = now
+            self._dirty = False
+            # written while holding the lock, so an older state never replaces a newer one
+            self._write_state(self._file_name, state)
+
+    def _write_state(self, name: str, state: dict) -> bool:
+        """
+        :return: whether the state was written
+        """
+        metrics_file = path.join(self.folder, name)
+        tmp_file = metrics_file + '.tmp'
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, metrics_file)
+        except OSError:
+            # metrics are best effort and must never fail a request
+            return False
+        return True
+
+    def _read_state(self, name: str) -> Optional[dict]:
+        try:
+            with open(path.join(self.folder, name), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _list_files(self) -> List[str]:
+        try:
+            return os.listdir(self.folder)
+        except OSError:
+            return []
+
+    @staticmethod
+    def _exited_worker_files(names: Iterable[str]) -> List[str]:
+        """
+        Picks the files of workers that have exited: those whose process is gone, and those of a process ID that a
+        later worker has taken over
+        """
+        latest: Dict[int, int] = {}
+        keys = {}
+        for name in names:
+            key = _worker_file_key(name)
+            if key is not None:
+                keys[name] = key
+                latest[key[0]] = max(latest.get(key[0], key[1]), key[1])
+        return [
+            name for name, (pid, started) in keys.items()
+            if started != latest[pid] or not _is_running(pid)
+        ]
+
+    def _retire_exited_workers(self):
+        """
+        Folds the files of exited workers into the retired file and deletes them.
+
+        The retired file lists the files that had been taken in when it was last written, so a collection that stopped
+        before deleting them does not count them twice. Collections take turns through a lock file.
+        """
+        if fcntl is None:
+            return
+        try:
+            fd = os.open(path.join(self.folder, 'retired.lock'),
+                         os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            exited = self._exited_worker_files(self._list_files())
+            if not exited:
+                return
+            retired = self._read_state(self.RETIRED_FILE)
+            taken_in = set(retired['merged']) if retired is not None else set()
+            merged = [name for name in exited if name not in taken_in]
+            if merged:
+                totals = _Totals(self.HISTOGRAMS, self.POOL_COUNTERS)
+                if retired is not None:
+                    totals.add(retired)
+                for name in merged:
+                    state = self._read_state(name)
+                    if state is not None:
+                        totals.add(state)
+                retired = totals.to_state()
+                retired['merged'] = exited
+                if not self._write_state(self.RETIRED_FILE, retired):
+                    # the files are only deleted once their counts are kept
+                    return
+            for name in exited:
+                try:
+                    os.remove(path.join(self.folder, name))
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def collect(self) -> str:
+        """
+        Adds up the metrics of every worker
+
+        :return: the metrics in the Prometheus text exposition format
+        """
+        self.flush(force=True)
+        self._retire_exited_workers()
+        totals = _Totals(self.HISTOGRAMS, self.POOL_COUNTERS)
+        pool_gauges = dict.fromkeys(self.POOL_GAUGES, 0)
+        names = self._list_files()
+        retired = self._read_state(self.RETIRED_FILE)
+        taken_in = set()
+        if retired is not None:
+            totals.add(retired)
+            # files that were folded in but not deleted yet
+            taken_in = set(retired['merged'])
+        exited = set(self._exited_worker_files(names))
+        for name in names:
+            if _worker_file_key(name) is None or name in taken_in:
+                continue
+            state = self._read_state(name)
+            if state is None:
+                continue
+            totals.add(state)
+            pool = state.get('pool')
+            # the connections of workers that have exited are gone
+            if pool is not None and name not in exited:
+                for key in self.POOL_GAUGES:
+                    pool_gauges[key] += pool[key]
+
+        lines = []
+        for histogram, (metric, help_text, label_names,
+                        _) in self.HISTOGRAMS.items():
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} histogram'.format(metric))
+            for labels, totals_histogram in sorted(
+                    totals.histograms[histogram].items()):
+                cumulative = 0
+                for bound, count in zip(totals_histogram.bounds,
+                                        totals_histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        metric,
+                        _labels(label_names, labels, le=repr(float(bound))),
+                        cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    metric, _labels(label_names, labels, le='+Inf'),
+                    totals_histogram.count))
+                lines.append('{}_sum{} {}'.format(metric,
+                                                  _labels(label_names, labels),
+                                                  repr(totals_histogram.sum)))
+                lines.append('{}_count{} {}'.format(
+                    metric, _labels(label_names, labels),
+                    totals_histogram.count))
+        lines.append(
+            '# HELP mike_slow_requests_profiled_total Profiled requests that were slow enough to keep.'
+        )
+        lines.append('# TYPE mike_slow_requests_profiled_total counter')
+        lines.append('mike_slow_requests_profiled_total {}'.format(
+            totals.slow_requests))
+        if totals.pool_counters is not None:
+            for key, (metric, help_text) in self.POOL_COUNTERS.items():
+                lines.append('# HELP {} {}'.format(metric, help_text))
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, totals.pool_counters[key]))
+            for key, (metric, help_text) in self.POOL_GAUGES.items():
+                lines.append('# HELP {} {}'.format(metric, help_text))
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.append('{} {}'.format(metric, pool_gauges[key]))
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """
+    Profiles a random sample of requests with cProfile and keeps the profiles of the ones that turn out to be slow,
+    as files that can be opened with pstats or snakeviz.
+
+    Only one request per process is profiled at a time, as the interpreter only supports one active profiler.
+
+    :param sample_rate: fraction of requests to profile, between 0 and 1
+    :param threshold: profiles of requests faster than this many seconds are thrown away
+    :param max_files: the oldest profiles are deleted to keep at most this many
+    """
+    _active = threading.Lock()
+
+    def __init__(self,
+                 folder: str,
+                 sample_rate: float,
+                 threshold: float,
+                 max_files: int = 50) -> None:
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.max_files = max_files
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """
+        Starts profiling the current request if it is picked for the sample
+
+        :return: the running profiler, to pass to finish, or None
+        """
+        if random.random() >= self.sample_rate or not self._active.acquire(
+                blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another tool is already profiling this process
+            self._active.release()
+            return None
+        return profiler
+
+    def finish(self, profiler: cProfile.Profile, route: str,
+               seconds: float) -> bool:
+        """
+        Stops a profiler and keeps its profile if the request was slow
+
+        :return: whether the profile was kept
+        """
+        try:
+            profiler.disable()
+        finally:
+            self._active.release()
+        if seconds < self.threshold:
+            return False
+        name = '{}-{}-{}.prof'.format(
+            datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S.%f'),
+            os.getpid(),
+            route.strip('/').replace('/', '_').replace('<', '').replace(
+                '>', '') or 'root')
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            profiler.dump_stats(path.join(self.folder, name))
+            self._remove_oldest()
+        except OSError:
+            return False
+        return True
+
+    def _remove_oldest(self):
+        profiles: List[str] = sorted(name for name in os.listdir(self.folder)
+                                     if name.endswith('.prof'))
+        # names start with the time they were written, so sorting them sorts them by age
+        for name in profiles[:max(len(profiles) - self.max_files, 0)]:
+            try:
+                os.remove(path.join(self.folder, name))
+            except OSError:
+                pass
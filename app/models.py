@@ -1,4 +1,6 @@
-from typing import Iterable, Optional, Tuple
+from datetime import datetime
+from hashlib import blake2b
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence, Tuple
 from abc import ABC, abstractmethod
 
 
@@ -7,7 +9,19 @@ class InvalidRecordError(Exception):
 
 
 class MikeRecord:
+    FIELDS = ('un_region', 'subregion_name', 'subregion_id', 'country_name',
+              'country_code', 'mike_site_id', 'mike_site_name', 'year',
+              'carcasses', 'illegal_carcasses')
+    # camelCase name of each field, in the same order, as used by the API
+    JSON_KEYS = ('unRegion', 'subregionName', 'subregionId', 'countryName',
+                 'countryCode', 'mikeSiteId', 'mikeSiteName', 'year',
+                 'carcasses', 'illegalCarcasses')
+    FIELD_TYPES = (str, str, str, str, str, str, str, int, int, int)
+
+    __slots__ = FIELDS
+
     class PrimaryKey(tuple):
+
         def __new__(cls, mike_site_id: str, year: int):
             if len(mike_site_id) == 3 and year >= 0:
                 return super().__new__(cls, (mike_site_id, year))
@@ -16,10 +30,11 @@ class MikeRecord:
 
     def __init__(self, un_region: str, subregion_name: str, subregion_id: str,
                  country_name: str, country_code: str, mike_site_id: str,
-                 mike_site_name: str, year: int,
-                 carcasses: int, illegal_carcasses: int) -> None:
+                 mike_site_name: str, year: int, carcasses: int,
+                 illegal_carcasses: int) -> None:
         if len(subregion_id) == 2 and len(country_code) == 2 and len(
-                mike_site_id) == 3 and year >= 0 and carcasses >= 0 and illegal_carcasses >= 0:
+                mike_site_id
+        ) == 3 and year >= 0 and carcasses >= 0 and illegal_carcasses >= 0:
             self.un_region = un_region
             self.subregion_name = subregion_name
             self.subregion_id = subregion_id.lower()
@@ -36,26 +51,37 @@ class MikeRecord:
     def get_primary_key(self) -> PrimaryKey:
         return self.PrimaryKey(self.mike_site_id, self.year)
 
-    def to_tuple(self) -> Tuple[str, str, str, str, str, str, str, int, int, int]:
+    def to_tuple(
+            self) -> Tuple[str, str, str, str, str, str, str, int, int, int]:
         """
         Returns this object as a tuple
 
         :return: (un_region, subregion_name, subregion_id, country_name, country_code, mike_site_id, mike_site_name,
              mike_year, carcasses, illegal_carcasses)
         """
-        return (self.un_region,
-                self.subregion_name,
-                self.subregion_id,
-                self.country_name,
-                self.country_code,
-                self.mike_site_id,
-                self.mike_site_name,
-                self.year,
-                self.carcasses,
+        return (self.un_region, self.subregion_name, self.subregion_id,
+                self.country_name, self.country_code, self.mike_site_id,
+                self.mike_site_name, self.year, self.carcasses,
                 self.illegal_carcasses)
 
+    def fingerprint(self) -> str:
+        """
+        Returns a digest of every field of this record, so two records with the same fingerprint hold the same data
+
+        :return: 32 hexadecimal digits
+        """
+        return blake2b('\x1f'.join(map(str, self.to_tuple())).encode('utf-8'),
+                       digest_size=16).hexdigest()
+
+    def to_camel_dict(self) -> dict:
+        """
+        Returns this object as a dictionary keyed by the camelCase names of its fields
+        """
+        return dict(zip(self.JSON_KEYS, self.to_tuple()))
+
     @classmethod
-    def from_tuple(cls, tuple_record: Tuple[str, str, str, str, str, str, str, int, int, int]):
+    def from_tuple(cls, tuple_record: Tuple[str, str, str, str, str, str, str,
+                                            int, int, int]):
         """
         Constructs a MikeRecord from a tuple
 
@@ -63,17 +89,209 @@ class MikeRecord:
             mike_site_name, year, carcasses, illegal_carcasses)
         :return: MikeRecord
         """
-        return cls(tuple_record[0], tuple_record[1], tuple_record[2], tuple_record[3], tuple_record[4], tuple_record[5],
-                   tuple_record[6], tuple_record[7], tuple_record[8], tuple_record[9])
+        return cls(tuple_record[0], tuple_record[1], tuple_record[2],
+                   tuple_record[3], tuple_record[4], tuple_record[5],
+                   tuple_record[6], tuple_record[7], tuple_record[8],
+                   tuple_record[9])
+
+
+class MikeRecordQuery:
+    """
+    Describes a filtered, projected and optionally paginated read of MIKE records.
+
+    Records are ordered by primary key. Pages are requested by passing the primary key of the last record of the
+    previous page as ``after``.
+
+    :param fields: names of the MikeRecord attributes to return, in order; all of them if None
+    """
+    FIELDS = MikeRecord.FIELDS
+
+    def __init__(self,
+                 country_code: Optional[str] = None,
+                 subregion_id: Optional[str] = None,
+                 mike_site_id: Optional[str] = None,
+                 year_from: Optional[int] = None,
+                 year_to: Optional[int] = None,
+                 after: Optional[MikeRecord.PrimaryKey] = None,
+                 limit: Optional[int] = None,
+                 fields: Optional[Sequence[str]] = None) -> None:
+        if fields is None:
+            fields = self.FIELDS
+        if (len(fields) == 0
+                or any(field not in self.FIELDS for field in fields)
+                or (limit is not None and limit < 1)):
+            raise ValueError()
+        self.country_code = country_code.lower(
+        ) if country_code is not None else None
+        self.subregion_id = subregion_id.lower(
+        ) if subregion_id is not None else None
+        self.mike_site_id = mike_site_id.lower(
+        ) if mike_site_id is not None else None
+        self.year_from = year_from
+        self.year_to = year_to
+        self.after = after
+        self.limit = limit
+        self.fields = tuple(fields)
+
+    def cache_key(self) -> tuple:
+        """
+        A key that is the same for every query that reads the same records and fields, however it was spelled
+        """
+        return (self.country_code, self.subregion_id,
+                self.mike_site_id, self.year_from, self.year_to,
+                tuple(self.after) if self.after is not None else None,
+                self.limit, self.fields)
+
+
+class MikeRecordPage:
+    """
+    The result of a MikeRecordQuery
+
+    :param rows: tuples holding the requested fields of each record, in the order given by the query
+    :param next_key: primary key to pass as ``after`` to get the next page, or None if this is the last page
+    """
+
+    def __init__(self, rows: List[tuple],
+                 next_key: Optional[MikeRecord.PrimaryKey]) -> None:
+        self.rows = rows
+        self.next_key = next_key
+
+
+class TotalsQuery:
+    """
+    Describes a read of carcass totals per year, summed over groups of MIKE records.
+
+    :param group_by: one of GROUPINGS: records are grouped by MIKE site, country, subregion or UN region
+    """
+    GROUPINGS = ('site', 'country', 'subregion', 'region')
+
+    def __init__(self,
+                 group_by: str = 'country',
+                 country_code: Optional[str] = None,
+                 subregion_id: Optional[str] = None,
+                 mike_site_id: Optional[str] = None,
+                 year_from: Optional[int] = None,
+                 year_to: Optional[int] = None) -> None:
+        if group_by not in self.GROUPINGS:
+            raise ValueError()
+        self.group_by = group_by
+        self.country_code = country_code.lower(
+        ) if country_code is not None else None
+        self.subregion_id = subregion_id.lower(
+        ) if subregion_id is not None else None
+        self.mike_site_id = mike_site_id.lower(
+        ) if mike_site_id is not None else None
+        self.year_from = year_from
+        self.year_to = year_to
+
+
+class SyncSource:
+    """
+    What is known about the last version of an external datasheet that was synchronized into the database
+
+    :param etag: ETag header the datasheet was served with, if any
+    :param last_modified: Last-Modified header the datasheet was served with, if any
+    :param digest: SHA-256 of the datasheet's content
+    """
+
+    def __init__(self, name: str, etag: Optional[str],
+                 last_modified: Optional[str], digest: str) -> None:
+        self.name = name
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+
+
+class SyncSummary:
+    """
+    Number of records a synchronization inserted, changed, deleted and left alone
+    """
+
+    def __init__(self,
+                 inserted: int = 0,
+                 changed: int = 0,
+                 deleted: int = 0,
+                 unchanged: int = 0) -> None:
+        self.inserted = inserted
+        self.changed = changed
+        self.deleted = deleted
+        self.unchanged = unchanged
+
+
+class EditResult:
+    """
+    The outcome of a batch of edits: one status per added, changed and removed record, in the order they were given
+
+    :param applied: whether the edits were committed
+    """
+    OK = 'ok'
+    DUPLICATE = 'duplicate'
+    NOT_FOUND = 'notFound'
+    INVALID = 'invalid'
+
+    def __init__(self,
+                 added: List[str],
+                 changed: List[str],
+                 removed: List[str],
+                 applied: bool = False) -> None:
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.applied = applied
+
+    @classmethod
+    def check(cls, added: Sequence['MikeRecord'],
+              changed: Sequence['MikeRecord'],
+              removed: Sequence['MikeRecord.PrimaryKey'],
+              stored: set) -> 'EditResult':
+        """
+        Works out which edits can be applied, in order, to the stored records
+
+        :param stored: the primary keys of the edited records that are stored; it is updated to the keys stored after
+            the edits
+        """
+        result = cls([cls.OK] * len(added), [cls.OK] * len(changed),
+                     [cls.OK] * len(removed))
+        for i, record in enumerate(added):
+            if record.get_primary_key() in stored:
+                result.added[i] = cls.DUPLICATE
+            else:
+                stored.add(record.get_primary_key())
+        for i, record in enumerate(changed):
+            if record.get_primary_key() not in stored:
+                result.changed[i] = cls.NOT_FOUND
+        for i, record_key in enumerate(removed):
+            if record_key in stored:
+                stored.remove(record_key)
+            else:
+                result.removed[i] = cls.NOT_FOUND
+        return result
+
+    def failed(self) -> bool:
+        """
+        Returns whether any record could not be applied
+        """
+        return any(status != self.OK
+                   for statuses in (self.added, self.changed, self.removed)
+                   for status in statuses)
 
 
 class CountryRecord:
+    FIELDS = ('country_name', 'country_code', 'year', 'carcasses',
+              'illegal_carcasses')
+    JSON_KEYS = ('countryName', 'countryCode', 'year', 'carcasses',
+                 'illegalCarcasses')
+    FIELD_TYPES = (str, str, int, int, int)
+
+    __slots__ = FIELDS
+
     class PrimaryKey(tuple):
+
         def __new__(cls, country_code: str, year: int):
-            return super().__new__(cls.__class__, (country_code, year))
+            return super().__new__(cls, (country_code, year))
 
-    def __init__(self, country_name: str, country_code: str, year: int, carcasses: int,
-                 illegal_carcasses: int) -> None:
+    def __init__(self, country_name: str, country_code: str, year: int,
+                 carcasses: int, illegal_carcasses: int) -> None:
         self.country_name = country_name
         self.country_code = country_code
         self.year = year
@@ -83,6 +301,20 @@ class CountryRecord:
     def get_primary_key(self) -> PrimaryKey:
         return self.PrimaryKey(self.country_code, self.year)
 
+    def to_tuple(self) -> Tuple[str, str, int, int, int]:
+        """
+        Returns this object as a tuple
+
+        :return: (country_name, country_code, year, carcasses, illegal_carcasses)
+        """
+        return self.country_name, self.country_code, self.year, self.carcasses, self.illegal_carcasses
+
+    def to_camel_dict(self) -> dict:
+        """
+        Returns this object as a dictionary keyed by the camelCase names of its fields
+        """
+        return dict(zip(self.JSON_KEYS, self.to_tuple()))
+
     @classmethod
     def from_tuple(cls, tuple_record: Tuple[str, str, int, int, int]):
         """
@@ -91,22 +323,48 @@ class CountryRecord:
         :param tuple_record: (country_name, country_code, year, carcasses, illegal_carcasses)
         :return: CountryRecord
         """
-        return cls(tuple_record[0], tuple_record[1], tuple_record[2], tuple_record[3], tuple_record[4])
+        return cls(tuple_record[0], tuple_record[1], tuple_record[2],
+                   tuple_record[3], tuple_record[4])
 
 
 # Data Provider Interfaces
 
+
 class DataAccessError(Exception):
     pass
 
 
+class DataVersion:
+    """
+    Identifies one state of the stored records
+
+    :param token: opaque value that changes whenever the records change
+    :param last_modified: timezone-aware time of the change that produced this state
+    """
+
+    def __init__(self, token: str, last_modified: datetime) -> None:
+        self.token = token
+        self.last_modified = last_modified
+
+
 class NoMasterPasswordError(Exception):
     pass
 
 
+class PasswordCheckBusyError(Exception):
+    """
+    Raised when too many password checks are already under way to start another one
+    """
+    pass
+
+
 class MasterPasswordProvider(ABC):
+
     @abstractmethod
     def verify_pwd(self, plain_pwd: str) -> bool:
+        """
+        :raises PasswordCheckBusyError: if the provider is too busy to check the password now
+        """
         pass
 
     @abstractmethod
@@ -115,12 +373,14 @@ class MasterPasswordProvider(ABC):
 
 
 class InvalidPrimaryKeyOperationError(DataAccessError):
+
     def __init__(self, record: MikeRecord):
         self.record = record
         super().__init__()
 
 
 class MikeRecordProvider(ABC):
+
     @abstractmethod
     def add_mike_record(self, record: MikeRecord):
         pass
@@ -134,13 +394,33 @@ class MikeRecordProvider(ABC):
         pass
 
     @abstractmethod
-    def get_mike_record(self, record_key: MikeRecord.PrimaryKey) -> Optional[MikeRecord]:
+    def get_mike_record(
+            self, record_key: MikeRecord.PrimaryKey) -> Optional[MikeRecord]:
         pass
 
     @abstractmethod
     def get_all_mike_records(self) -> Iterable[MikeRecord]:
         pass
 
+    @abstractmethod
+    def iter_mike_records(self) -> Iterator[MikeRecord]:
+        """
+        Lazily yields every MIKE record, holding only a small batch of them in memory at a time
+        """
+        pass
+
+    @abstractmethod
+    def iter_mike_record_rows(self) -> Iterator[tuple]:
+        """
+        Like iter_mike_records, but yields each record as a tuple in the order of MikeRecord.FIELDS instead of
+        constructing MikeRecord objects
+        """
+        pass
+
+    @abstractmethod
+    def query_mike_records(self, query: MikeRecordQuery) -> MikeRecordPage:
+        pass
+
     @abstractmethod
     def update_mike_record(self, record: MikeRecord):
         pass
@@ -154,15 +434,243 @@ class MikeRecordProvider(ABC):
         pass
 
     @abstractmethod
-    def remove_mike_records(self, record_keys: Iterable[MikeRecord.PrimaryKey]):
+    def remove_mike_records(self,
+                            record_keys: Iterable[MikeRecord.PrimaryKey]):
+        pass
+
+    @abstractmethod
+    def apply_mike_record_edits(self,
+                                added: Sequence[MikeRecord],
+                                changed: Sequence[MikeRecord],
+                                removed: Sequence[MikeRecord.PrimaryKey],
+                                continue_on_error: bool = False) -> EditResult:
+        """
+        Adds, changes and removes records, in that order, in one transaction.
+
+        A record cannot be added if its primary key is taken, and cannot be changed or removed if it is not stored. If
+        any record cannot be applied, nothing is written unless ``continue_on_error`` is set, in which case every other
+        record is. Either way the result tells which records could not be applied.
+        """
+        pass
+
+    @abstractmethod
+    def sync_mike_records(self, records: Iterable[MikeRecord]) -> SyncSummary:
+        """
+        Makes the stored records match a complete datasheet, in one transaction.
+
+        Only records that are new or differ from the stored ones are written. Records imported by an earlier
+        synchronization that are missing from the datasheet are deleted. Records that never came from a synchronized
+        datasheet are kept.
+        """
+        pass
+
+    @abstractmethod
+    def get_sync_source(self, name: str) -> Optional[SyncSource]:
+        pass
+
+    @abstractmethod
+    def save_sync_source(self, source: SyncSource):
+        pass
+
+    @abstractmethod
+    def get_data_version(self) -> Optional[DataVersion]:
+        """
+        Returns the version of the stored records, which changes every time the records change
+
+        :return: the current data version, or None if this provider does not track versions
+        """
         pass
 
 
 class CountryRecordProvider(ABC):
+
     @abstractmethod
-    def get_country_record(self, record_key: CountryRecord.PrimaryKey) -> Optional[CountryRecord]:
+    def get_country_record(
+            self,
+            record_key: CountryRecord.PrimaryKey) -> Optional[CountryRecord]:
         pass
 
     @abstractmethod
     def get_all_country_records(self) -> Iterable[CountryRecord]:
         pass
+
+    @abstractmethod
+    def get_all_country_record_rows(self) -> List[tuple]:
+        """
+        Like get_all_country_records, but returns each record as a tuple in the order of CountryRecord.FIELDS
+        """
+        pass
+
+    @abstractmethod
+    def get_data_version(self) -> Optional[DataVersion]:
+        """
+        Returns the version of the stored records, which changes every time the records change
+
+        :return: the current data version, or None if this provider does not track versions
+        """
+        pass
+
+
+class AnalyticsProvider(ABC):
+
+    @abstractmethod
+    def get_yearly_totals(
+            self, query: TotalsQuery) -> List[Tuple[str, str, int, int, int]]:
+        """
+        Sums the carcasses of the records matching the query per group and year
+
+        :return: (group_id, group_name, year, carcasses, illegal_carcasses) for every group and year that has records,
+            ordered by group_id and year
+        """
+        pass
+
+    @abstractmethod
+    def get_data_version(self) -> Optional[DataVersion]:
+        pass
+
+
+class AsyncMikeRecordProvider(ABC):
+    """
+    The asyncio counterpart of the MikeRecordProvider methods that the API's routes call. Each method has the
+    semantics of its MikeRecordProvider namesake.
+    """
+
+    @abstractmethod
+    async def get_all_mike_record_rows(self) -> List[tuple]:
+        """
+        Returns every MIKE record as a tuple in the order of MikeRecord.FIELDS
+        """
+        pass
+
+    @abstractmethod
+    async def query_mike_records(self,
+                                 query: MikeRecordQuery) -> MikeRecordPage:
+        pass
+
+    @abstractmethod
+    async def add_or_overwrite_mike_records(self,
+                                            records: Iterable[MikeRecord]):
+        """
+        ``records`` may block while it is iterated, as a datasheet being parsed does, so it must be iterated off the
+        event loop
+        """
+        pass
+
+    @abstractmethod
+    async def apply_mike_record_edits(
+            self,
+            added: Sequence[MikeRecord],
+            changed: Sequence[MikeRecord],
+            removed: Sequence[MikeRecord.PrimaryKey],
+            continue_on_error: bool = False) -> EditResult:
+        pass
+
+    @abstractmethod
+    async def get_data_version(self) -> Optional[DataVersion]:
+        pass
+
+
+class AsyncCountryRecordProvider(ABC):
+
+    @abstractmethod
+    async def get_all_country_record_rows(self) -> List[tuple]:
+        pass
+
+    @abstractmethod
+    async def get_data_version(self) -> Optional[DataVersion]:
+        pass
+
+
+class AsyncAnalyticsProvider(ABC):
+
+    @abstractmethod
+    async def get_yearly_totals(
+            self, query: TotalsQuery) -> List[Tuple[str, str, int, int, int]]:
+        pass
+
+    @abstractmethod
+    async def get_data_version(self) -> Optional[DataVersion]:
+        pass
+
+
+class Job:
+    """
+    A long running task, such as an import of the MIKE records, that is carried out in the background
+
+    :param progress: counters reported while the job runs
+    :param result: summary reported by the job when it finishes
+    :param message: explanation of why the job failed, if it did
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self,
+                 job_id: str,
+                 kind: str,
+                 status: str,
+                 created_at: datetime,
+                 started_at: Optional[datetime] = None,
+                 finished_at: Optional[datetime] = None,
+                 progress: Optional[dict] = None,
+                 result: Optional[dict] = None,
+                 message: Optional[str] = None) -> None:
+        self.job_id = job_id
+        self.kind = kind
+        self.status = status
+        self.created_at = created_at
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.progress = progress if progress is not None else {}
+        self.result = result
+        self.message = message
+
+
+class JobProvider(ABC):
+
+    @abstractmethod
+    def create_job(self, kind: str) -> Job:
+        """
+        Stores a new job in the queued state
+        """
+        pass
+
+    @abstractmethod
+    def update_job(self, job: Job):
+        pass
+
+    @abstractmethod
+    def get_job(self, job_id: str) -> Optional[Job]:
+        pass
+
+
+class SnapshotExport:
+    """
+    An open file holding every record of a table, as of one data version, in the layout written by
+    app.columnar.write_columnar
+
+    :param file: the export, opened for binary reading; the caller closes it
+    :param size: length of the file in bytes
+    """
+
+    def __init__(self, file: BinaryIO, size: int,
+                 version: DataVersion) -> None:
+        self.file = file
+        self.size = size
+        self.version = version
+
+
+class SnapshotExportProvider(ABC):
+    MIKE_RECORDS = 'mikerecords'
+    COUNTRY_RECORDS = 'countryrecords'
+    TABLES = (MIKE_RECORDS, COUNTRY_RECORDS)
+
+    @abstractmethod
+    def get_snapshot_export(self, table: str) -> SnapshotExport:
+        """
+        Returns the export of a table at the current data version, producing it first if nobody has yet
+
+        :param table: one of TABLES
+        """
+        pass
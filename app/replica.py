@@ -0,0 +1,299 @@
+import threading
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from .models import MikeRecord, CountryRecord, MikeRecordProvider, CountryRecordProvider, MikeRecordQuery, \
+    MikeRecordPage, DataVersion, SyncSource, SyncSummary, AnalyticsProvider, TotalsQuery, EditResult, DataAccessError
+
+_FIELD_INDEX = {field: i for i, field in enumerate(MikeRecord.FIELDS)}
+_COUNTRY_CODE = _FIELD_INDEX['country_code']
+_COUNTRY_NAME = _FIELD_INDEX['country_name']
+_SUBREGION_ID = _FIELD_INDEX['subregion_id']
+_SITE_ID = _FIELD_INDEX['mike_site_id']
+_YEAR = _FIELD_INDEX['year']
+_CARCASSES = _FIELD_INDEX['carcasses']
+_ILLEGAL_CARCASSES = _FIELD_INDEX['illegal_carcasses']
+# TotalsQuery grouping -> positions of the id and the name of a group in a row
+_GROUPING_INDEXES = {
+    'site': (_SITE_ID, _FIELD_INDEX['mike_site_name']),
+    'country': (_COUNTRY_CODE, _COUNTRY_NAME),
+    'subregion': (_SUBREGION_ID, _FIELD_INDEX['subregion_name']),
+    'region': (_FIELD_INDEX['un_region'], _FIELD_INDEX['un_region']),
+}
+
+
+def _primary_key(row: tuple) -> MikeRecord.PrimaryKey:
+    return MikeRecord.PrimaryKey(row[_SITE_ID], row[_YEAR])
+
+
+def _projection(fields) -> Callable[[tuple], tuple]:
+    if len(fields) == 1:
+        # itemgetter returns the bare value when given a single index
+        index = _FIELD_INDEX[fields[0]]
+        return lambda row: (row[index], )
+    return itemgetter(*(_FIELD_INDEX[field] for field in fields))
+
+
+class _Snapshot:
+    """
+    Every MIKE record at one data version, indexed for the reads the API serves, with the country totals derived
+    from them. A snapshot is never modified once built, so readers use it without locking.
+    """
+
+    def __init__(self, version: DataVersion, rows: Iterable[tuple]) -> None:
+        self.version = version
+        # positions in this list are what the secondary indexes hold, so filtering an index keeps primary key order
+        self.rows = sorted(rows, key=lambda row: (row[_SITE_ID], row[_YEAR]))
+        self.keys = [
+            MikeRecord.PrimaryKey(row[_SITE_ID], row[_YEAR])
+            for row in self.rows
+        ]
+        self.by_key = dict(zip(self.keys, self.rows))
+        self.by_country = self._index(_COUNTRY_CODE)
+        self.by_subregion = self._index(_SUBREGION_ID)
+        self.by_year = self._index(_YEAR)
+
+        # the name, carcasses and illegal carcasses of each country and year
+        totals: Dict[CountryRecord.PrimaryKey, list] = {}
+        for row in self.rows:
+            key = CountryRecord.PrimaryKey(row[_COUNTRY_CODE], row[_YEAR])
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [
+                    row[_COUNTRY_NAME], row[_CARCASSES],
+                    row[_ILLEGAL_CARCASSES]
+                ]
+            else:
+                # the same choice of name as country_year_totals
+                total[0] = max(total[0], row[_COUNTRY_NAME])
+                total[1] += row[_CARCASSES]
+                total[2] += row[_ILLEGAL_CARCASSES]
+        self.country_rows = [
+            (name, key[0], key[1], carcasses, illegal_carcasses)
+            for key, (name, carcasses,
+                      illegal_carcasses) in sorted(totals.items())
+        ]
+        self.countries_by_key = {
+            CountryRecord.PrimaryKey(row[1], row[2]): row
+            for row in self.country_rows
+        }
+
+    def _index(self, column: int) -> Dict[Any, List[int]]:
+        index: Dict[Any, List[int]] = {}
+        for position, row in enumerate(self.rows):
+            index.setdefault(row[column], []).append(position)
+        return index
+
+    def positions(self, query: MikeRecordQuery) -> Sequence[int]:
+        """
+        Returns the positions of the rows matching the query's filters, in primary key order
+        """
+        candidates = []
+        if query.country_code is not None:
+            candidates.append(self.by_country.get(query.country_code, []))
+        if query.subregion_id is not None:
+            candidates.append(self.by_subregion.get(query.subregion_id, []))
+        start, end = 0, len(self.rows)
+        if query.mike_site_id is not None:
+            # records of a site are contiguous in primary key order
+            start = bisect_left(self.keys, (query.mike_site_id, ))
+            end = bisect_left(self.keys, (query.mike_site_id + '\0', ))
+        if query.after is not None:
+            start = max(start, bisect_right(self.keys, query.after))
+        if (query.year_from is not None
+                or query.year_to is not None) and not candidates:
+            years = [
+                positions for year, positions in self.by_year.items()
+                if (query.year_from is None or year >= query.year_from) and (
+                    query.year_to is None or year <= query.year_to)
+            ]
+            candidates.append(
+                sorted(position for positions in years
+                       for position in positions))
+        if not candidates:
+            return range(start, end)
+        # scans the smallest index and checks the other filters on each row
+        positions = min(candidates, key=len)
+        positions = positions[bisect_left(positions, start
+                                          ):bisect_left(positions, end)]
+        rows = self.rows
+        return [
+            position for position in positions
+            if self._matches(rows[position], query)
+        ]
+
+    @staticmethod
+    def _matches(row: tuple, query: MikeRecordQuery) -> bool:
+        return ((query.country_code is None
+                 or row[_COUNTRY_CODE] == query.country_code)
+                and (query.subregion_id is None
+                     or row[_SUBREGION_ID] == query.subregion_id)
+                and (query.year_from is None or row[_YEAR] >= query.year_from)
+                and (query.year_to is None or row[_YEAR] <= query.year_to))
+
+
+class ReplicatedRecordProvider(MikeRecordProvider, CountryRecordProvider,
+                               AnalyticsProvider):
+    """
+    Serves reads of MIKE and country records from an in-memory copy of a store's MIKE records and passes writes
+    through to it. Country records are totalled from the copy.
+
+    Before every read the copy is compared with the store's data version, which every worker process shares, and the
+    whole copy is reloaded if it is out of date. Reads of a current copy never reach the database. The data version
+    reported is the one of the copy the reads are served from, so responses cached by version stay consistent.
+
+    :param store: the provider that holds the records, which must track data versions
+    :raises ValueError: if the store does not track data versions
+    """
+
+    def __init__(self, store: MikeRecordProvider) -> None:
+        if store.get_data_version() is None:
+            raise ValueError()
+        self._store = store
+        self._snapshot: Optional[_Snapshot] = None
+        self._load_lock = threading.Lock()
+
+    def _current(self) -> _Snapshot:
+        version = self._store.get_data_version()
+        if version is None:
+            # without a version there is no telling whether a copy is current
+            raise DataAccessError()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version.token == version.token:
+            return snapshot
+        with self._load_lock:
+            # another thread may have loaded it while this one waited
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version.token != version.token:
+                # the version is read before the rows, so a write landing in between only causes another reload
+                snapshot = _Snapshot(version,
+                                     self._store.iter_mike_record_rows())
+                self._snapshot = snapshot
+            return snapshot
+
+    def get_data_version(self) -> Optional[DataVersion]:
+        return self._current().version
+
+    # Implements MikeRecordProvider
+
+    def add_mike_record(self, record: MikeRecord):
+        self._store.add_mike_record(record)
+
+    def add_mike_records(self, records: Iterable[MikeRecord]):
+        self._store.add_mike_records(records)
+
+    def add_or_overwrite_mike_records(self, records: Iterable[MikeRecord]):
+        self._store.add_or_overwrite_mike_records(records)
+
+    def get_mike_record(
+            self, record_key: MikeRecord.PrimaryKey) -> Optional[MikeRecord]:
+        row = self._current().by_key.get(record_key)
+        return MikeRecord.from_tuple(row) if row is not None else None
+
+    def get_all_mike_records(self) -> Iterable[MikeRecord]:
+        return list(map(MikeRecord.from_tuple, self._current().rows))
+
+    def iter_mike_records(self) -> Iterator[MikeRecord]:
+        return map(MikeRecord.from_tuple, self._current().rows)
+
+    def iter_mike_record_rows(self) -> Iterator[tuple]:
+        return iter(self._current().rows)
+
+    def query_mike_records(self, query: MikeRecordQuery) -> MikeRecordPage:
+        snapshot = self._current()
+        positions = snapshot.positions(query)
+        if query.limit is not None:
+            # one extra row tells whether there is another page
+            positions = positions[:query.limit + 1]
+        rows = [snapshot.rows[position] for position in positions]
+        next_key = None
+        if query.limit is not None and len(rows) > query.limit:
+            rows = rows[:query.limit]
+            next_key = _primary_key(rows[-1])
+        return MikeRecordPage(list(map(_projection(query.fields), rows)),
+                              next_key)
+
+    def update_mike_record(self, record: MikeRecord):
+        self._store.update_mike_record(record)
+
+    def update_mike_records(self, records: Iterable[MikeRecord]):
+        self._store.update_mike_records(records)
+
+    def remove_mike_record(self, record_key: MikeRecord.PrimaryKey):
+        self._store.remove_mike_record(record_key)
+
+    def remove_mike_records(self,
+                            record_keys: Iterable[MikeRecord.PrimaryKey]):
+        self._store.remove_mike_records(record_keys)
+
+    def apply_mike_record_edits(self,
+                                added: Sequence[MikeRecord],
+                                changed: Sequence[MikeRecord],
+                                removed: Sequence[MikeRecord.PrimaryKey],
+                                continue_on_error: bool = False) -> EditResult:
+        return self._store.apply_mike_record_edits(added, changed, removed,
+                                                   continue_on_error)
+
+    def sync_mike_records(self, records: Iterable[MikeRecord]) -> SyncSummary:
+        return self._store.sync_mike_records(records)
+
+    def get_sync_source(self, name: str) -> Optional[SyncSource]:
+        return self._store.get_sync_source(name)
+
+    def save_sync_source(self, source: SyncSource):
+        self._store.save_sync_source(source)
+
+    # Implements CountryRecordProvider
+
+    def get_country_record(
+            self,
+            record_key: CountryRecord.PrimaryKey) -> Optional[CountryRecord]:
+        row = self._current().countries_by_key.get(record_key)
+        return CountryRecord.from_tuple(row) if row is not None else None
+
+    def get_all_country_records(self) -> Iterable[CountryRecord]:
+        return list(map(CountryRecord.from_tuple,
+                        self._current().country_rows))
+
+    def get_all_country_record_rows(self) -> List[tuple]:
+        return self._current().country_rows
+
+    # Implements AnalyticsProvider
+
+    def get_yearly_totals(self, query: TotalsQuery) -> List[tuple]:
+        snapshot = self._current()
+        if query.group_by == 'country' and query.subregion_id is None and query.mike_site_id is None:
+            # already summed per country and year
+            return [
+                (code, name, year, carcasses, illegal_carcasses)
+                for name, code, year, carcasses, illegal_carcasses in
+                snapshot.country_rows
+                if (query.country_code is None or code == query.country_code)
+                and (query.year_from is None or year >= query.year_from) and (
+                    query.year_to is None or year <= query.year_to)
+            ]
+        positions = snapshot.positions(
+            MikeRecordQuery(country_code=query.country_code,
+                            subregion_id=query.subregion_id,
+                            mike_site_id=query.mike_site_id,
+                            year_from=query.year_from,
+                            year_to=query.year_to))
+        group_id, group_name = _GROUPING_INDEXES[query.group_by]
+        # the name, carcasses and illegal carcasses of each group and year
+        totals: Dict[tuple, list] = {}
+        for position in positions:
+            row = snapshot.rows[position]
+            key = (row[group_id], row[_YEAR])
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [
+                    row[group_name], row[_CARCASSES], row[_ILLEGAL_CARCASSES]
+                ]
+            else:
+                total[0] = max(total[0], row[group_name])
+                total[1] += row[_CARCASSES]
+                total[2] += row[_ILLEGAL_CARCASSES]
+        return [(key[0], name, key[1], carcasses, illegal_carcasses)
+                for key, (name, carcasses,
+                          illegal_carcasses) in sorted(totals.items())]
@@ -1,15 +1,41 @@
-from typing import Iterable, Optional
-from app.models import MikeRecord, MikeRecordProvider, CountryRecordProvider, InvalidRecordError, \
-    InvalidPrimaryKeyOperationError
-from flask import Flask, Request, request, jsonify, Blueprint
-from .auth import AuthProvider
+from typing import IO, Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Tuple, TypeVar, Union
+from datetime import datetime
+from app.models import MikeRecord, CountryRecord, MikeRecordProvider, CountryRecordProvider, InvalidRecordError, \
+    DataVersion, MikeRecordQuery, MikeRecordPage, Job, JobProvider, SyncSource, \
+    PasswordCheckBusyError, SnapshotExportProvider, AnalyticsProvider, TotalsQuery, EditResult
+from flask import Flask, Request, Response, request, jsonify, json, Blueprint, stream_with_context, url_for, \
+    send_file, g
+from werkzeug.sansio.request import Request as BaseRequest
+from werkzeug.sansio.response import Response as BaseResponse
+from .analytics import trend_series
+from .auth import AuthProvider, SharedLoginRateLimiter
+from .cache import ResponseCache
+from .columnar import MIME_TYPE as COLUMNAR_MIME_TYPE
+from .compression import CONTENT_ENCODINGS, ResponseCompressor
+from .datasheet import InvalidDatasheetError, ColumnarMikeCsvReader
+from .serialization import MIKE_RECORD_ENCODER, COUNTRY_RECORD_ENCODER, mike_projection_encoder, \
+    encode_compact_mike_rows
+from .jobs import JobRunner, JobProgress, JobFailedError
+from .metrics import MetricsRegistry, SlowRequestProfiler, begin_request, end_request, phase
 import requests
+import codecs
 import csv
-from stringcase import camelcase
+import hashlib
+import tempfile
+from os import path
+from time import perf_counter
 
 MIKE_CSV_ID = '1z-fPcdTbZ97QSGEkwthPvs1KInGeu4j6'
 GOOGLE_DRIVE_URL = 'https://drive.google.com/u/0/uc'
+MIKE_CSV_URL = GOOGLE_DRIVE_URL + '?id=' + MIKE_CSV_ID + '&export=download'
+MIKE_SYNC_SOURCE = 'mike'
 VALID_COUNTRY_CODES = {'ga', 'cd', 'cg', 'cm', 'cf', 'ci', 'lr', 'gh', 'td'}
+MIKE_QUERY_PARAMS = {
+    'countryCode', 'subregionId', 'mikeSiteId', 'yearFrom', 'yearTo', 'after',
+    'limit', 'fields'
+}
+MAX_TREND_WINDOW = 50
+CAMEL_TO_MIKE_FIELD = dict(zip(MikeRecord.JSON_KEYS, MikeRecord.FIELDS))
 
 
 def has_csv(req: Request, file_field_name: str) -> bool:
@@ -22,58 +48,462 @@ def has_csv(req: Request, file_field_name: str) -> bool:
         return False
 
 
-def parse_mike_csv(csv_lines: Iterable[str]) -> Optional[Iterable[MikeRecord]]:
-    reader = csv.DictReader(csv_lines)
+def obj_to_camel_dict(obj: Union[MikeRecord, CountryRecord]) -> dict:
+    return obj.to_camel_dict()
+
+
+def parse_mike_record_query(args: Mapping[str, str],
+                            max_limit: int) -> MikeRecordQuery:
+    """
+    Builds a MikeRecordQuery from the query string of a /mikerecords request
+
+    :raises ValueError, InvalidRecordError: if a parameter is malformed
+    """
+    after = None
+    if 'after' in args:
+        [mike_site_id, year] = args['after'].split(':')
+        after = MikeRecord.PrimaryKey(mike_site_id, int(year))
+    limit = None
+    if 'limit' in args:
+        limit = int(args['limit'])
+        if limit > max_limit:
+            raise ValueError()
+    fields = None
+    if 'fields' in args:
+        fields = [CAMEL_TO_MIKE_FIELD[x] for x in args['fields'].split(',')]
+    return MikeRecordQuery(
+        country_code=args.get('countryCode'),
+        subregion_id=args.get('subregionId'),
+        mike_site_id=args.get('mikeSiteId'),
+        year_from=int(args['yearFrom']) if 'yearFrom' in args else None,
+        year_to=int(args['yearTo']) if 'yearTo' in args else None,
+        after=after,
+        limit=limit,
+        fields=fields)
+
+
+def parse_trend_query(
+        args: Mapping[str, str]) -> Tuple[TotalsQuery, int, Optional[int]]:
+    """
+    Builds the TotalsQuery of an /analytics/trends request. The query starts early enough to fill the rolling window
+    of the first year asked for.
+
+    :return: the query, the rolling window size and the first year asked for
+
+    :raises ValueError: if a parameter is malformed
+    """
+    window = int(args.get('window', 1))
+    if window < 1 or window > MAX_TREND_WINDOW:
+        raise ValueError()
+    year_from = int(args['yearFrom']) if 'yearFrom' in args else None
+    query = TotalsQuery(
+        group_by=args.get('groupBy', 'country'),
+        country_code=args.get('countryCode'),
+        subregion_id=args.get('subregionId'),
+        mike_site_id=args.get('mikeSiteId'),
+        year_from=year_from - window + 1 if year_from is not None else None,
+        year_to=int(args['yearTo']) if 'yearTo' in args else None)
+    return query, window, year_from
+
+
+def mike_page_to_json(query: MikeRecordQuery,
+                      page: MikeRecordPage,
+                      compact: bool = False) -> str:
+    next_key = ',"next":' + json.dumps('{}:{}'.format(
+        *page.next_key) if page.next_key else None)
+    if compact:
+        return encode_compact_mike_rows(
+            page.rows, next_key if query.limit is not None else '')
+    records = mike_projection_encoder(query.fields).encode_rows(page.rows)
+    if query.limit is None:
+        return records
+    return '{"records":' + records + next_key + '}'
+
+
+def is_compact_request(args: Mapping[str, str]) -> bool:
+    """
+    Whether a /mikerecords request asks for the compact format
+
+    :raises ValueError: if the format is unknown, or compact records are asked for with only some fields
+    """
+    response_format = args.get('format', 'json')
+    if response_format not in ('json', 'compact'):
+        raise ValueError()
+    if response_format == 'compact' and 'fields' in args:
+        raise ValueError()
+    return response_format == 'compact'
+
+
+def download_mike_csv(
+        url: str,
+        previous: Optional[SyncSource],
+        timeout: float = 30) -> Optional[Tuple[IO[bytes], SyncSource]]:
+    """
+    Downloads the MIKE datasheet at ``url`` into a temporary file, hashing it on the way. The validators of the
+    previous download are sent along, so an unchanged datasheet is not downloaded again. A ``file://`` URL reads a
+    local file instead, which stands in for the MIKE database in development and testing.
+
+    :return: None if the server reports the datasheet is unchanged, otherwise the file, rewound, and a SyncSource
+        describing it
+    :raises requests.RequestException: if the datasheet could not be downloaded
+    """
+    digest = hashlib.sha256()
+    # kept in memory up to 8 MiB, then moved to disk
+    file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    etag = last_modified = None
+    if url.startswith('file://'):
+        with open(url[len('file://'):], 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(block)
+                file.write(block)
+    else:
+        headers = {}
+        if previous is not None and previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous is not None and previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+        with requests.get(url, headers=headers, stream=True,
+                          timeout=timeout) as res:
+            if res.status_code == 304:
+                file.close()
+                return None
+            res.raise_for_status()
+            for block in res.iter_content(64 * 1024):
+                digest.update(block)
+                file.write(block)
+            etag = res.headers.get('ETag')
+            last_modified = res.headers.get('Last-Modified')
+    file.seek(0)
+    return file, SyncSource(MIKE_SYNC_SOURCE, etag, last_modified,
+                            digest.hexdigest())
+
+
+def sync_records_from_mike(mike_store: MikeRecordProvider, url: str,
+                           force: bool, progress: JobProgress) -> dict:
+    """
+    Job function that brings the records in line with the MIKE datasheet at ``url``, writing only the records that
+    were inserted, changed or deleted since the last synchronization. Nothing is written when the datasheet is
+    unchanged, unless ``force`` is set.
+    """
+    previous = None if force else mike_store.get_sync_source(MIKE_SYNC_SOURCE)
     try:
-        return [
-            MikeRecord(row['UNRegion'], row['SubregionName'],
-                       row['SubregionID'], row['CountryName'],
-                       row['CountryCode'], row['MIKEsiteID'],
-                       row['MIKEsiteName'], int(row['year']),
-                       int(row['TotalNumberOfCarcasses']),
-                       int(row['NumberOfIllegalCarcasses'])) for row in reader
-        ]
-
-    except (ValueError, KeyError, csv.Error, InvalidRecordError):
-        return None
+        download = download_mike_csv(url, previous)
+    except requests.RequestException:
+        raise JobFailedError(
+            'Could not download the MIKE Records. Try again later.')
+    if download is None:
+        return {'sourceChanged': False}
+    file, source = download
+    with file:
+        if previous is not None and previous.digest == source.digest:
+            # keep the newest validators for the next conditional download
+            mike_store.save_sync_source(source)
+            return {'sourceChanged': False}
+        reader = ColumnarMikeCsvReader(codecs.iterdecode(file, 'utf-8'),
+                                       VALID_COUNTRY_CODES)
+
+        def report_progress(records: Iterable[MikeRecord]):
+            for record in records:
+                yield record
+                progress.update(rowsRead=reader.rows_read,
+                                recordsRead=reader.records_read)
 
+        try:
+            summary = mike_store.sync_mike_records(report_progress(reader))
+        except (InvalidDatasheetError, csv.Error, UnicodeDecodeError):
+            raise JobFailedError(
+                'MIKE Records in invalid format. Contact an administrator.', {
+                    'errorCount': reader.error_count,
+                    'errors': reader.errors
+                })
+    mike_store.save_sync_source(source)
+    progress.update(rowsRead=reader.rows_read, recordsRead=reader.records_read)
+    return {
+        'sourceChanged': True,
+        'rowsRead': reader.rows_read,
+        'recordsSkipped': reader.records_skipped,
+        'inserted': summary.inserted,
+        'changed': summary.changed,
+        'deleted': summary.deleted,
+        'unchanged': summary.unchanged
+    }
 
-def obj_to_camel_dict(obj: object) -> dict:
-    return {camelcase(key): val for key, val in obj.__dict__.items()}
+
+def job_to_json(job: Job) -> dict:
+
+    def to_iso(time: Optional[datetime]) -> Optional[str]:
+        return time.isoformat() if time is not None else None
+
+    duration = None
+    if job.started_at is not None:
+        duration = ((job.finished_at or datetime.now(job.started_at.tzinfo)) -
+                    job.started_at).total_seconds()
+    return {
+        'id': job.job_id,
+        'kind': job.kind,
+        'status': job.status,
+        'createdAt': to_iso(job.created_at),
+        'startedAt': to_iso(job.started_at),
+        'finishedAt': to_iso(job.finished_at),
+        'durationSeconds': duration,
+        'progress': job.progress,
+        'result': job.result,
+        'message': job.message
+    }
 
 
 def json_dict_to_mike(json_dict: dict) -> MikeRecord:
-    return MikeRecord(json_dict['unRegion'], json_dict['subregionName'],
-                      json_dict['subregionId'], json_dict['countryName'],
-                      json_dict['countryCode'], json_dict['mikeSiteId'],
-                      json_dict['mikeSiteName'], json_dict['year'],
-                      json_dict['carcasses'], json_dict['illegalCarcasses'])
+    values = [json_dict[key] for key in MikeRecord.JSON_KEYS]
+    # the JSON encoders format each column by its type, so a float, bool or null must not reach the database
+    if any(
+            type(value) is not t
+            for value, t in zip(values, MikeRecord.FIELD_TYPES)):
+        raise InvalidRecordError()
+    return MikeRecord(*values)
+
+
+def json_dict_to_mike_key(json_dict: dict) -> MikeRecord.PrimaryKey:
+    if type(json_dict['year']) is not int:
+        raise InvalidRecordError()
+    return MikeRecord.PrimaryKey(json_dict['mikeSiteId'].lower(),
+                                 json_dict['year'])
+
+
+def parse_edit_list(items: list,
+                    parse: Callable[[dict], object]) -> Tuple[list, List[int]]:
+    """
+    Parses one of the lists of records of an /admin/edit request
+
+    :return: the parsed records and the positions of the items that could not be parsed
+    :raises TypeError: if items is not a list
+    """
+    if not isinstance(items, list):
+        raise TypeError()
+    parsed = []
+    invalid = []
+    for i, item in enumerate(items):
+        try:
+            parsed.append(parse(item))
+        except (ValueError, KeyError, TypeError, AttributeError,
+                InvalidRecordError):
+            invalid.append(i)
+    return parsed, invalid
+
+
+def with_invalid_statuses(statuses: List[str],
+                          invalid: List[int]) -> List[str]:
+    """
+    Inserts the status of the records that could not be parsed back at their positions in the request
+    """
+    statuses = list(statuses)
+    for i in invalid:
+        statuses.insert(i, EditResult.INVALID)
+    return statuses
+
+
+class EditRequest:
+    """
+    The parsed body of an /admin/edit request
+
+    :raises TypeError: if the body is not an object or one of its lists is not a list
+    """
+
+    def __init__(self, data: object) -> None:
+        if not isinstance(data, dict):
+            raise TypeError()
+        self.continue_on_error = data.get('continueOnError', False) is True
+        self.added, self.invalid_added = parse_edit_list(
+            data.get('added', []), json_dict_to_mike)
+        self.changed, self.invalid_changed = parse_edit_list(
+            data.get('changed', []), json_dict_to_mike)
+        self.removed, self.invalid_removed = parse_edit_list(
+            data.get('removed', []), json_dict_to_mike_key)
+
+    def has_invalid(self) -> bool:
+        return bool(self.invalid_added or self.invalid_changed
+                    or self.invalid_removed)
+
+    def result_to_json(self, result: EditResult) -> Tuple[dict, int]:
+        """
+        :return: the response body reporting the result of the edits and its status code
+        """
+        body: Dict[str, object] = {
+            'added': with_invalid_statuses(result.added, self.invalid_added),
+            'changed': with_invalid_statuses(result.changed,
+                                             self.invalid_changed),
+            'removed': with_invalid_statuses(result.removed,
+                                             self.invalid_removed)
+        }
+        if result.applied:
+            if result.failed() or self.has_invalid():
+                body['message'] = ('Database has been updated. '
+                                   'Some records were skipped.')
+            else:
+                body['message'] = 'Database has been updated.'
+            return body, 200
+        if EditResult.DUPLICATE in result.added:
+            body['message'] = ('Attempted to add a record whose primary key '
+                               'is already in the database.')
+            body['problemRecord'] = obj_to_camel_dict(
+                self.added[result.added.index(EditResult.DUPLICATE)])
+        else:
+            body['message'] = ('Attempted to change or remove a record that '
+                               'is not in the database.')
+        return body, 400
+
+
+# the header helpers are shared with the Quart app, so they take the werkzeug bases of both apps' requests and
+# responses
+_Response = TypeVar('_Response', bound=BaseResponse)
+
+
+def version_etag(version: DataVersion, encoding: Optional[str] = None) -> str:
+    """
+    The ETag of a body built from ``version``, which differs for each content encoding of the body
+    """
+    return version.token if encoding is None else '{}-{}'.format(
+        version.token, encoding)
+
+
+def is_not_modified(req: BaseRequest, version: DataVersion) -> bool:
+    if req.if_none_match:
+        return any(
+            req.if_none_match.contains_weak(version_etag(version, encoding))
+            for encoding in (None, ) + CONTENT_ENCODINGS)
+    if req.if_modified_since:
+        return version.last_modified.replace(
+            microsecond=0) <= req.if_modified_since
+    return False
+
+
+def set_version_headers(res: _Response,
+                        version: DataVersion,
+                        encoding: Optional[str] = None) -> _Response:
+    res.set_etag(version_etag(version, encoding))
+    res.last_modified = version.last_modified
+    # clients may keep the body but must revalidate it before every use
+    res.cache_control.no_cache = True
+    return res
+
+
+def set_encoding_headers(res: _Response, encoding: Optional[str]) -> _Response:
+    if encoding is not None:
+        res.content_encoding = encoding
+    # shared caches must keep a copy per encoding
+    res.vary.add('Accept-Encoding')
+    return res
+
+
+def cached_json_response(
+        req: Request,
+        cache: Optional[ResponseCache],
+        key: Hashable,
+        version: Optional[DataVersion],
+        build: Callable[[], str],
+        compressor: Optional[ResponseCompressor] = None) -> Response:
+    """
+    Serves a JSON body from the cache when it was built from the current data version, otherwise builds and caches
+    it. ``build`` returns the serialized body. Conditional requests for the current version are answered with 304 Not
+    Modified without building anything.
+
+    With a ``compressor``, the body is sent in the encoding the client accepts best, unless it is shorter than the
+    compressor's ``min_size``. Each encoding is compressed once per data version and cached along with the body.
+
+    The version must be read before the data is, so a write that lands in between leaves the entry tagged with the
+    older version and it is rebuilt on the next request.
+
+    Without a ``cache`` the body is built for every request that is not answered with 304, and sent as it is.
+    """
+    if version is None:
+        with phase('serialize'):
+            return Response(build(), mimetype='application/json')
+    if cache is None:
+        compressor = None
+    encoding = compressor.negotiate(
+        req.accept_encodings) if compressor is not None else None
+    if is_not_modified(req, version):
+        if cache is not None and compressor is not None and encoding is not None:
+            # the tag names the encoding a 200 would have been sent in
+            body = cache.get(key, version.token)
+            if body is not None:
+                encoding = compressor.negotiate(req.accept_encodings,
+                                                size=len(body))
+        res = set_version_headers(Response(status=304), version, encoding)
+        return set_encoding_headers(
+            res, encoding) if compressor is not None else res
+    if cache is None:
+        with phase('serialize'):
+            return set_version_headers(
+                Response(build(), mimetype='application/json'), version)
+    payload = cache.get(key, version.token, encoding)
+    if payload is None:
+        body = cache.get(key, version.token) if encoding is not None else None
+        if body is None:
+            with phase('serialize'):
+                body = build().encode('utf-8')
+            cache.put(key, version.token, body)
+        if compressor is not None and encoding is not None:
+            # small bodies are sent as they are
+            encoding = compressor.negotiate(req.accept_encodings,
+                                            size=len(body))
+        payload = body
+        if compressor is not None and encoding is not None:
+            with phase('compress'):
+                payload = compressor.compress(encoding, body)
+            cache.put(key, version.token, payload, encoding)
+    res = set_version_headers(Response(payload, mimetype='application/json'),
+                              version, encoding)
+    return set_encoding_headers(res,
+                                encoding) if compressor is not None else res
+
+
+def streamed_json_response(
+        req: Request,
+        version: Optional[DataVersion],
+        chunks: Callable[[], Iterable[str]],
+        compressor: Optional[ResponseCompressor] = None) -> Response:
+    """
+    Streams a JSON body to the client as its chunks are produced, so the whole body never has to be held in memory.
+    Conditional requests are handled as in cached_json_response. With a ``compressor``, the body is compressed with
+    gzip as it streams when the client accepts it.
+    """
+    encoding = compressor.negotiate(
+        req.accept_encodings, stream=True) if compressor is not None else None
+    if version is not None and is_not_modified(req, version):
+        res = set_version_headers(Response(status=304), version, encoding)
+        return set_encoding_headers(
+            res, encoding) if compressor is not None else res
+    body: Iterator = iter(chunks())
+    if compressor is not None and encoding is not None:
+        body = compressor.compress_stream(
+            chunk.encode('utf-8') for chunk in body)
+    res = Response(stream_with_context(body), mimetype='application/json')
+    if version is not None:
+        set_version_headers(res, version, encoding)
+    return set_encoding_headers(res,
+                                encoding) if compressor is not None else res
 
 
 def get_auth_token(req: Request) -> Optional[str]:
     auth_header = req.headers.get('Authorization')
-    token = None
-    if auth_header:
-        try:
-            [auth_type, tkn] = auth_header.split(' ')
-            if auth_type == 'Bearer' and len(tkn) > 0:
-                token = tkn
-        except ValueError:
-            pass
+    # slices the header instead of splitting it, as this runs on every admin request
+    if auth_header is None or not auth_header.startswith('Bearer '):
+        return None
+    token = auth_header[7:]
+    if len(token) == 0 or ' ' in token:
+        return None
     return token
 
 
 def register_admin_routes(app: Flask, mike_store: MikeRecordProvider,
-                          auth: AuthProvider):
+                          auth: AuthProvider, jobs: JobRunner):
     admin = Blueprint('admin', 'admin', url_prefix='/admin')
 
     @admin.before_request
     def require_login():
-        auth_failed_response = jsonify({'message':
-                                        'You are not logged in'}), 401
         token = get_auth_token(request)
         if token is None or not auth.is_logged_in(token):
-            return auth_failed_response
+            return jsonify({'message': 'You are not logged in'}), 401
 
     @admin.route('/upload', methods=['POST'])
     def upload_records():
@@ -82,80 +512,86 @@ def register_admin_routes(app: Flask, mike_store: MikeRecordProvider,
                 {'message':
                  'Requires a CSV file in "mike_datasheet" field.'}), 400
         file = request.files['mike_datasheet']
+        # decode and parse the upload a block of rows at a time as the records are written; a bad value rolls the
+        # write back
+        reader = ColumnarMikeCsvReader(codecs.iterdecode(file.stream, 'utf-8'),
+                                       VALID_COUNTRY_CODES)
         try:
-            mike_records = parse_mike_csv(
-                map(lambda x: x.decode('utf-8'),
-                    file.read().splitlines()))
-            if mike_records is None:
-                return jsonify(
-                    {'message': 'The datasheet is in an invalid format.'}), 400
-            else:
-                mike_store.add_or_overwrite_mike_records([
-                    x for x in mike_records
-                    if x.country_code in VALID_COUNTRY_CODES
-                ])
-                return jsonify({'message': 'Database has been updated.'}), 200
+            mike_store.add_or_overwrite_mike_records(reader)
+            return jsonify({
+                'message': 'Database has been updated.',
+                'recordsWritten': reader.records_read,
+                'recordsSkipped': reader.records_skipped
+            }), 200
+        except (InvalidDatasheetError, csv.Error):
+            return jsonify({
+                'message': 'The datasheet is in an invalid format.',
+                'errorCount': reader.error_count,
+                'errors': reader.errors
+            }), 400
         except UnicodeDecodeError:
             return jsonify({'message':
                             'Send the CSV file in UTF-8 encoding.'}), 400
 
     @admin.route('/update', methods=['GET'])
     def update_from_mike():
-        res = requests.get(GOOGLE_DRIVE_URL, {
-            'id': MIKE_CSV_ID,
-            'export': 'download'
-        })
-        mike_records = parse_mike_csv(res.content.decode('utf-8').splitlines())
-        if mike_records is None:
-            return jsonify({
-                'message':
-                'MIKE Records in invalid format. Contact an administrator.'
-            }), 500
-        else:
-            mike_store.add_or_overwrite_mike_records([
-                x for x in mike_records
-                if x.country_code in VALID_COUNTRY_CODES
-            ])
-            return jsonify({'message': 'Database has been updated'}), 200
+        url = app.config.get('MIKE_CSV_URL', MIKE_CSV_URL)
+        force = request.args.get('force', '').lower() == 'true'
+        job = jobs.submit(
+            'mike_update', lambda progress: sync_records_from_mike(
+                mike_store, url, force, progress))
+        return jsonify({
+            'message': 'The update has started.',
+            'jobId': job.job_id
+        }), 202, {
+            'Location': url_for('admin.fetch_job', job_id=job.job_id)
+        }
+
+    @admin.route('/jobs/<job_id>', methods=['GET'])
+    def fetch_job(job_id: str):
+        job = jobs.job_store.get_job(job_id)
+        if job is None:
+            return jsonify({'message': 'Not Found'}), 404
+        return jsonify(job_to_json(job)), 200
 
     @admin.route('/edit', methods=['POST'])
     def edit_records():
-        data = request.get_json()
-        res = jsonify({'message': 'Bad Request'}), 400
-        if data is not None:
-            try:
-                records_to_add = [
-                    json_dict_to_mike(x) for x in data.get('added', [])
-                ]
-                mike_store.add_mike_records(records_to_add)
-                records_to_change = [
-                    json_dict_to_mike(x) for x in data.get('changed', [])
-                ]
-                mike_store.update_mike_records(records_to_change)
-                records_to_remove = [
-                    MikeRecord.PrimaryKey(x['mikeSiteId'], x['year'])
-                    for x in data.get('removed', [])
-                ]
-                mike_store.remove_mike_records(records_to_remove)
-                return jsonify({'message': 'Database has been updated.'}), 200
-            except (ValueError, KeyError, InvalidRecordError):
-                return jsonify({
-                    'message':
-                    'One or more of the records supplied are invalid.'
-                }), 400
-            except InvalidPrimaryKeyOperationError as e:
-                return jsonify({
-                    'message':
-                    'Attempted to add a record whose primary key is already in the database.',
-                    'problemRecord': obj_to_camel_dict(e.record)
-                }), 400
-        return res
+        try:
+            edit = EditRequest(request.get_json())
+        except TypeError:
+            return jsonify({'message': 'Bad Request'}), 400
+        if edit.has_invalid() and not edit.continue_on_error:
+            return jsonify({
+                'message':
+                'One or more of the records supplied are invalid.'
+            }), 400
+        result = mike_store.apply_mike_record_edits(edit.added, edit.changed,
+                                                    edit.removed,
+                                                    edit.continue_on_error)
+        body, status = edit.result_to_json(result)
+        return jsonify(body), status
 
     app.register_blueprint(admin)
 
 
-def register_routes(app: Flask, mike_store: MikeRecordProvider,
-                    country_store: CountryRecordProvider, auth: AuthProvider):
+def register_routes(app: Flask,
+                    mike_store: MikeRecordProvider,
+                    country_store: CountryRecordProvider,
+                    auth: AuthProvider,
+                    job_store: JobProvider,
+                    export_store: Optional[SnapshotExportProvider] = None,
+                    analytics_store: Optional[AnalyticsProvider] = None):
+    response_cache = ResponseCache(
+        app.config.get('RESPONSE_CACHE_SIZE', 64),
+        app.config.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    compressor = ResponseCompressor.from_config(app.config)
+    jobs = JobRunner(job_store, app.config.get('JOB_WORKERS', 1))
+    # every worker process counts the attempts of a client together
+    login_limiter = SharedLoginRateLimiter(
+        path.join(app.instance_path, 'login_attempts.sqlite3'),
+        app.config.get('LOGIN_ATTEMPTS_PER_MINUTE', 10),
+        app.config.get('LOGIN_ATTEMPT_BURST', 5))
+
     @app.before_request
     def filter_request_types():
         if (request.method == 'POST' and
@@ -174,15 +610,82 @@ def register_routes(app: Flask, mike_store: MikeRecordProvider,
 
     @app.route('/mikerecords', methods=['GET'])
     def fetch_mike_records():
-        mike_records = mike_store.get_all_mike_records()
-        dict_records = list(map(obj_to_camel_dict, mike_records))
-        return jsonify(dict_records), 200
+        try:
+            compact = is_compact_request(request.args)
+        except ValueError:
+            return jsonify({'message': 'Bad Request'}), 400
+        if any(x in request.args for x in MIKE_QUERY_PARAMS):
+            return fetch_mike_record_query(compact)
+        if compact:
+            # the rows go from the cursor to the encoder without a record object per row
+            return cached_json_response(
+                request, response_cache, ('mikerecords', 'compact'),
+                mike_store.get_data_version(),
+                lambda: encode_compact_mike_rows(
+                    mike_store.iter_mike_record_rows()), compressor)
+        if app.config.get('STREAM_RESPONSES', False):
+            return streamed_json_response(
+                request, mike_store.get_data_version(),
+                lambda: MIKE_RECORD_ENCODER.iter_encode_rows(
+                    mike_store.iter_mike_record_rows()), compressor)
+        return cached_json_response(
+            request, response_cache, 'mikerecords',
+            mike_store.get_data_version(), lambda: MIKE_RECORD_ENCODER.
+            encode_rows(mike_store.iter_mike_record_rows()), compressor)
+
+    def fetch_mike_record_query(compact: bool):
+        try:
+            query = parse_mike_record_query(
+                request.args, app.config.get('MAX_PAGE_SIZE', 1000))
+        except (ValueError, KeyError, InvalidRecordError):
+            return jsonify({'message': 'Bad Request'}), 400
+        # an unpaginated query can return the whole table, which is not worth a cache entry per filter
+        cache = response_cache if query.limit is not None else None
+        return cached_json_response(
+            request, cache, ('mikerecords', query.cache_key(), compact),
+            mike_store.get_data_version(), lambda: mike_page_to_json(
+                query, mike_store.query_mike_records(query), compact),
+            compressor)
 
     @app.route('/countryrecords', methods=['GET'])
     def fetch_country_records():
-        country_records = country_store.get_all_country_records()
-        dict_records = list(map(obj_to_camel_dict, country_records))
-        return jsonify(dict_records), 200
+        return cached_json_response(
+            request, response_cache, 'countryrecords',
+            country_store.get_data_version(),
+            lambda: COUNTRY_RECORD_ENCODER.encode_rows(
+                country_store.get_all_country_record_rows()), compressor)
+
+    @app.route('/analytics/trends', methods=['GET'])
+    def fetch_trends():
+        if analytics_store is None:
+            return jsonify({'message': 'Not Found'}), 404
+        try:
+            query, window, year_from = parse_trend_query(request.args)
+        except ValueError:
+            return jsonify({'message': 'Bad Request'}), 400
+        return cached_json_response(
+            request, response_cache, ('trends', request.query_string),
+            analytics_store.get_data_version(), lambda: json.dumps(
+                trend_series(analytics_store.get_yearly_totals(query), window,
+                             year_from)), compressor)
+
+    @app.route('/export/<table>', methods=['GET'])
+    def fetch_snapshot_export(table: str):
+        if export_store is None or table not in SnapshotExportProvider.TABLES:
+            return jsonify({'message': 'Not Found'}), 404
+        # answers revalidations before anything is produced
+        version = mike_store.get_data_version()
+        if version is not None and is_not_modified(request, version):
+            return set_version_headers(Response(status=304), version)
+        export = export_store.get_snapshot_export(table)
+        # the WSGI server sends the open file with sendfile where it can, without copying it through Python
+        res = send_file(export.file,
+                        mimetype=COLUMNAR_MIME_TYPE,
+                        download_name=table + '.mkcol',
+                        conditional=False,
+                        etag=False)
+        res.content_length = export.size
+        return set_version_headers(res, export.version)
 
     @app.route('/login', methods=['POST'])
     def login():
@@ -196,11 +699,69 @@ def register_routes(app: Flask, mike_store: MikeRecordProvider,
             # else check password
         # else if user wants to login and get a token
         if pwd:
-            token = auth.login(pwd)
+            retry_after = login_limiter.try_acquire(request.remote_addr)
+            if retry_after > 0:
+                return jsonify(
+                    {'message':
+                     'Too many login attempts. Try again later.'}), 429, {
+                         'Retry-After': str(int(retry_after) + 1)
+                     }
+            try:
+                token = auth.login(pwd)
+            except PasswordCheckBusyError:
+                return jsonify(
+                    {'message':
+                     'The server is busy. Try again later.'}), 503, {
+                         'Retry-After': '1'
+                     }
             if token is not None:
-                return jsonify({'token': auth.generate_new_token()}), 200
+                return jsonify({'token': token}), 200
             else:
                 return jsonify({'message': 'Your password is incorrect.'}), 401
         return jsonify({'message': 'Bad Request'}), 400
 
-    register_admin_routes(app, mike_store, auth)
+    register_admin_routes(app, mike_store, auth, jobs)
+
+
+def register_metrics_routes(app: Flask,
+                            registry: MetricsRegistry,
+                            profiler: Optional[SlowRequestProfiler] = None):
+    """
+    Records the latency, phase timings and database round trips of every request and serves them on /metrics.
+    Should be called after the other routes are registered.
+    """
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = begin_request()
+        g.profiler = profiler.start() if profiler is not None else None
+
+    @app.after_request
+    def record_request_metrics(res: Response):
+        request_metrics = g.pop('request_metrics', None)
+        if request_metrics is None:
+            # an earlier hook answered the request before the metrics started
+            return res
+        method = request.method
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        running_profiler = g.pop('profiler', None)
+
+        def record():
+            seconds = perf_counter() - request_metrics.started
+            slow = running_profiler is not None and profiler.finish(
+                running_profiler, route, seconds)
+            end_request()
+            registry.record(method, route, res.status_code, seconds,
+                            request_metrics, slow)
+
+        if res.is_streamed:
+            # a streamed body is produced after this hook, so the request only ends once the server closes it
+            res.call_on_close(record)
+        else:
+            record()
+        return res
+
+    @app.route('/metrics', methods=['GET'])
+    def fetch_metrics():
+        return Response(registry.collect(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,148 @@
+import json
+from json.encoder import encode_basestring_ascii
+from typing import Callable, Dict, Iterable, Iterator, Sequence, Tuple
+
+from .models import MikeRecord, CountryRecord
+
+
+class RowJsonEncoder:
+    """
+    Serializes row tuples straight to JSON objects, without building a record object or a dictionary per row.
+
+    The JSON text surrounding the values of a row is computed once, so encoding a row only escapes its strings and
+    formats them into that template. String values are escaped exactly as ``json.dumps`` escapes them with
+    ``ensure_ascii``. Integer values are formatted with ``%d``. Values must not be None.
+
+    :param keys: JSON key of each column, in row order
+    :param types: type of each column, either str or int
+    """
+
+    def __init__(self, keys: Sequence[str], types: Sequence[type]) -> None:
+        if len(keys) != len(types) or any(t not in (str, int) for t in types):
+            raise ValueError()
+        self.keys = tuple(keys)
+        self.encode_row = self._row_encoder(
+            '{' + ','.join(
+                encode_basestring_ascii(key) + (':%s' if t is str else ':%d')
+                for key, t in zip(keys, types)) + '}',
+            tuple(i for i, t in enumerate(types) if t is str))
+
+    @staticmethod
+    def _row_encoder(template: str,
+                     str_columns: Tuple[int, ...]) -> Callable[[tuple], str]:
+        escape = encode_basestring_ascii
+        if str_columns == tuple(range(len(str_columns))):
+            # the records keep their strings before their integers, so a row splits into two slices
+            split = len(str_columns)
+
+            def encode_split_row(row: tuple) -> str:
+                return template % (*map(escape, row[:split]), *row[split:])
+
+            return encode_split_row
+
+        def encode_row(row: tuple) -> str:
+            values = list(row)
+            for i in str_columns:
+                values[i] = escape(values[i])
+            return template % tuple(values)
+
+        return encode_row
+
+    def encode_rows(self, rows: Iterable[tuple]) -> str:
+        """
+        Serializes rows as a JSON array
+        """
+        return '[' + ','.join(map(self.encode_row, rows)) + ']'
+
+    def iter_encode_rows(self,
+                         rows: Iterable[tuple],
+                         chunk_size: int = 500) -> Iterator[str]:
+        """
+        Serializes rows as a JSON array in chunks of ``chunk_size`` rows
+        """
+        encode_row = self.encode_row
+        yield '['
+        separator = ''
+        chunk = []
+        for row in rows:
+            chunk.append(encode_row(row))
+            if len(chunk) >= chunk_size:
+                yield separator + ','.join(chunk)
+                separator = ','
+                chunk = []
+        if chunk:
+            yield separator + ','.join(chunk)
+        yield ']'
+
+
+MIKE_RECORD_ENCODER = RowJsonEncoder(MikeRecord.JSON_KEYS,
+                                     MikeRecord.FIELD_TYPES)
+COUNTRY_RECORD_ENCODER = RowJsonEncoder(CountryRecord.JSON_KEYS,
+                                        CountryRecord.FIELD_TYPES)
+
+_MIKE_FIELD_INDEX = {field: i for i, field in enumerate(MikeRecord.FIELDS)}
+_MAX_PROJECTION_ENCODERS = 256
+_projection_encoders: Dict[Tuple[str, ...], RowJsonEncoder] = {}
+
+
+def mike_projection_encoder(fields: Sequence[str]) -> RowJsonEncoder:
+    """
+    Returns an encoder for rows holding only the given MikeRecord fields, in the given order
+
+    :param fields: names of MikeRecord attributes
+    """
+    fields = tuple(fields)
+    encoder = _projection_encoders.get(fields)
+    if encoder is None:
+        indices = [_MIKE_FIELD_INDEX[field] for field in fields]
+        encoder = RowJsonEncoder([MikeRecord.JSON_KEYS[i] for i in indices],
+                                 [MikeRecord.FIELD_TYPES[i] for i in indices])
+        # clients choose the fields, so stop remembering new projections once there are plenty of them
+        if len(_projection_encoders) < _MAX_PROJECTION_ENCODERS:
+            _projection_encoders[fields] = encoder
+    return encoder
+
+
+class _IndexTable(dict):
+    """
+    Gives each distinct key the next index, in the order the keys are first looked up
+    """
+
+    def __missing__(self, key: tuple) -> int:
+        index = self[key] = len(self)
+        return index
+
+
+COMPACT_MIKE_COLUMNS = ('subregion', 'country', 'site', 'year', 'carcasses',
+                        'illegalCarcasses')
+_COMPACT_SUBREGION_ENCODER = mike_projection_encoder(
+    ('un_region', 'subregion_name', 'subregion_id'))
+_COMPACT_COUNTRY_ENCODER = mike_projection_encoder(
+    ('country_name', 'country_code'))
+_COMPACT_SITE_ENCODER = mike_projection_encoder(
+    ('mike_site_id', 'mike_site_name'))
+
+
+def encode_compact_mike_rows(rows: Iterable[tuple], trailer: str = '') -> str:
+    """
+    Serializes full MikeRecord rows as a JSON object holding the distinct subregions, countries and sites once each,
+    and a record per row as an array of integers: the indices of its subregion, country and site in those tables,
+    then its year, carcasses and illegal carcasses.
+
+    :param trailer: JSON members to add after the records, starting with a comma
+    """
+    subregions = _IndexTable()
+    countries = _IndexTable()
+    sites = _IndexTable()
+    records = ','.join([
+        '[%d,%d,%d,%d,%d,%d]' %
+        (subregions[row[0], row[1], row[2]], countries[row[3], row[4]],
+         sites[row[5], row[6]], row[7], row[8], row[9]) for row in rows
+    ])
+    return ('{"columns":' +
+            json.dumps(COMPACT_MIKE_COLUMNS, separators=(',', ':')) +
+            ',"subregions":' +
+            _COMPACT_SUBREGION_ENCODER.encode_rows(subregions) +
+            ',"countries":' + _COMPACT_COUNTRY_ENCODER.encode_rows(countries) +
+            ',"sites":' + _COMPACT_SITE_ENCODER.encode_rows(sites) +
+            ',"records":[' + records + ']' + trailer + '}')
@@ -0,0 +1,533 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional, Sequence, Set
+from .file_access import FileVersionStamp, FileSnapshotExportProvider
+from .statements import ELEPHANTCARCASSES_INDEXES, chunks, INSERT_MIKE_RECORD, UPDATE_MIKE_RECORD, \
+    INSERT_COUNTRY_TOTALS, create_index_statement, mike_query_statement, mike_page_from_rows, yearly_totals_statement, \
+    country_totals_refresh_statements, stored_keys_statement, remove_records_statement, update_params
+from .models import MikeRecord, CountryRecord, MikeRecordProvider, CountryRecordProvider, AnalyticsProvider, \
+    JobProvider, DataAccessError, DataVersion, InvalidPrimaryKeyOperationError, MikeRecordQuery, MikeRecordPage, \
+    EditResult, SyncSource, SyncSummary, TotalsQuery, Job
+
+# inserts new records and overwrites the others in place, instead of deleting and inserting them as REPLACE does
+_UPSERT_MIKE_RECORD = (INSERT_MIKE_RECORD + ' '
+                       'on conflict (mike_site_id, mike_year) do update set'
+                       ' un_region = excluded.un_region'
+                       ', subregion_name = excluded.subregion_name'
+                       ', subregion_id = excluded.subregion_id'
+                       ', country_name = excluded.country_name'
+                       ', country_code = excluded.country_code'
+                       ', mike_site_name = excluded.mike_site_name'
+                       ', carcasses = excluded.carcasses'
+                       ', illegal_carcasses = excluded.illegal_carcasses')
+
+# Schema migrations of the SQLite database, in the format of data_access.MIGRATIONS. The version applied is kept in
+# the database's user_version.
+SQLITE_MIGRATIONS = [
+    (
+        1,
+        'Create the schema',
+        [
+            'create table if not exists elephantcarcasses '
+            '( un_region text not null'
+            ', subregion_name text not null'
+            ', subregion_id text not null'
+            ', country_name text not null'
+            ', country_code text not null'
+            # MariaDB compares site IDs without regard to case, and so does this
+            ', mike_site_id text not null collate nocase'
+            ', mike_site_name text not null'
+            ', mike_year integer not null'
+            ', carcasses integer not null'
+            ', illegal_carcasses integer not null'
+            ', primary key (mike_site_id, mike_year) )',
+            'create table if not exists country_year_totals '
+            '( country_code text not null'
+            ', mike_year integer not null'
+            ', country_name text not null'
+            ', carcasses integer not null'
+            ', illegal_carcasses integer not null'
+            ', primary key (country_code, mike_year) )',
+            'create table if not exists jobs '
+            '( job_id text not null primary key'
+            ', kind text not null'
+            ', status text not null'
+            ', created_at text not null'
+            ', started_at text null'
+            ', finished_at text null'
+            ', progress text not null'
+            ', result text null'
+            ', message text null )',
+            'create table if not exists sync_sources '
+            '( name text not null primary key'
+            ', etag text null'
+            ', last_modified text null'
+            ', digest text not null )',
+            'create table if not exists mike_sync_rows '
+            '( mike_site_id text not null collate nocase'
+            ', mike_year integer not null'
+            ', fingerprint text not null'
+            ', primary key (mike_site_id, mike_year) )',
+        ] + [
+            create_index_statement('elephantcarcasses', name, columns)
+            for name, columns in ELEPHANTCARCASSES_INDEXES
+        ]),
+]
+
+
+def _to_db_time(value: Optional[datetime]) -> Optional[str]:
+    return value.astimezone(
+        timezone.utc).isoformat() if value is not None else None
+
+
+def _from_db_time(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+class SQLiteRecordProvider(MikeRecordProvider, CountryRecordProvider,
+                           AnalyticsProvider, JobProvider,
+                           FileSnapshotExportProvider):
+    """
+    Keeps the records in an embedded SQLite database file, for deployments that are too small to run a database
+    server. It has the same schema, indexes and semantics as MariaDBRecordProvider.
+
+    The database runs in write-ahead logging mode, so reads go on while a write is committed. Each thread of each
+    process has its own connection, which caches the prepared form of up to ``SQLITE_STATEMENT_CACHE_SIZE``
+    statements. Writes take the database's write lock when they start and wait up to ``SQLITE_BUSY_TIMEOUT`` seconds
+    for it.
+
+    :param database: path of the database file, which is created if it does not exist
+    """
+    MIGRATIONS = SQLITE_MIGRATIONS
+
+    def __init__(self,
+                 database: str,
+                 config: Optional[dict] = None,
+                 version_stamp: Optional[FileVersionStamp] = None,
+                 export_folder: Optional[str] = None) -> None:
+        config = config or {}
+        self.database = database
+        self._version_stamp = version_stamp
+        self._export_folder = export_folder
+        self._export_lock = threading.Lock()
+        self._chunk_size = config.get('DB_WRITE_CHUNK_SIZE', 1000)
+        self._fetch_size = config.get('DB_FETCH_SIZE', 500)
+        self._busy_timeout = config.get('SQLITE_BUSY_TIMEOUT', 30.0)
+        self._statement_cache_size = config.get('SQLITE_STATEMENT_CACHE_SIZE',
+                                                128)
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        # a connection inherited through fork belongs to the parent and is left alone
+        if conn is None or self._local.pid != os.getpid():
+            try:
+                # autocommit mode: transactions are begun explicitly, so reads never hold one open
+                conn = sqlite3.connect(
+                    self.database,
+                    timeout=self._busy_timeout,
+                    isolation_level=None,
+                    check_same_thread=False,
+                    cached_statements=self._statement_cache_size)
+                conn.execute('pragma journal_mode = wal')
+                # in WAL mode a commit is still atomic and consistent without waiting for the disk
+                conn.execute('pragma synchronous = normal')
+            except sqlite3.Error:
+                raise DataAccessError()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Runs the body of a ``with`` block in a write transaction and commits it, unless the body already ended it.
+        The transaction is rolled back if the body raises.
+
+        :raises DataAccessError: on any database error
+        """
+        conn = self._get_connection()
+        try:
+            # takes the write lock up front, so concurrent writers wait for it instead of failing to upgrade theirs
+            conn.execute('begin immediate')
+        except sqlite3.Error:
+            raise DataAccessError()
+        try:
+            yield conn.cursor()
+            if conn.in_transaction:
+                conn.execute('commit')
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute('rollback')
+            if isinstance(e, sqlite3.Error):
+                raise DataAccessError()
+            raise
+
+    def _read(self, sql: str, params: tuple = ()) -> List[tuple]:
+        try:
+            return self._get_connection().execute(sql, params).fetchall()
+        except sqlite3.Error:
+            raise DataAccessError()
+
+    # Schema migrations
+
+    def get_schema_version(self) -> int:
+        return self._read('pragma user_version')[0][0]
+
+    def migrate(self) -> List[int]:
+        """
+        Applies every migration newer than the schema version recorded in the database
+
+        :return: the versions that were applied
+        """
+        applied = []
+        with self._write() as cur:
+            cur.execute('pragma user_version')
+            current = cur.fetchone()[0]
+            for version, description, statements in SQLITE_MIGRATIONS:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    cur.execute(statement)
+                # pragmas take no parameters
+                cur.execute('pragma user_version = {:d}'.format(version))
+                applied.append(version)
+        if applied:
+            self._data_changed()
+        return applied
+
+    def get_data_version(self) -> Optional[DataVersion]:
+        if self._version_stamp is None:
+            return None
+        return self._version_stamp.current()
+
+    def _data_changed(self):
+        if self._version_stamp is not None:
+            self._version_stamp.bump()
+
+    # Implements MikeRecordProvider
+
+    def add_mike_record(self, record: MikeRecord):
+        self.add_mike_records([record])
+
+    def add_mike_records(self, records: Iterable[MikeRecord]):
+        with self._write() as cur:
+            years: Set[int] = set()
+            for chunk in chunks(records, self._chunk_size):
+                self._add_records(cur, chunk)
+                years.update(record.year for record in chunk)
+            self._refresh_country_totals(cur, years)
+        self._data_changed()
+
+    def add_or_overwrite_mike_records(self, records: Iterable[MikeRecord]):
+        with self._write() as cur:
+            years: Set[int] = set()
+            for chunk in chunks(records, self._chunk_size):
+                cur.executemany(_UPSERT_MIKE_RECORD,
+                                [record.to_tuple() for record in chunk])
+                years.update(record.year for record in chunk)
+            self._refresh_country_totals(cur, years)
+        self._data_changed()
+
+    @staticmethod
+    def _add_records(cursor: sqlite3.Cursor, records: list):
+        """
+        Inserts a chunk of records, replaying it row by row on a key conflict to report the offending record as
+        MariaDBRecordProvider._add_records does
+
+        :raises InvalidPrimaryKeyOperationError: with the first record whose primary key is already taken
+        """
+        cursor.execute('savepoint add_records')
+        try:
+            cursor.executemany(INSERT_MIKE_RECORD,
+                               [record.to_tuple() for record in records])
+        except sqlite3.IntegrityError:
+            cursor.execute('rollback to savepoint add_records')
+            for record in records:
+                try:
+                    cursor.execute(INSERT_MIKE_RECORD, record.to_tuple())
+                except sqlite3.IntegrityError:
+                    raise InvalidPrimaryKeyOperationError(record)
+            raise
+        cursor.execute('release savepoint add_records')
+
+    def get_mike_record(
+            self, record_key: MikeRecord.PrimaryKey) -> Optional[MikeRecord]:
+        rows = self._read(
+            'select * from elephantcarcasses where mike_site_id = ? and mike_year = ?',
+            tuple(record_key))
+        return MikeRecord.from_tuple(rows[0]) if rows else None
+
+    def get_all_mike_records(self) -> Iterable[MikeRecord]:
+        return list(self.iter_mike_records())
+
+    def iter_mike_records(self) -> Iterator[MikeRecord]:
+        return map(MikeRecord.from_tuple, self.iter_mike_record_rows())
+
+    def iter_mike_record_rows(self) -> Iterator[tuple]:
+        # a cursor of its own, so the thread's connection can run other statements while the rows are read
+        try:
+            cur = self._get_connection().execute(
+                'select * from elephantcarcasses')
+            while True:
+                rows = cur.fetchmany(self._fetch_size)
+                if not rows:
+                    break
+                yield from rows
+        except sqlite3.Error:
+            raise DataAccessError()
+
+    def query_mike_records(self, query: MikeRecordQuery) -> MikeRecordPage:
+        return mike_page_from_rows(query,
+                                   self._read(*mike_query_statement(query)))
+
+    def update_mike_record(self, record: MikeRecord):
+        self.update_mike_records([record])
+
+    def update_mike_records(self, records: Iterable[MikeRecord]):
+        with self._write() as cur:
+            years: Set[int] = set()
+            for chunk in chunks(records, self._chunk_size):
+                cur.executemany(UPDATE_MIKE_RECORD,
+                                [update_params(record) for record in chunk])
+                years.update(record.year for record in chunk)
+            self._refresh_country_totals(cur, years)
+        self._data_changed()
+
+    def remove_mike_record(self, record_key: MikeRecord.PrimaryKey):
+        self.remove_mike_records([record_key])
+
+    def remove_mike_records(self,
+                            record_keys: Iterable[MikeRecord.PrimaryKey]):
+        with self._write() as cur:
+            years: Set[int] = set()
+            for chunk in chunks(record_keys, self._chunk_size):
+                cur.execute(*remove_records_statement(chunk))
+                years.update(record_key[1] for record_key in chunk)
+            self._refresh_country_totals(cur, years)
+        self._data_changed()
+
+    def apply_mike_record_edits(self,
+                                added: Sequence[MikeRecord],
+                                changed: Sequence[MikeRecord],
+                                removed: Sequence[MikeRecord.PrimaryKey],
+                                continue_on_error: bool = False) -> EditResult:
+        # the write lock is held from the check to the commit, so no other writer can take a key in between
+        with self._write() as cur:
+            stored: Set[MikeRecord.PrimaryKey] = set()
+            keys = [record.get_primary_key() for record in added] + \
+                [record.get_primary_key() for record in changed] + list(removed)
+            for chunk in chunks(set(keys), self._chunk_size):
+                cur.execute(*stored_keys_statement(chunk))
+                stored.update(
+                    MikeRecord.PrimaryKey(mike_site_id, mike_year)
+                    for mike_site_id, mike_year in cur)
+            result = EditResult.check(added, changed, removed, stored)
+            if result.failed() and not continue_on_error:
+                cur.execute('rollback')
+                return result
+            to_add = [
+                record.to_tuple() for i, record in enumerate(added)
+                if result.added[i] == EditResult.OK
+            ]
+            to_change = [
+                record for i, record in enumerate(changed)
+                if result.changed[i] == EditResult.OK
+            ]
+            to_remove = [
+                key for i, key in enumerate(removed)
+                if result.removed[i] == EditResult.OK
+            ]
+            for chunk in chunks(to_add, self._chunk_size):
+                cur.executemany(INSERT_MIKE_RECORD, chunk)
+            for chunk in chunks(to_change, self._chunk_size):
+                cur.executemany(UPDATE_MIKE_RECORD,
+                                [update_params(record) for record in chunk])
+            for chunk in chunks(to_remove, self._chunk_size):
+                cur.execute(*remove_records_statement(chunk))
+            years = {row[7] for row in to_add}
+            years.update(record.year for record in to_change)
+            years.update(record_key[1] for record_key in to_remove)
+            self._refresh_country_totals(cur, years)
+        result.applied = True
+        if years:
+            self._data_changed()
+        return result
+
+    def sync_mike_records(self, records: Iterable[MikeRecord]) -> SyncSummary:
+        summary = SyncSummary()
+        with self._write() as cur:
+            # fingerprints of the stored records and of the rows of the last synchronized datasheet
+            cur.execute('select * from elephantcarcasses')
+            stored = {}
+            for row in cur.fetchall():
+                record = MikeRecord.from_tuple(row)
+                stored[record.get_primary_key()] = record.fingerprint()
+            cur.execute(
+                'select mike_site_id, mike_year, fingerprint from mike_sync_rows'
+            )
+            synced = {
+                (row[0].lower(), row[1]): row[2]
+                for row in cur.fetchall()
+            }
+            seen = {}
+            years: Set[int] = set()
+            for chunk in chunks(records, self._chunk_size):
+                inserts = []
+                updates = []
+                for record in chunk:
+                    key = record.get_primary_key()
+                    fingerprint = record.fingerprint()
+                    seen[key] = fingerprint
+                    current = stored.get(key)
+                    if current == fingerprint:
+                        summary.unchanged += 1
+                        continue
+                    if current is None:
+                        inserts.append(record.to_tuple())
+                        summary.inserted += 1
+                    else:
+                        updates.append(update_params(record))
+                        summary.changed += 1
+                    stored[key] = fingerprint
+                    years.add(record.year)
+                cur.executemany(INSERT_MIKE_RECORD, inserts)
+                cur.executemany(UPDATE_MIKE_RECORD, updates)
+            dropped = [key for key in synced if key not in seen]
+            for chunk in chunks([key for key in dropped if key in stored],
+                                self._chunk_size):
+                cur.execute(*remove_records_statement(chunk))
+                summary.deleted += len(chunk)
+                years.update(key[1] for key in chunk)
+            for chunk in chunks(dropped, self._chunk_size):
+                cur.execute(*remove_records_statement(chunk, 'mike_sync_rows'))
+            for chunk in chunks([
+                    key + (fingerprint, ) for key, fingerprint in seen.items()
+                    if synced.get(key) != fingerprint
+            ], self._chunk_size):
+                cur.executemany(
+                    'insert into mike_sync_rows (mike_site_id, mike_year, fingerprint) '
+                    'values (?, ?, ?) '
+                    'on conflict (mike_site_id, mike_year) do update set fingerprint = excluded.fingerprint',
+                    chunk)
+            self._refresh_country_totals(cur, years)
+        if summary.inserted or summary.changed or summary.deleted:
+            self._data_changed()
+        return summary
+
+    def get_sync_source(self, name: str) -> Optional[SyncSource]:
+        rows = self._read(
+            'select name, etag, last_modified, digest from sync_sources where name = ?',
+            (name, ))
+        return SyncSource(*rows[0]) if rows else None
+
+    def save_sync_source(self, source: SyncSource):
+        with self._write() as cur:
+            cur.execute(
+                'replace into sync_sources (name, etag, last_modified, digest) values (?, ?, ?, ?)',
+                (source.name, source.etag, source.last_modified,
+                 source.digest))
+
+    # Maintains the country_year_totals aggregate table
+
+    @staticmethod
+    def _refresh_country_totals(cursor: sqlite3.Cursor, years: set):
+        for sql, params in country_totals_refresh_statements(years):
+            cursor.execute(sql, params)
+
+    def rebuild_country_totals(self):
+        with self._write() as cur:
+            cur.execute('delete from country_year_totals')
+            cur.execute(INSERT_COUNTRY_TOTALS +
+                        'group by country_code, mike_year')
+        self._data_changed()
+
+    def check_country_totals(self) -> List[CountryRecord.PrimaryKey]:
+        stored = {
+            (row[0], row[1]): (row[2], row[3])
+            for row in self._read(
+                'select country_code, mike_year, carcasses, illegal_carcasses from country_year_totals'
+            )
+        }
+        expected = {
+            (row[0], row[1]): (row[2], row[3])
+            for row in self._read(
+                'select country_code, mike_year, sum(carcasses), sum(illegal_carcasses) '
+                'from elephantcarcasses group by country_code, mike_year')
+        }
+        return [
+            CountryRecord.PrimaryKey(*key)
+            for key in sorted(stored.keys() | expected.keys())
+            if stored.get(key) != expected.get(key)
+        ]
+
+    # Implements CountryRecordProvider
+
+    def get_country_record(
+            self,
+            record_key: CountryRecord.PrimaryKey) -> Optional[CountryRecord]:
+        rows = self._read(
+            'select country_name, country_code, mike_year, carcasses, illegal_carcasses '
+            'from country_year_totals where country_code = ? and mike_year = ?',
+            tuple(record_key))
+        return CountryRecord.from_tuple(rows[0]) if rows else None
+
+    def get_all_country_records(self) -> Iterable[CountryRecord]:
+        return list(
+            map(CountryRecord.from_tuple, self.get_all_country_record_rows()))
+
+    def get_all_country_record_rows(self) -> List[tuple]:
+        return self._read(
+            'select country_name, country_code, mike_year, carcasses, illegal_carcasses '
+            'from country_year_totals order by country_code, mike_year')
+
+    # Implements AnalyticsProvider
+
+    def get_yearly_totals(self, query: TotalsQuery) -> List[tuple]:
+        return self._read(*yearly_totals_statement(query))
+
+    # Implements JobProvider
+
+    def create_job(self, kind: str) -> Job:
+        job = Job(uuid.uuid4().hex, kind, Job.QUEUED,
+                  datetime.now(timezone.utc))
+        with self._write() as cur:
+            cur.execute(
+                'insert into jobs (job_id, kind, status, created_at, progress) values (?, ?, ?, ?, ?)',
+                (job.job_id, job.kind, job.status, _to_db_time(
+                    job.created_at), json.dumps(job.progress)))
+        return job
+
+    def update_job(self, job: Job):
+        with self._write() as cur:
+            cur.execute(
+                'update jobs set'
+                ' status = ?'
+                ', started_at = ?'
+                ', finished_at = ?'
+                ', progress = ?'
+                ', result = ?'
+                ', message = ? '
+                'where job_id = ?',
+                (job.status, _to_db_time(job.started_at),
+                 _to_db_time(job.finished_at), json.dumps(job.progress),
+                 json.dumps(job.result) if job.result is not None else None,
+                 job.message, job.job_id))
+
+    def get_job(self, job_id: str) -> Optional[Job]:
+        rows = self._read(
+            'select job_id, kind, status, created_at, started_at, finished_at, progress, result, '
+            'message from jobs where job_id = ?', (job_id, ))
+        if not rows:
+            return None
+        row = rows[0]
+        # jobs always have a creation time
+        return Job(row[0], row[1], row[2], datetime.fromisoformat(row[3]),
+                   _from_db_time(row[4]), _from_db_time(row[5]),
+                   json.loads(row[6]),
+                   json.loads(row[7]) if row[7] is not None else None, row[8])
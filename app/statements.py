@@ -0,0 +1,244 @@
+"""
+The SQL statements and statement builders shared by the storage backends. Statements use ``?`` placeholders and only
+SQL that both MariaDB and SQLite accept.
+"""
+from typing import Iterable, Iterator, List, Tuple
+from .models import MikeRecord, MikeRecordQuery, MikeRecordPage, TotalsQuery
+
+
+def chunks(items: Iterable, size: int) -> Iterator[list]:
+    """
+    Lazily splits an iterable into lists of at most ``size`` items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+MIKE_RECORD_COLUMNS = ('( un_region'
+                       ', subregion_name'
+                       ', subregion_id'
+                       ', country_name'
+                       ', country_code'
+                       ', mike_site_id'
+                       ', mike_site_name'
+                       ', mike_year'
+                       ', carcasses'
+                       ', illegal_carcasses ) ')
+
+INSERT_MIKE_RECORD = ('insert into elephantcarcasses ' + MIKE_RECORD_COLUMNS +
+                      'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+REPLACE_MIKE_RECORD = ('replace into elephantcarcasses ' +
+                       MIKE_RECORD_COLUMNS +
+                       'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+# country_name is the same for every row of a country, max() just picks it
+INSERT_COUNTRY_TOTALS = ('insert into country_year_totals '
+                         '( country_code'
+                         ', mike_year'
+                         ', country_name'
+                         ', carcasses'
+                         ', illegal_carcasses ) '
+                         'select '
+                         'country_code'
+                         ', mike_year'
+                         ', max(country_name)'
+                         ', cast(sum(carcasses) as int)'
+                         ', cast(sum(illegal_carcasses) as int) '
+                         'from elephantcarcasses ')
+
+# MikeRecord attribute -> elephantcarcasses column
+MIKE_FIELD_COLUMNS = {
+    'un_region': 'un_region',
+    'subregion_name': 'subregion_name',
+    'subregion_id': 'subregion_id',
+    'country_name': 'country_name',
+    'country_code': 'country_code',
+    'mike_site_id': 'mike_site_id',
+    'mike_site_name': 'mike_site_name',
+    'year': 'mike_year',
+    'carcasses': 'carcasses',
+    'illegal_carcasses': 'illegal_carcasses',
+}
+
+# TotalsQuery grouping -> elephantcarcasses columns holding the id and the name of a group
+GROUPING_COLUMNS = {
+    'site': ('mike_site_id', 'mike_site_name'),
+    'country': ('country_code', 'country_name'),
+    'subregion': ('subregion_id', 'subregion_name'),
+    'region': ('un_region', 'un_region'),
+}
+
+UPDATE_MIKE_RECORD = ('update elephantcarcasses set'
+                      ' un_region = ?'
+                      ', subregion_name = ?'
+                      ', subregion_id = ?'
+                      ', country_name = ?'
+                      ', country_code = ?'
+                      ', mike_site_name = ?'
+                      ', carcasses = ?'
+                      ', illegal_carcasses = ?  '
+                      'where mike_site_id = ? and mike_year = ?')
+
+# Secondary indexes of elephantcarcasses as (name, columns)
+ELEPHANTCARCASSES_INDEXES = [
+    # covers recomputing the country totals of a year
+    ('elephantcarcasses_year_country',
+     ('mike_year', 'country_code', 'country_name', 'carcasses',
+      'illegal_carcasses')),
+    # country and subregion filters of MIKE record queries
+    ('elephantcarcasses_country_year', ('country_code', 'mike_year')),
+    ('elephantcarcasses_subregion_year', ('subregion_id', 'mike_year')),
+]
+
+
+def create_index_statement(table: str, name: str, columns) -> str:
+    return 'create index if not exists {} on {} ({})'.format(
+        name, table, ', '.join(columns))
+
+
+def mike_query_statement(query: MikeRecordQuery) -> Tuple[str, tuple]:
+    """
+    Builds the select statement of a MIKE record query. Each row holds the requested fields followed by the primary
+    key, and one row more than the limit is selected to tell whether there is another page.
+
+    :return: the statement, with ``?`` placeholders, and its parameters
+    """
+    conditions: List[str] = []
+    params: List[object] = []
+    for column, value in (('country_code', query.country_code),
+                          ('subregion_id', query.subregion_id),
+                          ('mike_site_id', query.mike_site_id)):
+        if value is not None:
+            conditions.append(column + ' = ?')
+            params.append(value)
+    if query.year_from is not None:
+        conditions.append('mike_year >= ?')
+        params.append(query.year_from)
+    if query.year_to is not None:
+        conditions.append('mike_year <= ?')
+        params.append(query.year_to)
+    if query.after is not None:
+        # spelled out instead of a row comparison so the primary key index is used for the range
+        conditions.append(
+            '(mike_site_id > ? or (mike_site_id = ? and mike_year > ?))')
+        params.extend((query.after[0], query.after[0], query.after[1]))
+    sql = ('select ' + ', '.join(MIKE_FIELD_COLUMNS[field]
+                                 for field in query.fields) +
+           ', mike_site_id, mike_year from elephantcarcasses')
+    if conditions:
+        sql += ' where ' + ' and '.join(conditions)
+    sql += ' order by mike_site_id, mike_year'
+    if query.limit is not None:
+        sql += ' limit ?'
+        params.append(query.limit + 1)
+    return sql, tuple(params)
+
+
+def mike_page_from_rows(query: MikeRecordQuery,
+                        rows: List[tuple]) -> MikeRecordPage:
+    """
+    Builds the page of a MIKE record query from the rows selected by the statement of mike_query_statement
+    """
+    next_key = None
+    if query.limit is not None and len(rows) > query.limit:
+        rows = rows[:query.limit]
+        next_key = MikeRecord.PrimaryKey(rows[-1][-2], rows[-1][-1])
+    return MikeRecordPage([row[:-2] for row in rows], next_key)
+
+
+def yearly_totals_statement(query: TotalsQuery) -> Tuple[str, tuple]:
+    """
+    Builds the select statement of the yearly totals of AnalyticsProvider.get_yearly_totals
+
+    :return: the statement, with ``?`` placeholders, and its parameters
+    """
+    conditions: List[str] = []
+    params: List[object] = []
+    for column, value in (('country_code', query.country_code),
+                          ('subregion_id', query.subregion_id),
+                          ('mike_site_id', query.mike_site_id)):
+        if value is not None:
+            conditions.append(column + ' = ?')
+            params.append(value)
+    if query.year_from is not None:
+        conditions.append('mike_year >= ?')
+        params.append(query.year_from)
+    if query.year_to is not None:
+        conditions.append('mike_year <= ?')
+        params.append(query.year_to)
+    if query.group_by == 'country' and query.subregion_id is None and query.mike_site_id is None:
+        # already summed per country and year
+        sql = (
+            'select country_code, country_name, mike_year, carcasses, illegal_carcasses '
+            'from country_year_totals')
+        if conditions:
+            sql += ' where ' + ' and '.join(conditions)
+        sql += ' order by country_code, mike_year'
+    else:
+        group_id, group_name = GROUPING_COLUMNS[query.group_by]
+        sql = (
+            'select ' + group_id + ', max(' + group_name + '), mike_year'
+            ', cast(sum(carcasses) as int), cast(sum(illegal_carcasses) as int) '
+            'from elephantcarcasses')
+        if conditions:
+            sql += ' where ' + ' and '.join(conditions)
+        sql += ' group by ' + group_id + ', mike_year order by ' + group_id + ', mike_year'
+    return sql, tuple(params)
+
+
+def country_totals_refresh_statements(years: set) -> List[Tuple[str, tuple]]:
+    """
+    Builds the statements that recompute the rows of country_year_totals of the given years
+    """
+    if not years:
+        return []
+    params = tuple(years)
+    marks = ', '.join(['?'] * len(params))
+    return [
+        ('delete from country_year_totals '
+         'where mike_year in (' + marks + ')', params),
+        (INSERT_COUNTRY_TOTALS + 'where mike_year in (' + marks + ') '
+         'group by country_code, mike_year', params),
+    ]
+
+
+def stored_keys_statement(record_keys: list) -> Tuple[str, tuple]:
+    """
+    Builds the statement that selects which of the given MIKE record keys are stored
+    """
+    return ('select mike_site_id, mike_year from elephantcarcasses '
+            'where (mike_site_id, mike_year) in (' +
+            ', '.join(['(?, ?)'] * len(record_keys)) + ')',
+            tuple(value for record_key in record_keys for value in record_key))
+
+
+def remove_records_statement(
+        record_keys: list,
+        table: str = 'elephantcarcasses') -> Tuple[str, tuple]:
+    return ('delete from ' + table + ' '
+            'where (mike_site_id, mike_year) in (' +
+            ', '.join(['(?, ?)'] * len(record_keys)) + ')',
+            tuple(value for record_key in record_keys for value in record_key))
+
+
+def update_params(record: MikeRecord) -> tuple:
+    """
+    Returns the parameters of the update statement of a record
+    """
+    return (
+        record.un_region,
+        record.subregion_name,
+        record.subregion_id,
+        record.country_name,
+        record.country_code,
+        record.mike_site_name,
+        record.carcasses,
+        record.illegal_carcasses,
+    ) + record.get_primary_key()
@@ -0,0 +1,39 @@
+from app import create_async_app
+from app.async_data_access import AsyncMariaDBRecordProvider
+from app.async_routes import register_async_routes
+from app.data_access import MariaDBRecordProvider
+from app.file_access import TextFileMasterPasswordProvider, FileVersionStamp
+from app.auth import AuthProvider
+from hypercorn.middleware import ProxyFixMiddleware
+
+app = create_async_app()
+# serves the background jobs, which run on threads
+db = MariaDBRecordProvider(app.config, FileVersionStamp(app.instance_path))
+records = AsyncMariaDBRecordProvider(app.config,
+                                     FileVersionStamp(app.instance_path))
+pwd_store = TextFileMasterPasswordProvider(
+    app.instance_path, app.config.get('PASSWORD_HASH_WORKERS', 1),
+    app.config.get('MAX_PENDING_PASSWORD_CHECKS', 4))
+auth = AuthProvider(pwd_store,
+                    app.config.get('SECRET_KEYS') or app.config['SECRET_KEY'],
+                    app.config.get('SECRET_KEY_ID'),
+                    app.config.get('TOKEN_CACHE_SIZE', 1024))
+register_async_routes(app, records, records, auth, db, db, records)
+
+
+@app.before_serving
+async def open_pool():
+    if app.config.get('DB_MIGRATE_ON_STARTUP', False):
+        db.migrate()
+    await records.open()
+
+
+@app.after_serving
+async def close_pool():
+    await records.close()
+
+
+if app.config.get('PROXY_COUNT', 0) > 0:
+    app.asgi_app = ProxyFixMiddleware(app.asgi_app,
+                                      mode='legacy',
+                                      trusted_hops=app.config['PROXY_COUNT'])
@@ -0,0 +1,49 @@
+"""
+Measures the per-request cost of the admin login check: reading the bearer token and verifying it, with and without
+the verified token cache. Needs no database. Results are printed as JSON.
+
+    python benchmarks/bench_auth.py [iterations]
+"""
+import json
+import sys
+from os import path
+from timeit import timeit
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from flask import Flask
+from app.auth import AuthProvider
+from app.routes import get_auth_token
+
+
+def per_call_us(func, iterations: int) -> float:
+    return timeit(func, number=iterations) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    auth = AuthProvider(None, {'old': 'o' * 32, 'new': 'n' * 32}, 'new')
+    token = auth.generate_new_token()
+    app = Flask(__name__)
+    with app.test_request_context(headers={'Authorization': 'Bearer ' +
+                                           token}) as ctx:
+        req = ctx.request
+        auth.is_logged_in(token)
+        results = {
+            'get_auth_token_us':
+            per_call_us(lambda: get_auth_token(req), iterations),
+            'verify_uncached_us':
+            per_call_us(lambda: auth._verify(token), iterations),
+            'is_logged_in_cached_us':
+            per_call_us(lambda: auth.is_logged_in(token), iterations),
+            'admin_check_cached_us':
+            per_call_us(lambda: auth.is_logged_in(get_auth_token(req)),
+                        iterations),
+        }
+    results['speedup'] = (results['verify_uncached_us'] /
+                          results['is_logged_in_cached_us'])
+    print(json.dumps({'iterations': iterations, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Compares the ways of parsing a MIKE datasheet: parse_mike_csv, which builds every record from a csv.DictReader row, the
+row at a time MikeCsvReader, both of which the app used before, and the column at a time ColumnarMikeCsvReader in
+datasheet.py. The datasheet is synthetic, with a tenth of its rows from countries the app does not track, and needs no
+database. Results are printed as JSON.
+
+    python benchmarks/bench_csv.py [rows] [repeats]
+"""
+import csv
+import io
+import json
+import sys
+import tracemalloc
+from collections import deque
+from os import path
+from time import perf_counter
+from typing import Iterable, Iterator, List, Mapping, Optional
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from app.datasheet import MIKE_CSV_COLUMNS, ColumnarMikeCsvReader, InvalidDatasheetError
+from app.models import MikeRecord, InvalidRecordError
+from app.routes import VALID_COUNTRY_CODES
+
+COUNTRY_CODES = sorted(VALID_COUNTRY_CODES)
+
+
+def mike_record_from_csv_row(row: Mapping[str, str]) -> MikeRecord:
+    return MikeRecord(row['UNRegion'], row['SubregionName'],
+                      row['SubregionID'], row['CountryName'],
+                      row['CountryCode'], row['MIKEsiteID'],
+                      row['MIKEsiteName'], int(row['year']),
+                      int(row['TotalNumberOfCarcasses']),
+                      int(row['NumberOfIllegalCarcasses']))
+
+
+def parse_mike_csv(csv_lines: Iterable[str]) -> Optional[Iterable[MikeRecord]]:
+    reader = csv.DictReader(csv_lines)
+    try:
+        return [mike_record_from_csv_row(row) for row in reader]
+
+    except (ValueError, KeyError, TypeError, csv.Error, InvalidRecordError):
+        return None
+
+
+class MikeCsvReader:
+    """
+    Lazily reads MIKE records from the lines of a CSV datasheet, keeping only the current row in memory.
+
+    Records from countries outside ``country_codes`` are skipped. Once a row fails to parse no more records are
+    yielded, but the rest of the datasheet is still read so that every bad row can be reported. After the last row,
+    InvalidDatasheetError is raised if any row was bad. A consumer that writes the records inside a transaction
+    therefore rolls the whole datasheet back.
+    """
+    MAX_REPORTED_ERRORS = 100
+
+    def __init__(self,
+                 csv_lines: Iterable[str],
+                 country_codes: Optional[set] = None) -> None:
+        self.csv_lines = csv_lines
+        self.country_codes = country_codes
+        self.rows_read = 0
+        self.records_read = 0
+        self.records_skipped = 0
+        self.errors: List[dict] = []
+        self.error_count = 0
+
+    def _add_error(self, row: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < self.MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'message': message})
+
+    def __iter__(self) -> Iterator[MikeRecord]:
+        reader = csv.DictReader(self.csv_lines)
+        missing = [
+            x for x in MIKE_CSV_COLUMNS if x not in (reader.fieldnames or [])
+        ]
+        if missing:
+            self._add_error(1, 'Missing columns: ' + ', '.join(missing))
+            raise InvalidDatasheetError(self.errors, self.error_count)
+        for row in reader:
+            self.rows_read += 1
+            try:
+                record = mike_record_from_csv_row(row)
+            except (ValueError, TypeError):
+                self._add_error(
+                    reader.line_num,
+                    'A value is missing or a number is not an integer.')
+                continue
+            except InvalidRecordError:
+                self._add_error(
+                    reader.line_num,
+                    'An ID has the wrong length or a number is negative.')
+                continue
+            if self.error_count > 0:
+                continue
+            if (self.country_codes is not None
+                    and record.country_code not in self.country_codes):
+                self.records_skipped += 1
+                continue
+            self.records_read += 1
+            yield record
+        if self.error_count > 0:
+            raise InvalidDatasheetError(self.errors, self.error_count)
+
+
+def synthetic_datasheet(count: int) -> str:
+    sites = ['S{:02d}'.format(i) for i in range(100)]
+    lines = [','.join(MIKE_CSV_COLUMNS)]
+    for i in range(count):
+        site = sites[i % len(sites)]
+        country = 'ZZ' if i % 10 == 9 else COUNTRY_CODES[
+            i % len(COUNTRY_CODES)].upper()
+        lines.append(
+            'Africa,Central Africa,CA,Country {0},{0},{1},Site {1},{2},{3},{4}'
+            .format(country, site, 1990 + i // len(sites), i % 97, i % 41))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_function_path(text: str) -> Iterable[MikeRecord]:
+    records = parse_mike_csv(io.StringIO(text))
+    if records is None:
+        raise AssertionError('parse_mike_csv rejected the datasheet')
+    # the function parses every row and leaves out no country
+    return (record for record in records
+            if record.country_code in VALID_COUNTRY_CODES)
+
+
+def row_reader_path(text: str) -> Iterable[MikeRecord]:
+    return MikeCsvReader(io.StringIO(text), VALID_COUNTRY_CODES)
+
+
+def columnar_reader_path(text: str) -> Iterable[MikeRecord]:
+    return ColumnarMikeCsvReader(io.StringIO(text), VALID_COUNTRY_CODES)
+
+
+def consume(func, text: str):
+    # records are written as they are read, so none are kept
+    deque(func(text), 0)
+
+
+def first_errors(reader_class, text: str) -> list:
+    try:
+        list(reader_class(io.StringIO(text), VALID_COUNTRY_CODES))
+    except InvalidDatasheetError as e:
+        return [error['row'] for error in e.errors]
+    raise AssertionError(reader_class.__name__ + ' accepted a bad datasheet')
+
+
+def peak_mib(func, text: str) -> float:
+    tracemalloc.start()
+    consume(func, text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    text = synthetic_datasheet(count)
+    expected = [record.to_tuple() for record in parse_function_path(text)]
+    bad_text = text.replace(',Site S07,', ',Site S07,x',
+                            5).replace('\nAfrica,Central Africa,CA,',
+                                       '\nAfrica,', 1)
+    if first_errors(MikeCsvReader,
+                    bad_text) != first_errors(ColumnarMikeCsvReader, bad_text):
+        raise AssertionError('the readers reported different rows')
+    results = {}
+    for name, func in (('parse_mike_csv',
+                        parse_function_path), ('row_reader', row_reader_path),
+                       ('columnar_reader', columnar_reader_path)):
+        if [record.to_tuple() for record in func(text)] != expected:
+            raise AssertionError(name + ' read different records')
+        start = perf_counter()
+        for _ in range(repeats):
+            consume(func, text)
+        seconds = (perf_counter() - start) / repeats
+        results[name] = {
+            'seconds': seconds,
+            'rows_per_second': count / seconds,
+            # the datasheet text itself is not counted
+            'peak_mib': peak_mib(func, text),
+        }
+    for name in ('row_reader', 'columnar_reader'):
+        results[name]['speedup'] = results['parse_mike_csv'][
+            'seconds'] / results[name]['seconds']
+    # the row reader is what the app used right before the columnar one
+    results['columnar_reader']['speedup_over_row_reader'] = results[
+        'row_reader']['seconds'] / results['columnar_reader']['seconds']
+    print(
+        json.dumps(
+            {
+                'rows': count,
+                'records': len(expected),
+                'repeats': repeats,
+                'results': results
+            },
+            indent=2))
+
+
+if __name__ == '__main__':
+    main()
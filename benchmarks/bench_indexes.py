@@ -0,0 +1,149 @@
+"""
+Measures the country and subregion access paths of elephantcarcasses with and without its secondary indexes.
+
+Seeds a synthetic copy of the table (elephantcarcasses_bench) in the configured database, records EXPLAIN output and
+latencies of the queries the app runs, adds the indexes from the schema migrations and measures again. The copy is
+dropped afterwards. Results are printed as JSON.
+
+    python benchmarks/bench_indexes.py [rows] [repeats] [output.json]
+"""
+import json
+import random
+import statistics
+import sys
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+import mariadb
+from app import create_app
+from app.statements import ELEPHANTCARCASSES_INDEXES, create_index_statement
+
+TABLE = 'elephantcarcasses_bench'
+SUBREGIONS = ['ca', 'ea', 'sa', 'wa', 'na']
+COUNTRIES = [
+    '{}{}'.format(chr(97 + i // 26), chr(97 + i % 26))
+    for i in range(0, 26 * 26, 13)
+]
+
+QUERIES = {
+    'country_totals_of_year':
+    ('select country_code, mike_year, max(country_name), sum(carcasses), sum(illegal_carcasses) '
+     'from {} where mike_year in (?) group by country_code, mike_year'.format(
+         TABLE), lambda: (2000, )),
+    'all_country_totals':
+    ('select country_code, mike_year, max(country_name), sum(carcasses), sum(illegal_carcasses) '
+     'from {} group by country_code, mike_year'.format(TABLE), lambda: ()),
+    'country_year_range':
+    ('select * from {} where country_code = ? and mike_year >= ? and mike_year <= ? '
+     'order by mike_site_id, mike_year'.format(TABLE), lambda:
+     (random.choice(COUNTRIES), 1995, 2005)),
+    'subregion_year':
+    ('select * from {} where subregion_id = ? and mike_year = ? '
+     'order by mike_site_id, mike_year'.format(TABLE), lambda:
+     (random.choice(SUBREGIONS), 2000)),
+}
+
+
+def synthetic_rows(count: int):
+    site_count = min(26**3, max(1, count // 50))
+    years = -(-count // site_count)
+    produced = 0
+    for site in range(site_count):
+        site_id = chr(97 + site // 676) + chr(97 + site // 26 %
+                                              26) + chr(97 + site % 26)
+        country = COUNTRIES[site % len(COUNTRIES)]
+        subregion = SUBREGIONS[site % len(SUBREGIONS)]
+        for year in range(1980, 1980 + years):
+            if produced == count:
+                return
+            carcasses = random.randint(0, 40)
+            yield ('Africa', 'Subregion ' + subregion, subregion,
+                   'Country ' + country, country, site_id, 'Site ' + site_id,
+                   year, carcasses, random.randint(0, carcasses))
+            produced += 1
+
+
+def seed(cur, rows: int):
+    cur.execute('drop table if exists ' + TABLE)
+    cur.execute('create table {} like elephantcarcasses'.format(TABLE))
+    # drop any secondary index copied from elephantcarcasses so the first run measures the bare primary key
+    for name, _ in ELEPHANTCARCASSES_INDEXES:
+        cur.execute('drop index if exists {} on {}'.format(name, TABLE))
+    batch = []
+    for row in synthetic_rows(rows):
+        batch.append(row)
+        if len(batch) == 5000:
+            cur.executemany(
+                'insert into {} values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                    TABLE), batch)
+            batch = []
+    if batch:
+        cur.executemany(
+            'insert into {} values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                TABLE), batch)
+    cur.execute('analyze table ' + TABLE)
+    cur.fetchall()
+
+
+def measure(cur, repeats: int) -> dict:
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        cur.execute('explain ' + sql, params())
+        columns = [column[0] for column in cur.description]
+        plan = [dict(zip(columns, row)) for row in cur.fetchall()]
+        timings = []
+        for _ in range(repeats):
+            start = perf_counter()
+            cur.execute(sql, params())
+            cur.fetchall()
+            timings.append((perf_counter() - start) * 1000)
+        timings.sort()
+        results[name] = {
+            'explain': plan,
+            'median_ms': statistics.median(timings),
+            'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        }
+    return results
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    config = create_app().config
+    conn = mariadb.connect(host=config['DB_HOST'],
+                           port=config['DB_PORT'],
+                           user=config['DB_USER'],
+                           password=config['DB_PASSWORD'],
+                           database=config['DB_NAME'])
+    try:
+        cur = conn.cursor()
+        seed(cur, rows)
+        conn.commit()
+        before = measure(cur, repeats)
+        for name, columns in ELEPHANTCARCASSES_INDEXES:
+            cur.execute(create_index_statement(TABLE, name, columns))
+        cur.execute('analyze table ' + TABLE)
+        cur.fetchall()
+        after = measure(cur, repeats)
+        cur.execute('drop table ' + TABLE)
+    finally:
+        conn.close()
+    report = json.dumps(
+        {
+            'rows': rows,
+            'repeats': repeats,
+            'before': before,
+            'after': after
+        },
+        indent=2,
+        default=str)
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
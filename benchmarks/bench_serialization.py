@@ -0,0 +1,119 @@
+"""
+Compares the ways of serializing the full /mikerecords response: the former path, which built a record object with an
+instance dictionary per row and camelCased every key of every record, the slotted records with their precomputed
+key table, the row encoder that writes the JSON straight from the row tuples, and the compact format with its
+lookup tables. Needs no database. Results, including the size of each body, are printed as JSON.
+
+    python benchmarks/bench_serialization.py [records] [repeats]
+"""
+import json
+import re
+import sys
+import tracemalloc
+from os import path
+from timeit import timeit
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from app.models import MikeRecord
+from app.serialization import MIKE_RECORD_ENCODER, encode_compact_mike_rows
+
+
+def legacy_camelcase(string: str) -> str:
+    # what stringcase.camelcase did for every key
+    string = re.sub(r'^[\-_.]', '', str(string))
+    if not string:
+        return string
+    return string[0].lower() + re.sub(r'[\-_.\s]([a-z])',
+                                      lambda matched: matched.group(1).upper(),
+                                      string[1:])
+
+
+class LegacyMikeRecord:
+
+    def __init__(self, *values) -> None:
+        for field, value in zip(MikeRecord.FIELDS, values):
+            setattr(self, field, value)
+
+
+def legacy_path(rows) -> str:
+    records = [LegacyMikeRecord(*row) for row in rows]
+    return json.dumps([{
+        legacy_camelcase(key): val
+        for key, val in record.__dict__.items()
+    } for record in records])
+
+
+def slotted_path(rows) -> str:
+    return json.dumps(
+        [MikeRecord.from_tuple(row).to_camel_dict() for row in rows])
+
+
+def encoder_path(rows) -> str:
+    return MIKE_RECORD_ENCODER.encode_rows(rows)
+
+
+def compact_path(rows) -> str:
+    return encode_compact_mike_rows(rows)
+
+
+def expand_compact(document: dict) -> list:
+    return [
+        dict(**document['subregions'][subregion],
+             **document['countries'][country],
+             **document['sites'][site],
+             year=year,
+             carcasses=carcasses,
+             illegalCarcasses=illegal) for subregion, country, site, year,
+        carcasses, illegal in document['records']
+    ]
+
+
+def synthetic_rows(count: int):
+    sites = ['s{:02d}'.format(i) for i in range(60)]
+    return [('Africa', 'Central Africa', 'ca', 'Gabon', 'ga',
+             sites[i % len(sites)], 'Site ' + sites[i % len(sites)],
+             1990 + i // len(sites), i % 97, i % 41) for i in range(count)]
+
+
+def peak_kib(func, rows) -> float:
+    tracemalloc.start()
+    func(rows)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rows = synthetic_rows(count)
+    expected = json.loads(legacy_path(rows))
+    results = {}
+    for name, func in (('legacy', legacy_path), ('slotted', slotted_path),
+                       ('row_encoder', encoder_path), ('compact',
+                                                       compact_path)):
+        body = func(rows)
+        document = json.loads(body)
+        if (expand_compact(document)
+                if name == 'compact' else document) != expected:
+            raise AssertionError(name + ' produced a different document')
+        results[name] = {
+            'ms': timeit(lambda: func(rows), number=repeats) / repeats * 1000,
+            'peak_kib': peak_kib(func, rows),
+            'kib': len(body) / 1024,
+        }
+    for name in ('slotted', 'row_encoder', 'compact'):
+        results[name][
+            'speedup'] = results['legacy']['ms'] / results[name]['ms']
+    print(
+        json.dumps({
+            'records': count,
+            'repeats': repeats,
+            'results': results
+        },
+                   indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+"""
+Drives the read, login, upload and edit routes of the app with concurrent clients and reports the throughput, p50 and
+p99 latency, errors and peak memory of each scenario as JSON.
+
+The records are synthetic and seeded at the requested scale. By default they are kept in a SQLite database in a
+temporary folder, so no server is needed. With ``--backend mariadb`` they are written to the database configured in
+``instance/config.json``, which should be a scratch database: the seeded records overwrite any with the same keys.
+Requests go through Flask's test client, one per thread, so the app, its caches and the storage are measured without
+a network or a WSGI server in between.
+
+    python benchmarks/load_test.py --records 20000 --threads 8 --duration 10 --output results.json
+    python benchmarks/load_test.py --compare results.json --tolerance 0.2
+
+With ``--compare`` the new results are checked against earlier ones, and the script exits with status 1 if any
+scenario's throughput fell or its p99 latency rose by more than the tolerance.
+"""
+import argparse
+import csv
+import io
+import json
+import platform
+import resource
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from os import path
+from time import perf_counter
+from typing import Callable, Dict, List
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from app import create_app
+from app.auth import AuthProvider
+from app.backends import create_record_provider
+from app.datasheet import MIKE_CSV_COLUMNS
+from app.file_access import TextFileMasterPasswordProvider
+from app.models import MikeRecord
+from app.replica import ReplicatedRecordProvider
+from app.routes import register_routes, VALID_COUNTRY_CODES
+
+PASSWORD = 'load-test'
+COUNTRY_CODES = sorted(VALID_COUNTRY_CODES)
+SUBREGIONS = ['ca', 'wa']
+FIRST_YEAR = 2003
+YEARS = 16
+ID_CHARS = '0123456789abcdefghijklmnopqrstuvwxyz'
+SCENARIOS = ('mikerecords', 'mikerecords_query', 'countryrecords', 'login',
+             'upload', 'edit')
+
+
+def site_id(number: int) -> str:
+    return ''.join(ID_CHARS[number // len(ID_CHARS)**i % len(ID_CHARS)]
+                   for i in (2, 1, 0))
+
+
+def synthetic_records(count: int) -> List[MikeRecord]:
+    """
+    Returns ``count`` records spread over sites of YEARS years each, with the sites spread over the valid countries
+    """
+    records = []
+    for i in range(count):
+        site = i // YEARS
+        country_code = COUNTRY_CODES[site % len(COUNTRY_CODES)]
+        subregion_id = SUBREGIONS[site % len(SUBREGIONS)]
+        records.append(
+            MikeRecord('Africa', 'Subregion ' + subregion_id,
+                       subregion_id, 'Country ' + country_code, country_code,
+                       site_id(site), 'Site ' + str(site),
+                       FIRST_YEAR + i % YEARS, (i * 7) % 53, (i * 3) % 29))
+    return records
+
+
+def datasheet(records: List[MikeRecord]) -> bytes:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(MIKE_CSV_COLUMNS)
+    writer.writerows(record.to_tuple() for record in records)
+    return out.getvalue().encode('utf-8')
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def max_rss_kib() -> int:
+    # kibibytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def git_metadata() -> dict:
+    root = path.join(path.dirname(path.abspath(__file__)), '..')
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=root,
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True).stdout != ''
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def build_app(args, instance: str):
+    app = create_app({
+        'SECRET_KEY': secrets.token_hex(32),
+        'READ_REPLICA': args.replica,
+        'LOGIN_ATTEMPTS_PER_MINUTE': 1000000,
+        'LOGIN_ATTEMPT_BURST': 1000000,
+        'PASSWORD_HASH_WORKERS': args.threads,
+        'MAX_PENDING_PASSWORD_CHECKS': args.threads,
+    })
+    # the login attempts of the run are counted in its scratch folder
+    app.instance_path = instance
+    if args.backend == 'mariadb':
+        config = dict(create_app().config, STORAGE_BACKEND='mariadb')
+    else:
+        config = {'STORAGE_BACKEND': 'sqlite'}
+    db = create_record_provider(config, instance)
+    if config.get('DB_MIGRATE_ON_STARTUP', False):
+        db.migrate()
+    pwd_store = TextFileMasterPasswordProvider(instance, args.threads,
+                                               args.threads)
+    pwd_store.set_master_pwd(PASSWORD)
+    auth = AuthProvider(pwd_store, app.config['SECRET_KEY'])
+    records = ReplicatedRecordProvider(db) if args.replica else db
+    register_routes(app, records, records, auth, db, db, records)
+    return app, db
+
+
+def run_scenario(app, threads: int, duration: float,
+                 make_request: Callable) -> dict:
+    """
+    Sends requests from ``threads`` clients for ``duration`` seconds
+
+    :param make_request: called with the client, the number of the thread and the number of the request; returns the
+        response
+    """
+    latencies: List[List[float]] = [[] for _ in range(threads)]
+    errors = [0] * threads
+    start_barrier = threading.Barrier(threads + 1)
+
+    def work(number: int):
+        client = app.test_client()
+        start_barrier.wait()
+        deadline = perf_counter() + duration
+        count = 0
+        while perf_counter() < deadline:
+            started = perf_counter()
+            res = make_request(client, number, count)
+            latencies[number].append(perf_counter() - started)
+            if res.status_code >= 400:
+                errors[number] += 1
+            res.close()
+            count += 1
+
+    workers = [
+        threading.Thread(target=work, args=(number, ))
+        for number in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    start_barrier.wait()
+    started = perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = perf_counter() - started
+    ordered = sorted(latency for thread_latencies in latencies
+                     for latency in thread_latencies)
+    return {
+        'requests': len(ordered),
+        'errors': sum(errors),
+        'throughput': len(ordered) / elapsed,
+        'p50_ms': percentile(ordered, 0.5) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'max_rss_kib': max_rss_kib(),
+    }
+
+
+def scenarios(app, records: List[MikeRecord],
+              upload_rows: int) -> Dict[str, Callable]:
+    client = app.test_client()
+    token = client.post('/login', json={
+        'password': PASSWORD
+    }).get_json()['token']
+    auth_header = {'Authorization': 'Bearer ' + token}
+    upload = datasheet(records[:upload_rows])
+
+    def edit(client, number: int, count: int):
+        # each thread adds a record of its own site every time and removes the one it added before
+        site = 'z' + ID_CHARS[number // len(ID_CHARS) %
+                              len(ID_CHARS)] + ID_CHARS[number % len(ID_CHARS)]
+        record = {
+            'unRegion': 'Africa',
+            'subregionName': 'Subregion ca',
+            'subregionId': 'ca',
+            'countryName': 'Country ga',
+            'countryCode': 'ga',
+            'mikeSiteId': site,
+            'mikeSiteName': 'Edited',
+            'year': count,
+            'carcasses': 10,
+            'illegalCarcasses': 4
+        }
+        removed = [{
+            'mikeSiteId': site,
+            'year': count - 1
+        }] if count > 0 else []
+        return client.post('/admin/edit',
+                           json={
+                               'added': [record],
+                               'removed': removed
+                           },
+                           headers=auth_header)
+
+    return {
+        'mikerecords':
+        lambda client, number, count: client.get('/mikerecords'),
+        'mikerecords_query':
+        lambda client, number, count: client.get(
+            '/mikerecords?countryCode={}&yearFrom={}&limit=100'.format(
+                COUNTRY_CODES[count % len(COUNTRY_CODES)], FIRST_YEAR + count %
+                YEARS)),
+        'countryrecords':
+        lambda client, number, count: client.get('/countryrecords'),
+        'login':
+        lambda client, number, count: client.post('/login',
+                                                  json={'password': PASSWORD}),
+        'upload':
+        lambda client, number, count: client.post(
+            '/admin/upload',
+            headers=auth_header,
+            content_type='multipart/form-data',
+            data={'mike_datasheet': (io.BytesIO(upload), 'mike.csv')}),
+        'edit':
+        edit,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Returns a description of every scenario that regressed by more than ``tolerance`` compared with the baseline
+    """
+    regressions = []
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        if current['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append('{}: throughput {:.1f}/s, was {:.1f}/s'.format(
+                name, current['throughput'], before['throughput']))
+        if current['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append('{}: p99 {:.2f} ms, was {:.2f} ms'.format(
+                name, current['p99_ms'], before['p99_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the API routes')
+    parser.add_argument('--backend',
+                        choices=('sqlite', 'mariadb'),
+                        default='sqlite')
+    parser.add_argument('--records',
+                        type=int,
+                        default=10000,
+                        help='number of MIKE records to seed')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=5.0,
+                        help='seconds each scenario runs for')
+    parser.add_argument('--upload-rows',
+                        type=int,
+                        default=500,
+                        help='rows in each uploaded datasheet')
+    parser.add_argument('--scenarios',
+                        default=','.join(SCENARIOS),
+                        help='comma separated scenarios to run')
+    parser.add_argument('--replica',
+                        action='store_true',
+                        help='serve reads from the in-memory replica')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--compare',
+                        metavar='BASELINE',
+                        help='results to check these against')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.1,
+                        help='allowed relative regression')
+    args = parser.parse_args()
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(unknown))
+
+    instance = tempfile.mkdtemp(prefix='mike-load-test-')
+    try:
+        app, db = build_app(args, instance)
+        records = synthetic_records(args.records)
+        started = perf_counter()
+        db.add_or_overwrite_mike_records(records)
+        seed_seconds = perf_counter() - started
+        requests = scenarios(app, records, args.upload_rows)
+        results = {}
+        for name in names:
+            results[name] = run_scenario(app, args.threads, args.duration,
+                                         requests[name])
+            print(
+                '{}: {:.1f} requests/s, p50 {:.2f} ms, p99 {:.2f} ms, {} errors'
+                .format(name, results[name]['throughput'],
+                        results[name]['p50_ms'], results[name]['p99_ms'],
+                        results[name]['errors']),
+                file=sys.stderr)
+    finally:
+        shutil.rmtree(instance, ignore_errors=True)
+
+    report = {
+        'date': datetime.now(timezone.utc).isoformat(),
+        'git': git_metadata(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'backend': args.backend,
+            'records': args.records,
+            'threads': args.threads,
+            'duration': args.duration,
+            'upload_rows': args.upload_rows,
+            'replica': args.replica
+        },
+        'seed_seconds': seed_seconds,
+        'scenarios': results,
+    }
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(encoded)
+    print(encoded)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != report['parameters']:
+            print('The baseline was run with other parameters: {}'.format(
+                baseline.get('parameters')),
+                  file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression in ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
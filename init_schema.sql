@@ -2,6 +2,10 @@
 -- create database
 -- create all tables
 -- create user?
+--
+-- This only creates the tables. The secondary indexes and the schema_migrations table that records the schema version
+-- are created by the migrations in app/data_access.py, so run `python manage_db.py migrate` right after this file,
+-- or start the app with DB_MIGRATE_ON_STARTUP set to true. The migrations are safe to run over these tables.
 CREATE DATABASE IF NOT EXISTS all_ears;
 
 CREATE TABLE IF NOT EXISTS all_ears.elephantcarcasses
@@ -19,6 +23,52 @@ CREATE TABLE IF NOT EXISTS all_ears.elephantcarcasses
     PRIMARY KEY (mike_site_id, mike_year)
 );
 
+-- Per country per year totals of elephantcarcasses, kept up to date by the app.
+-- Rebuild it with `python manage_db.py rebuild-country-totals` after changing elephantcarcasses by hand.
+CREATE TABLE IF NOT EXISTS all_ears.country_year_totals
+(
+    country_code      char(2)   not null,
+    mike_year         int       not null,
+    country_name      char(100) not null,
+    carcasses         int       not null,
+    illegal_carcasses int       not null,
+    PRIMARY KEY (country_code, mike_year)
+);
+
+-- Background jobs such as imports from the MIKE database
+CREATE TABLE IF NOT EXISTS all_ears.jobs
+(
+    job_id      char(32)     not null,
+    kind        varchar(50)  not null,
+    status      varchar(20)  not null,
+    created_at  datetime(3)  not null,
+    started_at  datetime(3)  null,
+    finished_at datetime(3)  null,
+    progress    text         not null,
+    result      mediumtext   null,
+    message     varchar(500) null,
+    PRIMARY KEY (job_id)
+);
+
+-- What was last imported from the MIKE database
+CREATE TABLE IF NOT EXISTS all_ears.sync_sources
+(
+    name          varchar(50)  not null,
+    etag          varchar(200) null,
+    last_modified varchar(50)  null,
+    digest        char(64)     not null,
+    synced_at     timestamp    not null default current_timestamp on update current_timestamp,
+    PRIMARY KEY (name)
+);
+
+CREATE TABLE IF NOT EXISTS all_ears.mike_sync_rows
+(
+    mike_site_id char(3)  not null,
+    mike_year    int      not null,
+    fingerprint  char(32) not null,
+    PRIMARY KEY (mike_site_id, mike_year)
+);
+
 -- Alter username, host, and password to fit db setup desire
 CREATE USER IF NOT EXISTS 'admin'@'localhost' IDENTIFIED BY 'password';
 
@@ -1,10 +1,36 @@
 from app import create_app
-from app.data_access import MariaDBRecordProvider, TextFileMasterPasswordProvider
-from app.routes import register_routes
+from app.backends import create_record_provider
+from app.file_access import TextFileMasterPasswordProvider
+from app.routes import register_routes, register_metrics_routes
+from app.metrics import MetricsRegistry, SlowRequestProfiler
 from app.auth import AuthProvider
+from app.replica import ReplicatedRecordProvider
+from os import path
 
 app = create_app()
-db = MariaDBRecordProvider(app.config)
-pwd_store = TextFileMasterPasswordProvider(app.instance_path)
-auth = AuthProvider(pwd_store, app.config['SECRET_KEY'])
-register_routes(app, db, db, auth)
+db = create_record_provider(app.config, app.instance_path)
+if app.config.get('DB_MIGRATE_ON_STARTUP', False):
+    db.migrate()
+pwd_store = TextFileMasterPasswordProvider(
+    app.instance_path, app.config.get('PASSWORD_HASH_WORKERS', 1),
+    app.config.get('MAX_PENDING_PASSWORD_CHECKS', 4))
+auth = AuthProvider(pwd_store,
+                    app.config.get('SECRET_KEYS') or app.config['SECRET_KEY'],
+                    app.config.get('SECRET_KEY_ID'),
+                    app.config.get('TOKEN_CACHE_SIZE', 1024))
+records = ReplicatedRecordProvider(db) if app.config.get(
+    'READ_REPLICA', False) else db
+register_routes(app, records, records, auth, db, db, records)
+if app.config.get('METRICS_ENABLED', False):
+    profiler = None
+    if app.config.get('PROFILE_SAMPLE_RATE', 0) > 0:
+        profiler = SlowRequestProfiler(
+            path.join(app.instance_path, 'profiles'),
+            app.config['PROFILE_SAMPLE_RATE'],
+            app.config.get('PROFILE_SLOW_REQUEST_SECONDS', 1.0),
+            app.config.get('PROFILE_MAX_FILES', 50))
+    register_metrics_routes(
+        app,
+        MetricsRegistry(path.join(app.instance_path, 'metrics'),
+                        app.config.get('METRICS_FLUSH_INTERVAL', 5.0),
+                        getattr(db, 'get_pool_stats', None)), profiler)
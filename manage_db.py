@@ -0,0 +1,68 @@
+from app import create_app
+from app.backends import create_record_provider
+from sys import argv, stderr, exit
+
+USAGE = (
+    'Usage: python manage_db.py <command>\n'
+    'Commands:\n'
+    '    migrate                   apply pending schema migrations\n'
+    '    schema-version            print the current schema version\n'
+    '    rebuild-country-totals    recompute the country_year_totals table\n'
+    '    check-country-totals      report country totals that do not match the MIKE records'
+)
+
+
+def migrate(db) -> int:
+    applied = db.migrate()
+    if len(applied) == 0:
+        print('The schema is up to date.')
+    for version in applied:
+        print('Applied migration {}.'.format(version))
+    return 0
+
+
+def schema_version(db) -> int:
+    print('Schema version {} (latest is {}).'.format(db.get_schema_version(),
+                                                     db.MIGRATIONS[-1][0]))
+    return 0
+
+
+def rebuild_country_totals(db) -> int:
+    db.rebuild_country_totals()
+    print('The country totals have been rebuilt.')
+    return 0
+
+
+def check_country_totals(db) -> int:
+    mismatched = db.check_country_totals()
+    if len(mismatched) == 0:
+        print('The country totals are consistent.')
+        return 0
+    for country_code, year in mismatched:
+        print('Inconsistent totals for country {} in {}'.format(
+            country_code, year),
+              file=stderr)
+    print('Run "python manage_db.py rebuild-country-totals" to fix them.',
+          file=stderr)
+    return 1
+
+
+COMMANDS = {
+    'migrate': migrate,
+    'schema-version': schema_version,
+    'rebuild-country-totals': rebuild_country_totals,
+    'check-country-totals': check_country_totals,
+}
+
+
+def main():
+    if len(argv) != 2 or argv[1] not in COMMANDS:
+        print(USAGE, file=stderr)
+        exit(1)
+    app = create_app()
+    db = create_record_provider(app.config, app.instance_path)
+    exit(COMMANDS[argv[1]](db))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from app.data_access import TextFileMasterPasswordProvider
+from app.file_access import TextFileMasterPasswordProvider
 from sys import argv, stderr, exit
 from os import path
 
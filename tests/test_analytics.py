@@ -0,0 +1,105 @@
+"""
+Checks the PIKE trends derived from yearly totals.
+"""
+import pytest
+
+from app.analytics import pike, trend_series
+from app.routes import parse_trend_query
+
+
+def test_pike_is_the_share_of_illegal_carcasses():
+    assert pike(8, 2) == 0.25
+    assert pike(3, 3) == 1.0
+    assert pike(5, 0) == 0.0
+    assert pike(0, 0) is None
+
+
+def test_no_totals_give_no_series():
+    assert trend_series([]) == []
+    assert trend_series([], window=3, year_from=2010) == []
+
+
+def test_single_year_has_no_year_over_year_change():
+    [series] = trend_series([('ga', 'Gabon', 2010, 4, 1)], window=3)
+    assert (series['group'], series['name'], series['carcasses'],
+            series['illegalCarcasses'], series['pike']) == ('ga', 'Gabon', 4,
+                                                            1, 0.25)
+    [point] = series['years']
+    assert (point['year'], point['pike'], point['rollingPike'],
+            point['yearOverYear']) == (2010, 0.25, 0.25, None)
+
+
+def test_rolling_pike_sums_the_carcasses_of_the_window():
+    totals = [('ga', 'Gabon', 2010, 10, 1), ('ga', 'Gabon', 2011, 10, 3),
+              ('ga', 'Gabon', 2012, 20, 14), ('ga', 'Gabon', 2013, 0, 0)]
+    [series] = trend_series(totals, window=2)
+    assert [point['rollingPike'] for point in series['years']
+            ] == [0.1, pytest.approx(0.2),
+                  pytest.approx(17 / 30), 0.7]
+    assert [point['pike']
+            for point in series['years']] == [0.1, 0.3, 0.7, None]
+
+
+def test_missing_years_count_as_no_carcasses():
+    totals = [('ga', 'Gabon', 2010, 10, 5), ('ga', 'Gabon', 2013, 10, 1)]
+    [series] = trend_series(totals, window=3)
+    # 2010 is more than three years before 2013, so it left the window
+    assert series['years'][1]['rollingPike'] == 0.1
+    [series] = trend_series(totals, window=4)
+    assert series['years'][1]['rollingPike'] == 0.3
+
+
+def test_year_over_year_needs_both_years():
+    totals = [('ga', 'Gabon', 2010, 10, 1), ('ga', 'Gabon', 2011, 10, 4),
+              ('ga', 'Gabon', 2012, 0, 0), ('ga', 'Gabon', 2013, 10, 2),
+              ('ga', 'Gabon', 2015, 10, 5)]
+    [series] = trend_series(totals)
+    changes = [point['yearOverYear'] for point in series['years']]
+    # 2012 has no PIKE, so neither it nor 2013 has a change, and 2014 is missing
+    assert changes == [None, pytest.approx(0.3), None, None, None]
+
+
+def test_years_before_year_from_only_feed_the_window():
+    totals = [('ga', 'Gabon', 2010, 10, 9), ('ga', 'Gabon', 2011, 10, 1),
+              ('gh', 'Ghana', 2010, 5, 5)]
+    series = trend_series(totals, window=2, year_from=2011)
+    # Ghana has no year left to report, so it has no series at all
+    assert [s['group'] for s in series] == ['ga']
+    [point] = series[0]['years']
+    assert point['rollingPike'] == 0.5
+    assert point['yearOverYear'] == pytest.approx(-0.8)
+    assert (series[0]['carcasses'], series[0]['illegalCarcasses'],
+            series[0]['pike']) == (10, 1, 0.1)
+
+
+def test_groups_are_kept_apart():
+    totals = [('ga', 'Gabon', 2010, 10, 5), ('gh', 'Ghana', 2011, 10, 1)]
+    series = trend_series(totals, window=5)
+    assert [(s['group'], s['years'][0]['rollingPike'],
+             s['years'][0]['yearOverYear'])
+            for s in series] == [('ga', 0.5, None), ('gh', 0.1, None)]
+
+
+def test_group_without_carcasses_has_no_pike():
+    [series] = trend_series([('ga', 'Gabon', 2010, 0, 0)], window=2)
+    assert series['pike'] is None
+    assert series['years'][0]['rollingPike'] is None
+
+
+def test_query_starts_early_enough_to_fill_the_first_window():
+    query, window, year_from = parse_trend_query({
+        'window': '3',
+        'yearFrom': '2012',
+        'groupBy': 'site'
+    })
+    assert (query.year_from, query.group_by, window,
+            year_from) == (2010, 'site', 3, 2012)
+    query, window, year_from = parse_trend_query({})
+    assert (query.year_from, query.group_by, window,
+            year_from) == (None, 'country', 1, None)
+
+
+@pytest.mark.parametrize('window', ['0', '-1', '51', 'x'])
+def test_malformed_window_is_rejected(window):
+    with pytest.raises(ValueError):
+        parse_trend_query({'window': window})
@@ -0,0 +1,209 @@
+"""
+Checks the login token cache, the login rate limiters and the limits on concurrent password checks.
+"""
+import threading
+from typing import List
+
+import pytest
+
+import app.auth
+from app.auth import AuthProvider, VerifiedTokenCache, LoginRateLimiter, SharedLoginRateLimiter
+from app.file_access import TextFileMasterPasswordProvider
+from app.models import MasterPasswordProvider, PasswordCheckBusyError
+
+
+class FixedPasswordProvider(MasterPasswordProvider):
+
+    def verify_pwd(self, plain_pwd: str) -> bool:
+        return plain_pwd == 'password'
+
+    def set_master_pwd(self, new_pwd: str):
+        pass
+
+
+class Clock:
+    """
+    Stands in for the time functions of app.auth, so buckets refill without waiting
+    """
+
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.auth, 'monotonic', clock)
+    monkeypatch.setattr(app.auth, 'time', clock)
+    return clock
+
+
+def test_token_cache_forgets_the_least_recently_used_token():
+    cache = VerifiedTokenCache(max_entries=2)
+    a, b, c = (cache.digest(token) for token in ('a', 'b', 'c'))
+    cache.put(a, 100, None)
+    cache.put(b, 100, None)
+    assert cache.get(a, 0) is not None
+    cache.put(c, 100, None)
+    assert cache.get(b, 0) is None
+    assert cache.get(a, 0) == (100, None)
+
+
+def test_token_cache_drops_expired_tokens():
+    cache = VerifiedTokenCache()
+    digest = cache.digest('token')
+    cache.put(digest, 100, 'k1')
+    assert cache.get(digest, 99) == (100, 'k1')
+    assert cache.get(digest, 100) is None
+
+
+def test_token_signature_is_verified_once(monkeypatch):
+    auth = AuthProvider(FixedPasswordProvider(), 'x' * 32)
+    token = auth.generate_new_token()
+    verified: List[str] = []
+    verify = auth._verify
+
+    def counting_verify(token: str):
+        verified.append(token)
+        return verify(token)
+
+    monkeypatch.setattr(auth, '_verify', counting_verify)
+    assert auth.is_logged_in(token)
+    assert auth.is_logged_in(token)
+    assert verified == [token]
+    assert not auth.is_logged_in(token + 'x')
+
+
+def test_cached_token_is_revoked_with_its_secret():
+    auth = AuthProvider(FixedPasswordProvider(), {
+        'old': 'o' * 32,
+        'new': 'n' * 32
+    }, 'old')
+    token = auth.generate_new_token()
+    assert auth.is_logged_in(token)
+    del auth.secrets['old']
+    assert not auth.is_logged_in(token)
+
+
+def test_client_is_locked_out_after_its_burst(clock):
+    limiter = LoginRateLimiter(per_minute=6, burst=2)
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('a') == pytest.approx(10)
+    # other clients have buckets of their own
+    assert limiter.try_acquire('b') == 0
+
+
+def test_bucket_refills_with_time(clock):
+    limiter = LoginRateLimiter(per_minute=6, burst=2)
+    for _ in range(2):
+        limiter.try_acquire('a')
+    clock.now += 5
+    assert limiter.try_acquire('a') == pytest.approx(5)
+    clock.now += 5
+    assert limiter.try_acquire('a') == 0
+    # a bucket fills up to the burst and no further
+    clock.now += 3600
+    assert [limiter.try_acquire('a') for _ in range(3)][-1] > 0
+
+
+def test_limiter_forgets_the_least_recently_seen_clients(clock):
+    limiter = LoginRateLimiter(per_minute=6, burst=1, max_clients=2)
+    for client in ('a', 'b', 'c'):
+        limiter.try_acquire(client)
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('c') > 0
+
+
+def test_limiters_on_the_same_file_share_the_buckets(tmp_path, clock):
+    db_file = str(tmp_path / 'login_attempts.sqlite3')
+    first = SharedLoginRateLimiter(db_file, per_minute=6, burst=2)
+    second = SharedLoginRateLimiter(db_file, per_minute=6, burst=2)
+    assert first.try_acquire('a') == 0
+    assert second.try_acquire('a') == 0
+    assert first.try_acquire('a') == pytest.approx(10)
+    assert second.try_acquire('a') == pytest.approx(10)
+    clock.now += 10
+    assert second.try_acquire('a') == 0
+    assert first.try_acquire('a') > 0
+
+
+def test_shared_limiter_deletes_buckets_that_filled_up(tmp_path, clock):
+    db_file = str(tmp_path / 'login_attempts.sqlite3')
+    limiter = SharedLoginRateLimiter(db_file, per_minute=6, burst=2)
+    limiter.try_acquire('a')
+    clock.now += 21
+    limiter.try_acquire('b')
+    rows = limiter._connection().execute(
+        'select client from login_buckets').fetchall()
+    assert rows == [('b', )]
+
+
+def test_shared_limiter_counts_in_memory_without_its_file(tmp_path, clock):
+    # the file's folder cannot be created under a regular file
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+    limiter = SharedLoginRateLimiter(str(blocker / 'login_attempts.sqlite3'),
+                                     per_minute=6,
+                                     burst=1)
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('a') > 0
+
+
+class BlockingPasswordProvider(TextFileMasterPasswordProvider):
+    """
+    Holds every check until ``release`` is set
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _verify(self, master_pwd_hash: str, plain_pwd: str) -> bool:
+        self.started.set()
+        self.release.wait(10)
+        return super()._verify(master_pwd_hash, plain_pwd)
+
+
+def check_in_background(provider: BlockingPasswordProvider,
+                        results: list) -> threading.Thread:
+    thread = threading.Thread(
+        target=lambda: results.append(provider.verify_pwd('password')))
+    thread.start()
+    assert provider.started.wait(10)
+    return thread
+
+
+def test_check_is_turned_away_while_every_hash_thread_is_busy(tmp_path):
+    provider = BlockingPasswordProvider(str(tmp_path),
+                                        workers=1,
+                                        max_pending=4)
+    provider.set_master_pwd('password')
+    results: list = []
+    thread = check_in_background(provider, results)
+    with pytest.raises(PasswordCheckBusyError):
+        provider.verify_pwd('password')
+    provider.release.set()
+    thread.join()
+    assert results == [True]
+    assert provider.verify_pwd('password')
+
+
+def test_check_slots_are_shared_by_providers_of_one_folder(tmp_path):
+    first = BlockingPasswordProvider(str(tmp_path), workers=2, max_pending=1)
+    second = TextFileMasterPasswordProvider(str(tmp_path),
+                                            workers=2,
+                                            max_pending=1)
+    first.set_master_pwd('password')
+    results: list = []
+    thread = check_in_background(first, results)
+    with pytest.raises(PasswordCheckBusyError):
+        second.verify_pwd('password')
+    first.release.set()
+    thread.join()
+    assert second.verify_pwd('password')
+    assert not second.verify_pwd('wrong')
@@ -0,0 +1,69 @@
+"""
+Checks the bounds and version checks of ResponseCache.
+"""
+from app.cache import ResponseCache
+
+
+def test_least_recently_used_entry_is_evicted_by_count():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', 'v1', b'a')
+    cache.put('b', 'v1', b'b')
+    # reading an entry makes it the most recently used
+    assert cache.get('a', 'v1') == b'a'
+    cache.put('c', 'v1', b'c')
+    assert cache.get('b', 'v1') is None
+    assert (cache.get('a', 'v1'), cache.get('c', 'v1')) == (b'a', b'c')
+
+
+def test_entries_are_evicted_by_bytes_counting_every_encoding():
+    cache = ResponseCache(max_entries=10, max_bytes=10)
+    cache.put('a', 'v1', b'aaaa')
+    cache.put('a', 'v1', b'aa', 'gzip')
+    cache.put('b', 'v1', b'bbbb')
+    assert cache.size == 10
+    cache.put('b', 'v1', b'b', 'gzip')
+    assert cache.get('a', 'v1') is None
+    assert cache.size == 5
+
+
+def test_replacing_a_variant_counts_only_its_new_size():
+    cache = ResponseCache(max_bytes=10)
+    cache.put('a', 'v1', b'aaaaaaaa', 'gzip')
+    cache.put('a', 'v1', b'aa', 'gzip')
+    assert cache.size == 2
+    assert cache.get('a', 'v1', 'gzip') == b'aa'
+
+
+def test_entry_larger_than_the_bound_is_kept_alone():
+    cache = ResponseCache(max_bytes=4)
+    cache.put('a', 'v1', b'aa')
+    cache.put('b', 'v1', b'bbbbbbbb')
+    assert cache.get('a', 'v1') is None
+    assert cache.get('b', 'v1') == b'bbbbbbbb'
+
+
+def test_new_version_invalidates_the_entry_and_its_variants():
+    cache = ResponseCache()
+    cache.put('a', 'v1', b'body')
+    cache.put('a', 'v1', b'zipped', 'gzip')
+    assert cache.get('a', 'v2') is None
+    assert cache.get('a', 'v1') is None, 'a stale entry was kept'
+    assert cache.size == 0
+
+
+def test_storing_a_new_version_drops_the_older_variants():
+    cache = ResponseCache()
+    cache.put('a', 'v1', b'body')
+    cache.put('a', 'v1', b'zipped', 'gzip')
+    cache.put('a', 'v2', b'new body')
+    assert cache.get('a', 'v2') == b'new body'
+    assert cache.get('a', 'v2', 'gzip') is None
+    assert cache.size == len(b'new body')
+
+
+def test_clear_empties_the_cache():
+    cache = ResponseCache()
+    cache.put('a', 'v1', b'body')
+    cache.clear()
+    assert cache.get('a', 'v1') is None
+    assert cache.size == 0
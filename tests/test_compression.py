@@ -0,0 +1,110 @@
+"""
+Checks how ResponseCompressor picks an encoding from the Accept-Encoding header and that its bodies decompress back.
+"""
+import gzip
+
+import pytest
+from werkzeug.http import parse_accept_header
+
+import app.compression
+from app.compression import DEFAULT_MIN_SIZE, ResponseCompressor
+
+BODY = b'[{"countryName":"Gabon","year":2010}]' * 100
+
+# brotli and zstandard are optional, so the checks that offer them are skipped without them
+needs_every_encoding = pytest.mark.skipif(app.compression.brotli is None
+                                          or app.compression.zstandard is None,
+                                          reason='needs brotli and zstandard')
+
+
+@pytest.fixture
+def gzip_only(monkeypatch):
+    monkeypatch.setattr(app.compression, 'brotli', None)
+    monkeypatch.setattr(app.compression, 'zstandard', None)
+    return ResponseCompressor()
+
+
+def negotiate(compressor: ResponseCompressor, header: str, **kwargs):
+    return compressor.negotiate(parse_accept_header(header), **kwargs)
+
+
+@needs_every_encoding
+@pytest.mark.parametrize(
+    'header,encoding',
+    [
+        ('gzip;q=1.0, br;q=0.5, zstd;q=0.2', 'gzip'),
+        ('br;q=0.8, gzip;q=0.5', 'br'),
+        # ties go to the first of CONTENT_ENCODINGS
+        ('gzip, br, zstd', 'zstd'),
+        ('gzip, br', 'br'),
+        ('*', 'zstd'),
+        ('*;q=0.5, gzip', 'gzip'),
+        # q=0 refuses an encoding the wildcard would allow
+        ('zstd;q=0, *', 'br'),
+        ('gzip;q=0.5, identity', None),
+        ('identity;q=0.9, br;q=0.9', 'br'),
+        ('*;q=0', None),
+        ('deflate', None),
+        ('', None),
+    ])
+def test_highest_q_value_wins(header, encoding):
+    assert negotiate(ResponseCompressor(), header) == encoding
+
+
+@pytest.mark.parametrize('header,encoding', [
+    ('br, zstd', None),
+    ('br, gzip;q=0.1', 'gzip'),
+    ('*', 'gzip'),
+    ('gzip;q=0, *', None),
+])
+def test_missing_packages_leave_gzip(gzip_only, header, encoding):
+    assert list(gzip_only.encoders) == ['gzip']
+    assert negotiate(gzip_only, header) == encoding
+
+
+@needs_every_encoding
+def test_streams_are_only_sent_as_gzip():
+    compressor = ResponseCompressor()
+    assert negotiate(compressor, 'zstd, br, gzip;q=0.1', stream=True) == 'gzip'
+    assert negotiate(compressor, 'zstd, br', stream=True) is None
+
+
+def test_bodies_under_the_minimum_size_are_sent_as_they_are(gzip_only):
+    assert negotiate(gzip_only, 'gzip', size=DEFAULT_MIN_SIZE - 1) is None
+    assert negotiate(gzip_only, 'gzip', size=DEFAULT_MIN_SIZE) == 'gzip'
+    # without a size the body is taken to be large enough
+    assert negotiate(gzip_only, 'gzip') == 'gzip'
+    assert negotiate(ResponseCompressor(min_size=0), 'gzip', size=0) == 'gzip'
+
+
+def test_config_sets_the_minimum_size_and_can_turn_compression_off():
+    compressor = ResponseCompressor.from_config({'COMPRESSION_MIN_SIZE': 10})
+    assert negotiate(compressor, 'gzip', size=9) is None
+    assert negotiate(compressor, 'gzip', size=10) == 'gzip'
+    disabled = ResponseCompressor.from_config({'COMPRESS_RESPONSES': False})
+    assert negotiate(disabled, 'gzip, br, zstd, *') is None
+
+
+def test_bodies_decompress_to_what_was_compressed():
+    compressor = ResponseCompressor()
+    decompress = {'gzip': gzip.decompress}
+    if app.compression.brotli is not None:
+        decompress['br'] = app.compression.brotli.decompress
+    if app.compression.zstandard is not None:
+        decompress['zstd'] = app.compression.zstandard.ZstdDecompressor(
+        ).decompress
+    assert sorted(compressor.encoders) == sorted(decompress)
+    for encoding, encoder in compressor.encoders.items():
+        payload = compressor.compress(encoding, BODY)
+        assert len(payload) < len(BODY)
+        assert decompress[encoding](payload) == BODY
+    # gzip bodies come out the same every time, so their ETag can be reused
+    assert compressor.compress('gzip',
+                               BODY) == compressor.compress('gzip', BODY)
+
+
+def test_streamed_gzip_decompresses_to_the_chunks():
+    compressor = ResponseCompressor()
+    chunks = [BODY[i:i + 100] for i in range(0, len(BODY), 100)]
+    assert gzip.decompress(b''.join(compressor.compress_stream(
+        iter(chunks)))) == BODY
@@ -0,0 +1,318 @@
+"""
+Checks that storage backends behave the same, by running the same checks against the provider of each one and
+comparing its answers with ones computed in Python.
+
+The SQLite backend is checked in a temporary folder. Any other backend is checked against the database configured in
+instance/config.json, and only when named in the comma separated CONFORMANCE_BACKENDS environment variable, because
+the checks delete every MIKE record in it. Each backend is checked again behind a ReplicatedRecordProvider, as it runs
+with READ_REPLICA set.
+"""
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from typing import DefaultDict, List
+
+import pytest
+
+from app import create_app
+from app.backends import STORAGE_BACKENDS
+from app.columnar import read_columnar
+from app.replica import ReplicatedRecordProvider
+from app.models import MikeRecord, CountryRecord, MikeRecordQuery, TotalsQuery, EditResult, SyncSource, Job, \
+    InvalidPrimaryKeyOperationError
+
+SITES = ['a{:02d}'.format(i) for i in range(12)]
+COUNTRIES = ['ga', 'cd', 'cg', 'cm']
+SUBREGIONS = ['ca', 'wa']
+
+
+def sample_records() -> List[MikeRecord]:
+    records = []
+    for i, site in enumerate(SITES):
+        for year in range(2010, 2016):
+            records.append(
+                MikeRecord('Africa', 'Subregion ' + SUBREGIONS[i % 2],
+                           SUBREGIONS[i % 2], 'Country ' + COUNTRIES[i % 4],
+                           COUNTRIES[i % 4], site, 'Site ' + site, year,
+                           (i * 7 + year) % 23, (i * 3 + year) % 11))
+    return records
+
+
+def reset(db):
+    # a synchronization with an empty datasheet forgets the rows of earlier ones
+    db.sync_mike_records([])
+    db.remove_mike_records(
+        [record.get_primary_key() for record in db.iter_mike_records()])
+
+
+def rows_by_key(db) -> dict:
+    return {
+        MikeRecord.from_tuple(row).get_primary_key(): tuple(row)
+        for row in db.iter_mike_record_rows()
+    }
+
+
+def expected_country_rows(records: List[MikeRecord]) -> List[tuple]:
+    # the name, carcasses and illegal carcasses of each country and year
+    totals: DefaultDict[tuple, list] = defaultdict(lambda: ['', 0, 0])
+    for record in records:
+        total = totals[(record.country_code, record.year)]
+        total[0] = max(total[0], record.country_name)
+        total[1] += record.carcasses
+        total[2] += record.illegal_carcasses
+    return [(name, code, year, carcasses, illegal)
+            for (code, year), (name, carcasses,
+                               illegal) in sorted(totals.items())]
+
+
+class ReplicaOverStore(ReplicatedRecordProvider):
+    """
+    Serves what a replica serves from its copy and leaves the rest, such as jobs and exports, to the store, as main.py
+    wires them when READ_REPLICA is set
+    """
+
+    def __getattr__(self, name: str):
+        return getattr(self._store, name)
+
+
+@pytest.fixture(scope='module',
+                params=[(name, replicated) for name in sorted(STORAGE_BACKENDS)
+                        for replicated in (False, True)],
+                ids=lambda param: param[0] + ('-replica' if param[1] else ''))
+def provider(request):
+    name, replicated = request.param
+    if name != 'sqlite' and name not in os.environ.get('CONFORMANCE_BACKENDS',
+                                                       '').split(','):
+        pytest.skip(
+            'checking {} deletes every MIKE record in the configured database; opt in with '
+            'CONFORMANCE_BACKENDS={}'.format(name, name))
+    instance = tempfile.mkdtemp(prefix='conformance-')
+    try:
+        config = dict(create_app().config) if name != 'sqlite' else {}
+        config['STORAGE_BACKEND'] = name
+        db = STORAGE_BACKENDS[name](config, instance)
+        db.migrate()
+        if replicated:
+            db = ReplicaOverStore(db)
+        yield db
+        reset(db)
+    finally:
+        shutil.rmtree(instance, ignore_errors=True)
+
+
+@pytest.fixture
+def db(provider):
+    reset(provider)
+    return provider
+
+
+def test_add_and_get(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    assert rows_by_key(db) == {
+        record.get_primary_key(): record.to_tuple()
+        for record in records
+    }
+    first = records[0]
+    assert db.get_mike_record(
+        first.get_primary_key()).to_tuple() == first.to_tuple()
+    assert db.get_mike_record(MikeRecord.PrimaryKey('zzz', 1999)) is None
+
+
+def test_duplicate_add(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    version = db.get_data_version()
+    fresh = MikeRecord('Africa', 'x', 'ca', 'Country ga', 'ga', 'b00',
+                       'Site b00', 2010, 1, 1)
+    try:
+        db.add_mike_records([fresh, records[3]])
+    except InvalidPrimaryKeyOperationError as e:
+        assert e.record.get_primary_key() == records[3].get_primary_key()
+    else:
+        raise AssertionError('adding a stored key did not fail')
+    assert db.get_mike_record(
+        fresh.get_primary_key()) is None, 'the failed add was not rolled back'
+    assert db.get_data_version(
+    ).token == version.token, 'a failed write changed the data version'
+
+
+def test_overwrite_update_remove(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    version = db.get_data_version()
+    changed = MikeRecord.from_tuple(records[0].to_tuple()[:8] + (99, 42))
+    added = MikeRecord('Africa', 'x', 'ca', 'Country ga', 'ga', 'b01',
+                       'Site b01', 2012, 5, 2)
+    db.add_or_overwrite_mike_records([changed, added])
+    assert db.get_data_version(
+    ).token != version.token, 'a write left the data version as it was'
+    assert db.get_mike_record(
+        changed.get_primary_key()).to_tuple() == changed.to_tuple()
+    assert db.get_mike_record(
+        added.get_primary_key()).to_tuple() == added.to_tuple()
+    updated = MikeRecord.from_tuple(records[1].to_tuple()[:6] + ('Renamed', ) +
+                                    records[1].to_tuple()[7:])
+    db.update_mike_records([updated])
+    assert db.get_mike_record(
+        updated.get_primary_key()).mike_site_name == 'Renamed'
+    db.remove_mike_records(
+        [records[2].get_primary_key(),
+         added.get_primary_key()])
+    assert db.get_mike_record(records[2].get_primary_key()) is None
+    assert len(rows_by_key(db)) == len(records) - 1
+
+
+def test_queries(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    ordered = sorted(records, key=lambda record: record.get_primary_key())
+    for country_code in (None, 'ga'):
+        for subregion_id in (None, 'wa'):
+            for year_from, year_to in ((None, None), (2011, 2013)):
+                expected = [
+                    record.to_tuple() for record in ordered
+                    if (country_code is None or record.country_code ==
+                        country_code) and (subregion_id is None or record.
+                                           subregion_id == subregion_id) and
+                    (year_from is None or year_from <= record.year <= year_to)
+                ]
+                rows = []
+                after = None
+                while True:
+                    page = db.query_mike_records(
+                        MikeRecordQuery(country_code=country_code,
+                                        subregion_id=subregion_id,
+                                        year_from=year_from,
+                                        year_to=year_to,
+                                        after=after,
+                                        limit=7))
+                    rows.extend(tuple(row) for row in page.rows)
+                    if page.next_key is None:
+                        break
+                    after = page.next_key
+                assert rows == expected, 'query {} {} {} {}'.format(
+                    country_code, subregion_id, year_from, year_to)
+    page = db.query_mike_records(
+        MikeRecordQuery(mike_site_id=SITES[1], fields=['year', 'carcasses']))
+    assert [tuple(row)
+            for row in page.rows] == [(record.year, record.carcasses)
+                                      for record in ordered
+                                      if record.mike_site_id == SITES[1]]
+
+
+def test_country_totals(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    db.remove_mike_records([records[0].get_primary_key()])
+    expected = expected_country_rows(records[1:])
+    assert [tuple(row) for row in db.get_all_country_record_rows()] == expected
+    assert db.get_country_record(CountryRecord.PrimaryKey('ga', 2011)).to_tuple() == \
+        next(row for row in expected if row[1:3] == ('ga', 2011))
+    assert db.check_country_totals() == []
+
+
+def test_yearly_totals(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    for group_by, field in (('site', 'mike_site_id'), ('country',
+                                                       'country_code'),
+                            ('subregion', 'subregion_id'), ('region',
+                                                            'un_region')):
+        for country_code in (None, 'cd'):
+            query = TotalsQuery(group_by=group_by,
+                                country_code=country_code,
+                                year_from=2011,
+                                year_to=2014)
+            totals = defaultdict(lambda: [0, 0])
+            for record in records:
+                if (country_code is None or record.country_code
+                        == country_code) and 2011 <= record.year <= 2014:
+                    total = totals[(getattr(record, field), record.year)]
+                    total[0] += record.carcasses
+                    total[1] += record.illegal_carcasses
+            expected = [(key[0], key[1], carcasses, illegal)
+                        for key, (carcasses, illegal) in sorted(totals.items())
+                        ]
+            actual = [(row[0], row[2], row[3], row[4])
+                      for row in db.get_yearly_totals(query)]
+            assert actual == expected, 'totals by ' + group_by
+
+
+def test_edits(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    new = MikeRecord('Africa', 'x', 'ca', 'Country ga', 'ga', 'b02',
+                     'Site b02', 2011, 3, 1)
+    missing = MikeRecord.PrimaryKey('zzz', 2011)
+    strict = db.apply_mike_record_edits([new, records[0]], [], [missing])
+    assert not strict.applied
+    assert (strict.added,
+            strict.removed) == ([EditResult.OK,
+                                 EditResult.DUPLICATE], [EditResult.NOT_FOUND])
+    assert db.get_mike_record(
+        new.get_primary_key()) is None, 'a rejected edit was written'
+    lenient = db.apply_mike_record_edits(
+        [new, records[0]], [records[1]],
+        [missing, records[2].get_primary_key()],
+        continue_on_error=True)
+    assert lenient.applied
+    assert (lenient.added, lenient.changed,
+            lenient.removed) == ([EditResult.OK,
+                                  EditResult.DUPLICATE], [EditResult.OK],
+                                 [EditResult.NOT_FOUND, EditResult.OK])
+    assert db.get_mike_record(new.get_primary_key()) is not None
+    assert db.get_mike_record(records[2].get_primary_key()) is None
+    assert db.check_country_totals() == []
+
+
+def test_sync(db):
+    records = sample_records()
+    first = db.sync_mike_records(records)
+    assert (first.inserted, first.changed, first.deleted,
+            first.unchanged) == (len(records), 0, 0, 0)
+    changed = MikeRecord.from_tuple(records[0].to_tuple()[:8] + (77, 7))
+    second = db.sync_mike_records([changed] + records[1:-1])
+    assert (second.inserted, second.changed, second.deleted,
+            second.unchanged) == (0, 1, 1, len(records) - 2)
+    assert db.get_mike_record(records[-1].get_primary_key()) is None
+    assert db.get_mike_record(changed.get_primary_key()).carcasses == 77
+    assert db.check_country_totals() == []
+    source = SyncSource('conformance', '"etag"',
+                        'Mon, 01 Jan 2024 00:00:00 GMT', '0' * 64)
+    db.save_sync_source(source)
+    stored = db.get_sync_source('conformance')
+    assert (stored.etag, stored.last_modified,
+            stored.digest) == (source.etag, source.last_modified,
+                               source.digest)
+
+
+def test_jobs(db):
+    job = db.create_job('conformance')
+    job.status = Job.SUCCEEDED
+    job.started_at = job.created_at
+    job.finished_at = job.created_at
+    job.progress = {'rowsRead': 3}
+    job.result = {'inserted': 3}
+    db.update_job(job)
+    stored = db.get_job(job.job_id)
+    assert (stored.kind, stored.status, stored.progress,
+            stored.result) == ('conformance', Job.SUCCEEDED, {
+                'rowsRead': 3
+            }, {
+                'inserted': 3
+            })
+    assert stored.created_at == job.created_at
+    assert db.get_job('0' * 32) is None
+
+
+def test_exports(db):
+    records = sample_records()
+    db.add_mike_records(records)
+    export = db.get_snapshot_export(db.MIKE_RECORDS)
+    with export.file:
+        header, columns = read_columnar(export.file.read())
+    assert header['rows'] == len(records)
+    assert sorted(zip(*(columns[key] for key in MikeRecord.JSON_KEYS))) == \
+        sorted(record.to_tuple() for record in records)
@@ -0,0 +1,150 @@
+"""
+Checks that ColumnarMikeCsvReader reads the same records as a csv.DictReader row at a time, on its fast path and on
+the csv.reader path taken by blocks with quotes or short rows, and that it reports each bad value by row and column.
+"""
+import csv
+import io
+from typing import List
+
+import pytest
+
+from app.datasheet import MIKE_CSV_COLUMNS, ColumnarMikeCsvReader, InvalidDatasheetError
+from app.models import MikeRecord
+
+HEADER = ','.join(MIKE_CSV_COLUMNS)
+TRACKED = {'ga', 'gh'}
+
+
+def datasheet_row(i: int) -> str:
+    country = ('GA', 'GH', 'ZZ')[i % 3]
+    return 'Africa,Central Africa,CA,Country {0},{0},S{1:02d},Site {1},{2},{3},{4}'.format(
+        country, i % 50, 2000 + i // 50, i % 13, i % 5)
+
+
+def expected_records(text: str) -> List[tuple]:
+    return [
+        MikeRecord(row['UNRegion'], row['SubregionName'], row['SubregionID'],
+                   row['CountryName'], row['CountryCode'], row['MIKEsiteID'],
+                   row['MIKEsiteName'], int(row['year']),
+                   int(row['TotalNumberOfCarcasses']),
+                   int(row['NumberOfIllegalCarcasses'])).to_tuple()
+        for row in csv.DictReader(io.StringIO(text))
+        if row['CountryCode'].lower() in TRACKED
+    ]
+
+
+def read(text: str) -> ColumnarMikeCsvReader:
+    return ColumnarMikeCsvReader(io.StringIO(text), TRACKED)
+
+
+@pytest.fixture(params=[4, 256])
+def block_rows(request, monkeypatch):
+    # small blocks make the datasheets below span several of them
+    monkeypatch.setattr(ColumnarMikeCsvReader, 'BLOCK_ROWS', request.param)
+    return request.param
+
+
+def errors_of(text: str) -> InvalidDatasheetError:
+    with pytest.raises(InvalidDatasheetError) as e:
+        list(read(text))
+    return e.value
+
+
+def test_unquoted_rows_are_read_a_column_at_a_time(block_rows):
+    text = '\n'.join([HEADER] + [datasheet_row(i) for i in range(30)]) + '\n'
+    reader = read(text)
+    records = [record.to_tuple() for record in reader]
+    assert records == expected_records(text)
+    assert records[0][4:6] == ('ga', 's00'), 'IDs were not lower cased'
+    assert (reader.rows_read, reader.records_read,
+            reader.records_skipped) == (30, 20, 10)
+
+
+def test_quoted_values_are_read_with_csv_reader(block_rows):
+    rows = [datasheet_row(i) for i in range(30)]
+    # a quoted line break that crosses the end of a block
+    rows[3] = rows[3].replace('Site 3', '"Site\n3"')
+    rows[4] = rows[4].replace('Central Africa', '"Central ""Africa"""')
+    rows[7] = rows[7].replace('Site 7', '"Site 7, north"')
+    text = '\r\n'.join([HEADER] + rows) + '\r\n'
+    records = [record.to_tuple() for record in read(text)]
+    assert records == expected_records(text)
+    # the rows of sites 2 and 5 are from an untracked country
+    assert [record[6] for record in records[2:6]
+            ] == ['Site\n3', 'Site 4', 'Site 6', 'Site 7, north']
+    assert records[3][1] == 'Central "Africa"'
+
+
+def test_columns_are_found_by_their_header(block_rows):
+    order = list(reversed(MIKE_CSV_COLUMNS)) + ['Notes']
+    lines = [','.join(order)]
+    for i in range(10):
+        values = dict(zip(MIKE_CSV_COLUMNS, datasheet_row(i).split(',')))
+        values['Notes'] = 'n'
+        lines.append(','.join(values[column] for column in order))
+    text = '\n'.join(lines) + '\n'
+    assert [record.to_tuple()
+            for record in read(text)] == expected_records(text)
+
+
+def test_blank_lines_are_skipped(block_rows):
+    text = '\n'.join([HEADER, datasheet_row(0), '', datasheet_row(1)]) + '\n'
+    reader = read(text)
+    assert len(list(reader)) == 2
+    assert reader.rows_read == 2
+
+
+def test_bad_values_are_reported_by_row_and_column(block_rows):
+    rows = [datasheet_row(i) for i in range(20)]
+    rows[1] = rows[1].replace(',2000,', ',20x0,')
+    rows[6] = rows[6].replace(',S06,', ',S6,')
+    rows[12] = rows[12].rsplit(',', 2)[0] + ',-1,' + rows[12].rsplit(',', 1)[1]
+    rows[15] = rows[15].rsplit(',', 1)[0] + ',' + str(2**63)
+    rows[17] = ','.join(rows[17].split(',')[:6])
+    text = '\n'.join([HEADER] + rows) + '\n'
+    error = errors_of(text)
+    assert [(e['row'], e['column'], e['message']) for e in error.errors] == [
+        (3, 'year', 'The value is not an integer.'),
+        (8, 'MIKEsiteID', 'The ID must be 3 characters long.'),
+        (14, 'TotalNumberOfCarcasses', 'The number is negative.'),
+        (17, 'NumberOfIllegalCarcasses', 'The number is too large.'),
+        (19, 'MIKEsiteName', 'A value is missing.'),
+    ]
+    assert error.error_count == 5
+
+
+def test_a_row_can_hold_several_errors(block_rows):
+    row = datasheet_row(0).replace(',CA,', ',CAA,').replace(',2000,', ',x,')
+    error = errors_of('\n'.join([HEADER, row]) + '\n')
+    assert [(e['row'], e['column'])
+            for e in error.errors] == [(2, 'SubregionID'), (2, 'year')]
+
+
+def test_records_stop_at_the_first_bad_block(monkeypatch):
+    monkeypatch.setattr(ColumnarMikeCsvReader, 'BLOCK_ROWS', 3)
+    rows = [datasheet_row(i) for i in range(12)]
+    rows[7] = rows[7].replace(',2000,', ',x,')
+    reader = read('\n'.join([HEADER] + rows) + '\n')
+    yielded = []
+    with pytest.raises(InvalidDatasheetError):
+        for record in reader:
+            yielded.append(record)
+    # the first two blocks hold four tracked records
+    assert len(yielded) == 4
+    assert reader.rows_read == 12, 'the rest of the datasheet was not checked'
+
+
+def test_reported_errors_are_capped_but_all_counted(block_rows):
+    rows = [datasheet_row(i).rsplit(',', 1)[0] + ',x' for i in range(150)]
+    error = errors_of('\n'.join([HEADER] + rows) + '\n')
+    assert len(error.errors) == ColumnarMikeCsvReader.MAX_REPORTED_ERRORS
+    assert error.error_count == 150
+    assert [e['row'] for e in error.errors] == list(range(2, 102))
+
+
+def test_missing_columns_are_reported_on_the_header():
+    error = errors_of('UNRegion,year\nAfrica,2000\n')
+    assert error.error_count == 1
+    [only] = error.errors
+    assert (only['row'], only['column']) == (1, None)
+    assert 'MIKEsiteID' in only['message']
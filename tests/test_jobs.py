@@ -0,0 +1,154 @@
+"""
+Runs /admin/update as a background job against a datasheet in a temporary folder, read through a ``file://`` URL in
+place of the MIKE database, with the records kept by the SQLite backend.
+"""
+import time
+from os import path
+
+import pytest
+
+from app import create_app
+from app.auth import AuthProvider
+from app.backends import create_sqlite_provider
+from app.datasheet import MIKE_CSV_COLUMNS
+from app.models import MasterPasswordProvider, Job
+from app.routes import register_routes
+
+ROWS = [
+    ('Africa', 'Central Africa', 'CA', 'Gabon', 'GA', 'MKK', 'Minkebe', 2010,
+     12, 4),
+    ('Africa', 'Central Africa', 'CA', 'Gabon', 'GA', 'MKK', 'Minkebe', 2011,
+     9, 3),
+    ('Africa', 'West Africa', 'WA', 'Ghana', 'GH', 'MOL', 'Mole', 2010, 2, 1),
+    # a country the app does not track
+    ('Africa', 'Nowhere', 'NW', 'Nowhere', 'ZZ', 'NOW', 'Nowhere', 2010, 5, 5),
+]
+
+
+class FixedPasswordProvider(MasterPasswordProvider):
+
+    def verify_pwd(self, plain_pwd: str) -> bool:
+        return plain_pwd == 'password'
+
+    def set_master_pwd(self, new_pwd: str):
+        pass
+
+
+def write_datasheet(file: str, rows):
+    with open(file, 'w') as f:
+        f.write(','.join(MIKE_CSV_COLUMNS) + '\n')
+        for row in rows:
+            f.write(','.join(str(value) for value in row) + '\n')
+
+
+@pytest.fixture
+def datasheet(tmp_path):
+    file = str(tmp_path / 'mike.csv')
+    write_datasheet(file, ROWS)
+    return file
+
+
+@pytest.fixture
+def db(tmp_path):
+    return create_sqlite_provider({}, str(tmp_path))
+
+
+@pytest.fixture
+def client(tmp_path, db, datasheet):
+    app = create_app({
+        'SECRET_KEY': 'x' * 32,
+        'MIKE_CSV_URL': 'file://' + datasheet
+    })
+    app.instance_path = str(tmp_path)
+    auth = AuthProvider(FixedPasswordProvider(), app.config['SECRET_KEY'])
+    register_routes(app, db, db, auth, db)
+    client = app.test_client()
+    token = auth.generate_new_token()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + token
+    return client
+
+
+def start_update(client, query: str = '') -> str:
+    res = client.get('/admin/update' + query)
+    assert res.status_code == 202
+    job_id = res.get_json()['jobId']
+    assert res.headers['Location'].endswith('/admin/jobs/' + job_id)
+    return res.headers['Location']
+
+
+def wait_for_job(client, location: str, timeout: float = 10) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        res = client.get(location)
+        assert res.status_code == 200
+        job = res.get_json()
+        if job['status'] in (Job.SUCCEEDED, Job.FAILED):
+            return job
+        assert time.monotonic() < deadline, 'the job did not finish'
+        time.sleep(0.01)
+
+
+def test_update_runs_as_a_job(client, db):
+    job = wait_for_job(client, start_update(client))
+    assert (job['kind'], job['status'],
+            job['message']) == ('mike_update', Job.SUCCEEDED, None)
+    assert job['progress'] == {
+        'rowsRead': len(ROWS),
+        'recordsRead': len(ROWS) - 1
+    }
+    assert job['result']['sourceChanged']
+    assert (job['result']['inserted'],
+            job['result']['recordsSkipped']) == (len(ROWS) - 1, 1)
+    assert job['startedAt'] is not None and job['finishedAt'] is not None
+    assert sorted(db.iter_mike_record_rows()) == sorted(
+        tuple(value.lower() if i in (2, 4, 5) else value
+              for i, value in enumerate(row)) for row in ROWS[:-1])
+
+
+def test_unchanged_datasheet_is_not_synchronized_again(client):
+    wait_for_job(client, start_update(client))
+    job = wait_for_job(client, start_update(client))
+    assert job['status'] == Job.SUCCEEDED
+    assert job['result'] == {'sourceChanged': False}
+    forced = wait_for_job(client, start_update(client, '?force=true'))
+    assert forced['result']['sourceChanged']
+    assert (forced['result']['inserted'],
+            forced['result']['unchanged']) == (0, len(ROWS) - 1)
+
+
+def test_changed_datasheet_writes_the_difference(client, db, datasheet):
+    wait_for_job(client, start_update(client))
+    write_datasheet(datasheet, [ROWS[0][:8] + (20, 10)] + ROWS[2:])
+    job = wait_for_job(client, start_update(client))
+    assert (job['result']['inserted'], job['result']['changed'],
+            job['result']['deleted']) == (0, 1, 1)
+    assert db.get_mike_record(
+        db.get_mike_record(('mkk', 2010)).get_primary_key()).carcasses == 20
+
+
+def test_invalid_datasheet_fails_the_job(client, db, datasheet):
+    write_datasheet(datasheet, ROWS[:1] + [ROWS[1][:7] + ('soon', 9, 3)])
+    job = wait_for_job(client, start_update(client))
+    assert job['status'] == Job.FAILED
+    assert job[
+        'message'] == 'MIKE Records in invalid format. Contact an administrator.'
+    assert job['result']['errorCount'] == 1
+    assert job['result']['errors'][0]['row'] == 3
+    assert list(db.iter_mike_record_rows()) == [], 'a failed job wrote records'
+
+
+def test_missing_datasheet_fails_the_job(client, datasheet):
+    client.application.config['MIKE_CSV_URL'] = 'file://' + path.join(
+        path.dirname(datasheet), 'missing.csv')
+    job = wait_for_job(client, start_update(client))
+    assert job['status'] == Job.FAILED
+    assert job['message'] is not None
+
+
+def test_unknown_job_is_not_found(client):
+    assert client.get('/admin/jobs/' + '0' * 32).status_code == 404
+
+
+def test_update_requires_login(client):
+    del client.environ_base['HTTP_AUTHORIZATION']
+    assert client.get('/admin/update').status_code == 401
@@ -0,0 +1,201 @@
+"""
+Checks how MetricsRegistry buckets observations, adds up the files of every worker and writes the Prometheus text
+format.
+"""
+import json
+import os
+from typing import Optional
+
+import pytest
+
+import app.metrics
+from app.metrics import Histogram, MetricsRegistry, RequestMetrics
+
+
+def test_observations_fall_in_the_first_bucket_that_holds_them():
+    histogram = Histogram((0.1, 1.0, 10.0))
+    for value in (0.0, 0.1, 0.5, 1.0, 10.0, 11.0):
+        histogram.observe(value)
+    # the last value is above every bound, so it is only counted in the total
+    assert histogram.counts == [2, 2, 1]
+    assert histogram.count == 6
+    assert histogram.sum == pytest.approx(22.6)
+
+
+def test_merge_adds_the_state_of_another_histogram():
+    first = Histogram((1, 2))
+    second = Histogram((1, 2))
+    first.observe(1)
+    second.observe(2)
+    second.observe(3)
+    first.merge(second.to_state())
+    assert (first.counts, first.count, first.sum) == ([1, 1], 3, 6.0)
+
+
+def write_worker_file(folder,
+                      pid: int,
+                      started: int,
+                      requests: int,
+                      pool: Optional[dict] = None):
+    histogram = Histogram(app.metrics.LATENCY_BUCKETS)
+    for _ in range(requests):
+        histogram.observe(0.02)
+    state = {
+        'histograms': {
+            'requests': [[['GET', '/mikerecords', '200'],
+                          histogram.to_state()]],
+            'phases': [],
+            'round_trips': []
+        },
+        'slow_requests': requests
+    }
+    if pool is not None:
+        state['pool'] = pool
+    folder.mkdir(exist_ok=True)
+    (folder / '{}-{}.json'.format(pid, started)).write_text(json.dumps(state))
+
+
+def pool_stats(checkouts: int, in_use: int) -> dict:
+    return {
+        'checkouts': checkouts,
+        'waits': 0,
+        'timeouts': 0,
+        'created': 1,
+        'discarded': 0,
+        'size': 4,
+        'in_use': in_use,
+        'idle': 1
+    }
+
+
+def metric_values(text: str) -> dict:
+    return dict(
+        line.rsplit(' ', 1) for line in text.splitlines()
+        if not line.startswith('#'))
+
+
+# the files of exited workers are only folded together where files can be locked
+needs_file_locks = pytest.mark.skipif(app.metrics.fcntl is None,
+                                      reason='needs fcntl')
+
+
+@pytest.fixture
+def running(monkeypatch):
+    """
+    The process IDs taken to be running, besides this one
+    """
+    pids = set()
+    monkeypatch.setattr(app.metrics, '_is_running',
+                        lambda pid: pid == os.getpid() or pid in pids)
+    return pids
+
+
+def test_text_format_has_cumulative_buckets(tmp_path):
+    registry = MetricsRegistry(str(tmp_path))
+    request_metrics = RequestMetrics()
+    request_metrics.round_trips = 2
+    registry.record('GET', '/a"b', 200, 0.02, request_metrics)
+    registry.record('GET', '/a"b', 200, 0.3, request_metrics, slow=True)
+    values = metric_values(registry.collect())
+    labels = 'method="GET",route="/a\\"b",status="200"'
+    assert values['mike_request_duration_seconds_bucket{' + labels +
+                  ',le="0.01"}'] == '0'
+    assert values['mike_request_duration_seconds_bucket{' + labels +
+                  ',le="0.025"}'] == '1'
+    assert values['mike_request_duration_seconds_bucket{' + labels +
+                  ',le="0.5"}'] == '2'
+    assert values['mike_request_duration_seconds_bucket{' + labels +
+                  ',le="+Inf"}'] == '2'
+    assert values['mike_request_duration_seconds_count{' + labels + '}'] == '2'
+    assert float(values['mike_request_duration_seconds_sum{' + labels +
+                        '}']) == pytest.approx(0.32)
+    assert values[
+        'mike_request_db_round_trips_bucket{route="/a\\"b",le="2.0"}'] == '2'
+    assert values['mike_slow_requests_profiled_total'] == '1'
+    # pool metrics are only reported when a pool reports its stats
+    assert not any(key.startswith('mike_db_pool') for key in values)
+
+
+def test_text_format_declares_every_metric(tmp_path):
+    text = MetricsRegistry(str(tmp_path)).collect()
+    assert '# TYPE mike_request_duration_seconds histogram\n' in text
+    assert '# TYPE mike_request_phase_seconds histogram\n' in text
+    assert '# TYPE mike_slow_requests_profiled_total counter\n' in text
+    assert text.endswith('mike_slow_requests_profiled_total 0\n')
+
+
+def test_files_of_every_worker_are_added_up(tmp_path, running):
+    folder = tmp_path / 'metrics'
+    running.update((101, 102))
+    write_worker_file(folder, 101, 1, 2, pool_stats(5, 1))
+    write_worker_file(folder, 102, 1, 3, pool_stats(7, 2))
+    values = metric_values(MetricsRegistry(str(folder)).collect())
+    assert values[
+        'mike_request_duration_seconds_count{method="GET",route="/mikerecords",status="200"}'] == '5'
+    assert values['mike_slow_requests_profiled_total'] == '5'
+    assert values['mike_db_pool_checkouts_total'] == '12'
+    assert values['mike_db_pool_connections_in_use'] == '3'
+    assert values['mike_db_pool_size'] == '8'
+
+
+@needs_file_locks
+def test_exited_workers_are_folded_into_the_retired_file(tmp_path, running):
+    folder = tmp_path / 'metrics'
+    running.add(101)
+    write_worker_file(folder, 101, 1, 2, pool_stats(5, 1))
+    write_worker_file(folder, 102, 1, 3, pool_stats(7, 2))
+    registry = MetricsRegistry(str(folder))
+    values = metric_values(registry.collect())
+    assert sorted(os.listdir(
+        str(folder))) == ['101-1.json', 'retired.json', 'retired.lock']
+    # counts stay, but the connections of an exited worker are gone
+    assert values['mike_slow_requests_profiled_total'] == '5'
+    assert values['mike_db_pool_checkouts_total'] == '12'
+    assert values['mike_db_pool_connections_in_use'] == '1'
+    running.clear()
+    write_worker_file(folder, 103, 1, 4)
+    values = metric_values(registry.collect())
+    assert sorted(os.listdir(str(folder))) == ['retired.json', 'retired.lock']
+    assert values['mike_slow_requests_profiled_total'] == '9'
+    assert values['mike_db_pool_checkouts_total'] == '12'
+    assert values['mike_db_pool_connections_in_use'] == '0'
+
+
+def test_worker_reusing_a_process_id_keeps_the_old_counts(tmp_path, running):
+    folder = tmp_path / 'metrics'
+    running.add(101)
+    write_worker_file(folder, 101, 1, 2, pool_stats(5, 1))
+    write_worker_file(folder, 101, 2, 3, pool_stats(7, 2))
+    values = metric_values(MetricsRegistry(str(folder)).collect())
+    assert values['mike_slow_requests_profiled_total'] == '5'
+    # only the later worker holds connections
+    assert values['mike_db_pool_connections_in_use'] == '2'
+
+
+@needs_file_locks
+def test_files_taken_in_before_an_interrupted_collection_count_once(
+        tmp_path, running, monkeypatch):
+    folder = tmp_path / 'metrics'
+    write_worker_file(folder, 102, 1, 3)
+    registry = MetricsRegistry(str(folder))
+    registry.collect()
+    # as if the collection had stopped before deleting the files it took in
+    write_worker_file(folder, 102, 1, 3)
+    monkeypatch.setattr(registry, '_retire_exited_workers', lambda: None)
+    values = metric_values(registry.collect())
+    assert values['mike_slow_requests_profiled_total'] == '3'
+    monkeypatch.undo()
+    values = metric_values(registry.collect())
+    assert values['mike_slow_requests_profiled_total'] == '3'
+    assert '102-1.json' not in os.listdir(str(folder))
+
+
+def test_forked_worker_writes_a_file_of_its_own(tmp_path, monkeypatch):
+    registry = MetricsRegistry(str(tmp_path), flush_interval=0)
+    registry.record('GET', '/', 200, 0.01, RequestMetrics())
+    parent = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: parent + 1)
+    registry.record('GET', '/', 200, 0.01, RequestMetrics())
+    assert sorted(name.split('-')[0]
+                  for name in os.listdir(str(tmp_path))) == sorted(
+                      [str(parent), str(parent + 1)])
@@ -0,0 +1,167 @@
+"""
+Checks MariaDBConnectionPool with stand-in connections, so no database server is needed.
+"""
+import os
+import threading
+from typing import List
+
+import pytest
+
+mariadb = pytest.importorskip('mariadb')
+
+from app.data_access import MariaDBConnectionPool
+from app.metrics import MetricsRegistry, RequestMetrics
+from app.models import DataAccessError
+
+
+class FakeConnection:
+
+    def __init__(self, alive: bool = True) -> None:
+        self.alive = alive
+        self.closed = False
+
+    def rollback(self):
+        pass
+
+    def ping(self):
+        if not self.alive:
+            raise mariadb.Error()
+
+    def close(self):
+        self.closed = True
+
+
+class Connector:
+
+    def __init__(self) -> None:
+        self.opened: List[FakeConnection] = []
+
+    def __call__(self) -> FakeConnection:
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+
+def test_connections_are_reused():
+    connect = Connector()
+    pool = MariaDBConnectionPool(connect, size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    stats = pool.stats()
+    assert (stats['open'], stats['idle'], stats['checkouts'],
+            stats['created']) == (1, 1, 2, 1)
+
+
+def test_checkout_times_out_when_every_connection_is_in_use():
+    pool = MariaDBConnectionPool(Connector(), size=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(DataAccessError):
+            with pool.connection():
+                pass
+    stats = pool.stats()
+    assert (stats['waits'], stats['timeouts'], stats['in_use']) == (1, 1, 0)
+
+
+def test_waiting_checkout_gets_the_returned_connection():
+    pool = MariaDBConnectionPool(Connector(), size=1, timeout=5)
+    checked_out = threading.Event()
+    got = []
+
+    def wait_for_connection():
+        checked_out.wait()
+        with pool.connection() as conn:
+            got.append(conn)
+
+    waiter = threading.Thread(target=wait_for_connection)
+    waiter.start()
+    with pool.connection() as conn:
+        checked_out.set()
+        while pool.stats()['waits'] == 0:
+            pass
+    waiter.join()
+    assert got == [conn]
+    assert pool.stats()['timeouts'] == 0
+
+
+def test_old_connections_are_recycled():
+    connect = Connector()
+    pool = MariaDBConnectionPool(connect, recycle=-1)
+    with pool.connection():
+        pass
+    with pool.connection() as conn:
+        assert conn is connect.opened[1]
+    assert connect.opened[0].closed
+    stats = pool.stats()
+    assert (stats['created'], stats['discarded'], stats['open']) == (2, 1, 1)
+
+
+def test_idle_connections_that_fail_a_ping_are_replaced():
+    connect = Connector()
+    pool = MariaDBConnectionPool(connect, ping_interval=-1)
+    with pool.connection():
+        pass
+    with pool.connection() as conn:
+        assert conn is connect.opened[0], 'a live connection was replaced'
+    connect.opened[0].alive = False
+    with pool.connection() as conn:
+        assert conn is connect.opened[1]
+    assert pool.stats()['discarded'] == 1
+
+
+@pytest.mark.parametrize('error', [mariadb.Error(), RuntimeError()])
+def test_failed_connect_gives_its_slot_back(error):
+
+    def connect():
+        raise error
+
+    pool = MariaDBConnectionPool(connect, size=1, timeout=0.05)
+    expected = DataAccessError if isinstance(error,
+                                             mariadb.Error) else RuntimeError
+    for _ in range(2):
+        # a leaked slot would make the second attempt time out instead
+        with pytest.raises(expected):
+            with pool.connection():
+                pass
+    assert pool.stats()['open'] == 0
+    assert pool.stats()['timeouts'] == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_forked_child_opens_its_own_connections():
+    connect = Connector()
+    pool = MariaDBConnectionPool(connect)
+    with pool.connection():
+        pass
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            stats = pool.stats()
+            with pool.connection() as conn:
+                reused = conn is connect.opened[0]
+            shared = stats['open'] > 0 or stats['idle'] > 0 or reused
+            os.write(write_end, b'shared' if shared else b'ok')
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    assert result == b'ok'
+    assert pool.stats()['open'] == 1, 'the parent lost its connection'
+
+
+def test_pool_stats_are_reported_in_the_metrics(tmp_path):
+    pool = MariaDBConnectionPool(Connector(), size=3)
+    registry = MetricsRegistry(str(tmp_path), pool_stats=pool.stats)
+    with pool.connection():
+        with pool.connection():
+            registry.record('GET', '/mikerecords', 200, 0.01, RequestMetrics())
+            text = registry.collect()
+    assert 'mike_db_pool_checkouts_total 2\n' in text
+    assert 'mike_db_pool_connections_created_total 2\n' in text
+    assert 'mike_db_pool_size 3\n' in text
+    assert 'mike_db_pool_connections_in_use 2\n' in text
+    assert 'mike_db_pool_connections_idle 0\n' in text
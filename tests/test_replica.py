@@ -0,0 +1,85 @@
+"""
+Checks when ReplicatedRecordProvider reloads its copy of the records, with the SQLite backend in a temporary folder.
+"""
+import pytest
+
+from app.backends import create_sqlite_provider
+from app.models import InvalidPrimaryKeyOperationError, MikeRecord, MikeRecordQuery
+from app.replica import ReplicatedRecordProvider
+
+RECORD = MikeRecord('Africa', 'Central Africa', 'ca', 'Gabon', 'ga', 'mkk',
+                    'Minkebe', 2010, 12, 4)
+
+
+class CountingStore:
+    """
+    Passes everything through to a provider, counting how often every record is read
+    """
+
+    def __init__(self, store) -> None:
+        self.store = store
+        self.loads = 0
+
+    def iter_mike_record_rows(self):
+        self.loads += 1
+        return self.store.iter_mike_record_rows()
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = create_sqlite_provider({}, str(tmp_path))
+    store.add_mike_record(RECORD)
+    return CountingStore(store)
+
+
+def test_current_copy_is_read_without_the_store(store):
+    replica = ReplicatedRecordProvider(store)
+    replica.get_mike_record(RECORD.get_primary_key())
+    replica.query_mike_records(MikeRecordQuery(country_code='ga'))
+    replica.get_all_country_record_rows()
+    assert store.loads == 1
+
+
+def test_write_through_the_replica_reloads_the_copy(store):
+    replica = ReplicatedRecordProvider(store)
+    version = replica.get_data_version()
+    changed = MikeRecord.from_tuple(RECORD.to_tuple()[:8] + (20, 5))
+    replica.update_mike_record(changed)
+    assert replica.get_data_version().token != version.token
+    assert replica.get_mike_record(
+        changed.get_primary_key()).to_tuple() == changed.to_tuple()
+    assert replica.get_all_country_record_rows() == [('Gabon', 'ga', 2010, 20,
+                                                      5)]
+    assert store.loads == 2
+
+
+def test_write_by_another_worker_reloads_the_copy(tmp_path, store):
+    replica = ReplicatedRecordProvider(store)
+    assert len(list(replica.iter_mike_record_rows())) == 1
+    # a second provider on the same instance folder stands in for another worker process
+    other = create_sqlite_provider({}, str(tmp_path))
+    other.add_mike_record(
+        MikeRecord('Africa', 'West Africa', 'wa', 'Ghana', 'gh', 'mol', 'Mole',
+                   2010, 2, 1))
+    assert replica.get_data_version().token == other.get_data_version().token
+    assert [row[5]
+            for row in replica.iter_mike_record_rows()] == ['mkk', 'mol']
+    assert store.loads == 2
+
+
+def test_failed_write_keeps_the_copy(store):
+    replica = ReplicatedRecordProvider(store)
+    replica.get_mike_record(RECORD.get_primary_key())
+    with pytest.raises(InvalidPrimaryKeyOperationError):
+        replica.add_mike_record(RECORD)
+    replica.get_mike_record(RECORD.get_primary_key())
+    assert store.loads == 1
+
+
+def test_store_must_track_data_versions(store, monkeypatch):
+    monkeypatch.setattr(store.store, 'get_data_version', lambda: None)
+    with pytest.raises(ValueError):
+        ReplicatedRecordProvider(store)
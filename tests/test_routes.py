@@ -0,0 +1,443 @@
+"""
+Drives the read routes through Flask's test client, with the records kept by the SQLite backend in a temporary folder.
+"""
+import pytest
+
+from app import create_app
+from app.auth import AuthProvider
+from app.backends import create_sqlite_provider
+from app.models import MasterPasswordProvider, MikeRecord
+from app.routes import register_routes
+
+ROWS = [
+    ('Africa', 'Central Africa', 'CA', 'Gabon', 'GA', 'MKK', 'Minkebe', 2010,
+     12, 4),
+    ('Africa', 'Central Africa', 'CA', 'Gabon', 'GA', 'MKK', 'Minkebe', 2011,
+     9, 3),
+    ('Africa', 'Central Africa', 'CA', 'Gabon', 'GA', 'LOP', 'Lope', 2010, 7,
+     0),
+    ('Africa', 'West Africa', 'WA', 'Ghana', 'GH', 'MOL', 'Mole', 2010, 2, 1),
+    ('Asia', 'South Asia', 'SA', 'India', 'IN', 'CHU', 'Chuchuna', 2011, 1, 1),
+]
+
+
+class FixedPasswordProvider(MasterPasswordProvider):
+
+    def verify_pwd(self, plain_pwd: str) -> bool:
+        return plain_pwd == 'password'
+
+    def set_master_pwd(self, new_pwd: str):
+        pass
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = create_sqlite_provider({}, str(tmp_path))
+    db.add_mike_records(MikeRecord(*row) for row in ROWS)
+    return db
+
+
+@pytest.fixture
+def config():
+    return {'SECRET_KEY': 'x' * 32}
+
+
+@pytest.fixture
+def client(tmp_path, db, config):
+    app = create_app(config)
+    app.instance_path = str(tmp_path)
+    auth = AuthProvider(FixedPasswordProvider(), app.config['SECRET_KEY'])
+    register_routes(app, db, db, auth, db, db, db)
+    return app.test_client()
+
+
+def test_read_routes_carry_the_version_headers(client):
+    for route in ('/mikerecords', '/countryrecords'):
+        res = client.get(route)
+        assert res.status_code == 200
+        assert res.headers['ETag']
+        assert res.headers['Last-Modified']
+        assert res.cache_control.no_cache
+
+
+def test_matching_etag_is_answered_with_304(client):
+    etag = client.get('/countryrecords').headers['ETag']
+    res = client.get('/countryrecords', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.data == b''
+    assert res.headers['ETag'] == etag
+    other = client.get('/countryrecords', headers={'If-None-Match': '"old"'})
+    assert other.status_code == 200
+
+
+def test_unchanged_since_is_answered_with_304(client):
+    last_modified = client.get('/mikerecords').headers['Last-Modified']
+    res = client.get('/mikerecords',
+                     headers={'If-Modified-Since': last_modified})
+    assert res.status_code == 304
+    older = client.get(
+        '/mikerecords',
+        headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+    assert older.status_code == 200
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since(client):
+    last_modified = client.get('/mikerecords').headers['Last-Modified']
+    res = client.get('/mikerecords',
+                     headers={
+                         'If-None-Match': '"old"',
+                         'If-Modified-Since': last_modified
+                     })
+    assert res.status_code == 200
+
+
+def test_write_changes_the_etag_and_the_body(client, db):
+    first = client.get('/countryrecords')
+    db.add_mike_record(
+        MikeRecord('Africa', 'West Africa', 'WA', 'Ghana', 'GH', 'DIG',
+                   'Digya', 2011, 5, 5))
+    res = client.get('/countryrecords',
+                     headers={'If-None-Match': first.headers['ETag']})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != first.headers['ETag']
+    assert res.get_json() != first.get_json()
+
+
+# the bodies of these records are too small to be compressed by default
+COMPRESS_ANY_SIZE = {'SECRET_KEY': 'x' * 32, 'COMPRESSION_MIN_SIZE': 0}
+
+
+@pytest.mark.parametrize('config', [COMPRESS_ANY_SIZE])
+def test_etags_differ_by_encoding(client):
+    plain = client.get('/countryrecords',
+                       headers={'Accept-Encoding': 'identity'})
+    zipped = client.get('/countryrecords', headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Encoding' not in plain.headers
+    assert zipped.headers['ETag'] != plain.headers['ETag']
+    # a client that saved either encoding may revalidate it with any other
+    res = client.get('/countryrecords',
+                     headers={
+                         'Accept-Encoding': 'identity',
+                         'If-None-Match': zipped.headers['ETag']
+                     })
+    assert res.status_code == 304
+
+
+@pytest.mark.parametrize('config', [COMPRESS_ANY_SIZE])
+@pytest.mark.parametrize('header,encoding', [('gzip', 'gzip'),
+                                             ('identity', None), ('', None)])
+def test_every_encoding_varies_by_accept_encoding(client, header, encoding):
+    res = client.get('/countryrecords', headers={'Accept-Encoding': header})
+    assert res.headers['Vary'] == 'Accept-Encoding'
+    assert res.headers.get('Content-Encoding') == encoding
+    revalidated = client.get('/countryrecords',
+                             headers={
+                                 'Accept-Encoding': header,
+                                 'If-None-Match': res.headers['ETag']
+                             })
+    assert revalidated.status_code == 304
+    assert revalidated.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_small_bodies_are_sent_uncompressed(client):
+    plain = client.get('/countryrecords',
+                       headers={'Accept-Encoding': 'identity'})
+    assert len(plain.data) < 1024
+    for _ in range(2):
+        res = client.get('/countryrecords',
+                         headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in res.headers
+        assert res.data == plain.data
+        assert res.headers['ETag'] == plain.headers['ETag']
+        assert res.headers['Vary'] == 'Accept-Encoding'
+    # the revalidated body keeps the tag it was sent with
+    res = client.get('/countryrecords',
+                     headers={
+                         'Accept-Encoding': 'gzip',
+                         'If-None-Match': plain.headers['ETag']
+                     })
+    assert res.status_code == 304
+    assert res.headers['ETag'] == plain.headers['ETag']
+
+
+def record_keys(rows) -> list:
+    return sorted((row[5].lower(), row[7]) for row in rows)
+
+
+def test_pages_follow_the_next_cursor_to_the_end(client):
+    keys = []
+    query = '/mikerecords?limit=2'
+    while True:
+        res = client.get(query)
+        assert res.status_code == 200
+        page = res.get_json()
+        assert len(page['records']) <= 2
+        keys += [(record['mikeSiteId'], record['year'])
+                 for record in page['records']]
+        if page['next'] is None:
+            break
+        query = '/mikerecords?limit=2&after=' + page['next']
+    assert keys == record_keys(ROWS)
+
+
+def test_filters_narrow_the_records(client):
+    res = client.get('/mikerecords?countryCode=ga&yearFrom=2011')
+    assert [(record['mikeSiteId'], record['year'])
+            for record in res.get_json()] == [('mkk', 2011)]
+    res = client.get('/mikerecords?subregionId=ca&yearTo=2010&limit=10')
+    assert [(record['mikeSiteId'], record['year'])
+            for record in res.get_json()['records']] == [('lop', 2010),
+                                                         ('mkk', 2010)]
+
+
+def test_fields_select_the_keys_of_each_record(client):
+    res = client.get('/mikerecords?mikeSiteId=mol&fields=year,carcasses')
+    assert res.get_json() == [{'year': 2010, 'carcasses': 2}]
+
+
+def expand_compact(body: dict) -> list:
+    """
+    The records of a compact body, as the usual response would have them
+    """
+    assert body['columns'] == [
+        'subregion', 'country', 'site', 'year', 'carcasses', 'illegalCarcasses'
+    ]
+    records = []
+    for subregion, country, site, year, carcasses, illegal in body['records']:
+        record = dict(body['subregions'][subregion])
+        record.update(body['countries'][country])
+        record.update(body['sites'][site])
+        record.update(year=year, carcasses=carcasses, illegalCarcasses=illegal)
+        records.append(record)
+    return records
+
+
+STREAMED = {'SECRET_KEY': 'x' * 32, 'STREAM_RESPONSES': True}
+
+
+@pytest.mark.parametrize('config', [{'SECRET_KEY': 'x' * 32}, STREAMED])
+def test_compact_body_holds_every_record_once(client):
+    records = client.get('/mikerecords').get_json()
+    res = client.get('/mikerecords?format=compact')
+    assert res.status_code == 200
+    assert res.mimetype == 'application/json'
+    body = res.get_json()
+    assert expand_compact(body) == records
+    # each site is listed once however many records it has
+    assert sorted(site['mikeSiteId']
+                  for site in body['sites']) == ['chu', 'lop', 'mkk', 'mol']
+    assert len(body['countries']) == 3
+    assert 'next' not in body
+
+
+def test_compact_body_is_revalidated_and_rebuilt_on_write(client, db):
+    first = client.get('/mikerecords?format=compact')
+    res = client.get('/mikerecords?format=compact',
+                     headers={'If-None-Match': first.headers['ETag']})
+    assert res.status_code == 304
+    db.add_mike_record(
+        MikeRecord('Africa', 'West Africa', 'WA', 'Ghana', 'GH', 'DIG',
+                   'Digya', 2011, 5, 5))
+    res = client.get('/mikerecords?format=compact',
+                     headers={'If-None-Match': first.headers['ETag']})
+    assert res.status_code == 200
+    assert len(res.get_json()['records']) == len(ROWS) + 1
+    # the usual response is cached apart from the compact one
+    assert len(client.get('/mikerecords').get_json()) == len(ROWS) + 1
+
+
+def test_compact_pages_follow_the_next_cursor_to_the_end(client):
+    keys = []
+    query = '/mikerecords?format=compact&limit=2'
+    while True:
+        body = client.get(query).get_json()
+        assert len(body['records']) <= 2
+        keys += [(record['mikeSiteId'], record['year'])
+                 for record in expand_compact(body)]
+        if body['next'] is None:
+            break
+        query = '/mikerecords?format=compact&limit=2&after=' + body['next']
+    assert keys == record_keys(ROWS)
+
+
+def test_compact_filters_narrow_the_records(client):
+    res = client.get('/mikerecords?format=compact&countryCode=ga&yearTo=2010')
+    body = res.get_json()
+    assert [(record['mikeSiteId'], record['year'])
+            for record in expand_compact(body)] == [('lop', 2010),
+                                                    ('mkk', 2010)]
+    # only the sites of the matching records are listed
+    assert len(body['sites']) == 2
+    assert body['countries'] == [{'countryName': 'Gabon', 'countryCode': 'ga'}]
+    assert 'next' not in body
+    res = client.get('/mikerecords?format=json&countryCode=gh')
+    assert [record['mikeSiteId'] for record in res.get_json()] == ['mol']
+
+
+@pytest.mark.parametrize('query', [
+    'format=compact&fields=year', 'format=csv', 'format=',
+    'format=compact&limit=0'
+])
+def test_malformed_format_gets_400(client, query):
+    res = client.get('/mikerecords?' + query)
+    assert res.status_code == 400
+    assert res.get_json() == {'message': 'Bad Request'}
+
+
+@pytest.mark.parametrize('query', [
+    'limit=0', 'limit=-1', 'limit=1001', 'limit=ten', 'after=mkk',
+    'after=mkk:x', 'after=mk:2010', 'fields=', 'fields=year,elephants',
+    'yearFrom=x', 'yearTo=2010.5'
+])
+def test_malformed_parameters_get_400(client, query):
+    res = client.get('/mikerecords?' + query)
+    assert res.status_code == 400
+    assert res.get_json() == {'message': 'Bad Request'}
+
+
+def test_trends_count_earlier_years_toward_the_window(client):
+    res = client.get('/analytics/trends?countryCode=ga&window=2&yearFrom=2011')
+    assert res.status_code == 200
+    [series] = res.get_json()
+    assert (series['group'], series['carcasses'],
+            series['illegalCarcasses']) == ('ga', 9, 3)
+    [point] = series['years']
+    assert point['year'] == 2011
+    assert point['rollingPike'] == pytest.approx(7 / 28)
+    assert point['yearOverYear'] == pytest.approx(3 / 9 - 4 / 19)
+
+
+def test_trends_of_no_records_are_empty(client):
+    res = client.get('/analytics/trends?groupBy=site&mikeSiteId=zzz')
+    assert res.status_code == 200
+    assert res.get_json() == []
+
+
+@pytest.mark.parametrize(
+    'query', ['window=0', 'window=51', 'yearFrom=x', 'groupBy=planet'])
+def test_malformed_trend_parameters_get_400(client, query):
+    res = client.get('/analytics/trends?' + query)
+    assert res.status_code == 400
+
+
+def mike_json(*row) -> dict:
+    return dict(zip(MikeRecord.JSON_KEYS, row))
+
+
+NEW = mike_json('Africa', 'West Africa', 'WA', 'Ghana', 'GH', 'DIG', 'Digya',
+                2011, 5, 5)
+EXISTING = mike_json(*ROWS[0])
+MISSING_KEY = {'mikeSiteId': 'zzz', 'year': 2010}
+
+
+@pytest.fixture
+def admin(client):
+    token = client.post('/login', json={
+        'password': 'password'
+    }).get_json()['token']
+    return {'Authorization': 'Bearer ' + token}
+
+
+def site_years(client) -> list:
+    return [(record['mikeSiteId'], record['year'])
+            for record in client.get('/mikerecords').get_json()]
+
+
+def test_edits_need_a_login(client):
+    res = client.post('/admin/edit', json={'added': [NEW]})
+    assert res.status_code == 401
+    assert ('dig', 2011) not in site_years(client)
+
+
+def test_applied_edits_are_all_ok(client, admin):
+    changed = dict(EXISTING, carcasses=20)
+    res = client.post('/admin/edit',
+                      headers=admin,
+                      json={
+                          'added': [NEW],
+                          'changed': [changed],
+                          'removed': [{
+                              'mikeSiteId': 'MOL',
+                              'year': 2010
+                          }]
+                      })
+    assert res.status_code == 200
+    assert res.get_json() == {
+        'added': ['ok'],
+        'changed': ['ok'],
+        'removed': ['ok'],
+        'message': 'Database has been updated.'
+    }
+    keys = site_years(client)
+    assert ('dig', 2011) in keys and ('mol', 2010) not in keys
+    record = client.get('/mikerecords?mikeSiteId=mkk&yearTo=2010').get_json()
+    assert record[0]['carcasses'] == 20
+
+
+def test_duplicate_rejects_every_edit(client, admin):
+    res = client.post('/admin/edit',
+                      headers=admin,
+                      json={'added': [NEW, EXISTING]})
+    assert res.status_code == 400
+    body = res.get_json()
+    assert body['added'] == ['ok', 'duplicate']
+    assert body['problemRecord']['mikeSiteId'] == 'mkk'
+    assert ('dig', 2011) not in site_years(client)
+
+
+def test_missing_record_rejects_every_edit(client, admin):
+    res = client.post('/admin/edit',
+                      headers=admin,
+                      json={
+                          'added': [NEW],
+                          'changed': [dict(NEW, mikeSiteId='ZZZ')],
+                          'removed': [MISSING_KEY]
+                      })
+    assert res.status_code == 400
+    body = res.get_json()
+    assert (body['added'], body['changed'],
+            body['removed']) == (['ok'], ['notFound'], ['notFound'])
+    assert body['message'] == ('Attempted to change or remove a record that '
+                               'is not in the database.')
+    assert ('dig', 2011) not in site_years(client)
+
+
+def test_invalid_record_rejects_every_edit(client, admin):
+    res = client.post('/admin/edit',
+                      headers=admin,
+                      json={'added': [NEW, dict(NEW, year='2012')]})
+    assert res.status_code == 400
+    assert res.get_json() == {
+        'message': 'One or more of the records supplied are invalid.'
+    }
+    assert ('dig', 2011) not in site_years(client)
+
+
+def test_continue_on_error_applies_the_other_edits(client, admin):
+    no_site = {'year': 2010}
+    chu_key = {'mikeSiteId': 'CHU', 'year': 2011}
+    no_year = {'mikeSiteId': 'LOP'}
+    edits = {
+        'continueOnError': True,
+        'added': [no_site, EXISTING, NEW],
+        'changed': [dict(NEW, mikeSiteId='ZZZ')],
+        'removed': [MISSING_KEY, chu_key, no_year]
+    }
+    res = client.post('/admin/edit', headers=admin, json=edits)
+    assert res.status_code == 200
+    assert res.get_json() == {
+        'added': ['invalid', 'duplicate', 'ok'],
+        'changed': ['notFound'],
+        'removed': ['notFound', 'ok', 'invalid'],
+        'message': 'Database has been updated. Some records were skipped.'
+    }
+    keys = site_years(client)
+    assert ('dig', 2011) in keys and ('chu', 2011) not in keys
+
+
+@pytest.mark.parametrize('body', [[NEW], {'added': NEW}, {'removed': 'mkk'}])
+def test_malformed_edit_body_gets_400(client, admin, body):
+    res = client.post('/admin/edit', headers=admin, json=body)
+    assert res.status_code == 400
+    assert res.get_json() == {'message': 'Bad Request'}
@@ -0,0 +1,122 @@
+"""
+Checks that RowJsonEncoder writes the same JSON as serializing each record's camelCase dictionary with json.dumps.
+"""
+import json
+
+import pytest
+
+from app.models import CountryRecord, InvalidRecordError, MikeRecord
+from app.routes import json_dict_to_mike, json_dict_to_mike_key, obj_to_camel_dict
+from app.serialization import (COUNTRY_RECORD_ENCODER, MIKE_RECORD_ENCODER,
+                               RowJsonEncoder, encode_compact_mike_rows,
+                               mike_projection_encoder)
+
+MIKE_ROWS = [
+    ('Africa', 'Central Africa', 'ca', 'Gabon', 'ga', 'mkk', 'Minkebe', 2010,
+     12, 4),
+    # quotes, backslashes, control characters, non-ASCII and astral characters are escaped by json.dumps
+    ('', 'Say "hi"\\', 'wa', "Côte d'Ivoire", 'ci', 'com', 'Comoé', 0, 0, 0),
+    ('Tab\there', 'Line\nbreak\r\x00\x1f\x7f', 'ea', '\u2028\u2029', 'xx',
+     'abc', '\U0001f418', 2**62, 2**70, 1),
+]
+COUNTRY_ROWS = [('Gabon', 'ga', 2010, 19, 4), ('éè"\\/', 'zz', 0, 2**64, 0)]
+
+
+def dumps(value) -> str:
+    return json.dumps(value, separators=(',', ':'))
+
+
+@pytest.mark.parametrize('row', MIKE_ROWS)
+def test_mike_row_matches_the_camel_dict(row):
+    expected = dumps(obj_to_camel_dict(MikeRecord(*row)))
+    assert MIKE_RECORD_ENCODER.encode_row(row) == expected
+
+
+@pytest.mark.parametrize('row', COUNTRY_ROWS)
+def test_country_row_matches_the_camel_dict(row):
+    expected = dumps(obj_to_camel_dict(CountryRecord(*row)))
+    assert COUNTRY_RECORD_ENCODER.encode_row(row) == expected
+
+
+def test_arrays_match_in_one_piece_and_in_chunks():
+    expected = dumps(
+        [obj_to_camel_dict(MikeRecord(*row)) for row in MIKE_ROWS])
+    assert MIKE_RECORD_ENCODER.encode_rows(MIKE_ROWS) == expected
+    for chunk_size in (1, 2, 3, 500):
+        assert ''.join(
+            MIKE_RECORD_ENCODER.iter_encode_rows(MIKE_ROWS,
+                                                 chunk_size)) == expected
+    assert MIKE_RECORD_ENCODER.encode_rows([]) == '[]'
+    assert ''.join(MIKE_RECORD_ENCODER.iter_encode_rows([])) == '[]'
+
+
+def test_strings_after_integers_are_escaped():
+    encoder = RowJsonEncoder(['n', 's', 'm'], [int, str, int])
+    assert encoder.encode_row((1, 'a"é', 2)) == dumps({
+        'n': 1,
+        's': 'a"é',
+        'm': 2
+    })
+
+
+def test_projection_matches_the_selected_keys():
+    fields = ('year', 'mike_site_name', 'illegal_carcasses')
+    encoder = mike_projection_encoder(fields)
+    for row in MIKE_ROWS:
+        record = MikeRecord(*row)
+        projected = tuple(getattr(record, field) for field in fields)
+        expected = dumps({
+            MikeRecord.JSON_KEYS[MikeRecord.FIELDS.index(field)]:
+            getattr(record, field)
+            for field in fields
+        })
+        assert encoder.encode_row(projected) == expected
+    assert mike_projection_encoder(fields) is encoder
+
+
+def test_compact_body_holds_every_record():
+    body = json.loads(encode_compact_mike_rows(MIKE_ROWS + MIKE_ROWS[:1]))
+    rebuilt = [
+        tuple(body['subregions'][r[0]].values()) +
+        tuple(body['countries'][r[1]].values()) +
+        tuple(body['sites'][r[2]].values()) + tuple(r[3:])
+        for r in body['records']
+    ]
+    assert rebuilt == MIKE_ROWS + MIKE_ROWS[:1]
+    assert len(body['sites']) == len(MIKE_ROWS)
+
+
+@pytest.mark.parametrize('types',
+                         [[float], [bool], [type(None)], [str, int, bytes]])
+def test_only_string_and_integer_columns_are_supported(types):
+    with pytest.raises(ValueError):
+        RowJsonEncoder(['k'] * len(types), types)
+
+
+def test_mismatched_keys_and_types_are_rejected():
+    with pytest.raises(ValueError):
+        RowJsonEncoder(['a', 'b'], [str])
+
+
+@pytest.mark.parametrize('column', [0, 7])
+def test_null_values_raise_instead_of_writing_invalid_json(column):
+    row = list(MIKE_ROWS[0])
+    row[column] = None
+    with pytest.raises(TypeError):
+        MIKE_RECORD_ENCODER.encode_row(tuple(row))
+
+
+@pytest.mark.parametrize('key,value', [('year', 2010.5), ('year', 2010.0),
+                                       ('carcasses', True),
+                                       ('illegalCarcasses', None),
+                                       ('mikeSiteName', 5),
+                                       ('unRegion', None)])
+def test_edited_records_must_hold_the_column_types(key, value):
+    # floats and booleans would be written as integers by the encoders, so they never reach the database
+    json_dict = obj_to_camel_dict(MikeRecord(*MIKE_ROWS[0]))
+    json_dict[key] = value
+    with pytest.raises(InvalidRecordError):
+        json_dict_to_mike(json_dict)
+    if key == 'year':
+        with pytest.raises(InvalidRecordError):
+            json_dict_to_mike_key(json_dict)